@@ -631,18 +631,30 @@ def process_subject(subject, cfg, be, bids_dir, rewrite):
     dm_to_bids = prepare_fieldmaps(dm_to_bids)
 
     # Transfer files over
+    bids_names = {}
     for k in dm_to_bids:
         if os.path.exists(k.dest_nii) and not rewrite:
             logger.info("Output file {} already exists!".format(k.dest_nii))
             continue
         k.transfer_files()
-        if dashboard.dash_found:
-            db_series = dashboard.get_scan(k.series.path)
-            db_series.add_bids(str(k))
+        bids_names[k.series.path] = str(k)
+
+    if dashboard.dash_found:
+        update_bids_names(bids_names)
 
     return
 
 
+def update_bids_names(bids_names):
+    """Record the BIDS name of each transferred series in the dashboard."""
+    db_series = dashboard.find_scans(list(bids_names))
+    for path, bids_name in bids_names.items():
+        try:
+            db_series[path].add_bids(bids_name)
+        except KeyError:
+            logger.error("Can't find {} in dashboard database".format(path))
+
+
 def main():
 
     arguments = docopt(__doc__)
@@ -19,15 +19,15 @@ Options:
 
 """
 import os
-import glob
 import logging
 
 from docopt import docopt
 
 import datman.config
+import datman.index
 import datman.scan
 import datman.utils
-from datman.scanid import ParseException
+from datman.scanid import ParseException, parse_filename
 
 logging.basicConfig(level=logging.WARN,
                     format="[%(name)s] %(levelname)s: %(message)s")
@@ -54,10 +54,12 @@ def main():
 
     config = datman.config.config(study=project)
     metadata = datman.utils.get_subject_metadata(config, allow_partial=True)
-    remove_blacklisted_items(metadata, config)
+    with datman.index.StudyIndex(config) as index:
+        index.refresh()
+        remove_blacklisted_items(metadata, config, index)
 
 
-def remove_blacklisted_items(metadata, config):
+def remove_blacklisted_items(metadata, config, index):
     for sub in metadata:
         blacklist_entries = metadata[sub]
         if not blacklist_entries:
@@ -69,20 +71,21 @@ def remove_blacklisted_items(metadata, config):
                          "Reason - {}".format(sub, e))
             continue
         logger.debug("Working on {}".format(sub))
-        remove_blacklisted(scan, blacklist_entries)
+        remove_blacklisted(scan, blacklist_entries, index)
 
 
-def remove_blacklisted(scan, entries):
+def remove_blacklisted(scan, entries, index):
+    folders = {
+        os.path.normpath(path) for path in [
+            scan.nii_path, scan.dcm_path, scan.nrrd_path, scan.mnc_path,
+            scan.resource_path
+        ]
+    }
     for entry in entries:
-        remove_matches(scan.nii_path, entry)
-        remove_matches(scan.dcm_path, entry)
-        remove_matches(scan.nrrd_path, entry)
-        remove_matches(scan.mnc_path, entry)
-        remove_matches(scan.resource_path, entry)
+        remove_matches(find_files(index, folders, entry))
 
 
-def remove_matches(path, fname):
-    matches = find_files(path, fname)
+def remove_matches(matches):
     if matches:
         logger.info("Files found for deletion: {}".format(matches))
     if DRYRUN:
@@ -96,8 +99,20 @@ def remove_matches(path, fname):
             logger.error("Failed to delete blacklisted item {}.".format(item))
 
 
-def find_files(path, fname):
-    return glob.glob(os.path.join(path, fname + "*"))
+def find_files(index, folders, fname):
+    """Find files in the given folders whose names start with fname."""
+    try:
+        ident, tag, series, _ = parse_filename(fname)
+    except ParseException:
+        logger.error("Blacklist entry {} is not a valid file name, "
+                     "ignoring.".format(fname))
+        return []
+    return [
+        record.path
+        for record in index.find(subject=ident, tag=tag, series=series)
+        if os.path.dirname(record.path) in folders
+        and os.path.basename(record.path).startswith(fname)
+    ]
 
 
 if __name__ == "__main__":
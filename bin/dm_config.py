@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Manages the frozen snapshot of the datman configuration files.
+
+Usage:
+    dm_config.py compile [options]
+
+Commands:
+    compile             Validate the main config file and every study config
+                        file listed in 'Projects' and save them to a snapshot
+                        next to the main config file.
+
+Options:
+    --config FILE       The main config file to compile. Defaults to the
+                        DM_CONFIG environment variable.
+    --system NAME       The system to validate settings for. Defaults to the
+                        DM_SYSTEM environment variable.
+    -v --verbose
+    -d --debug
+    -q --quiet
+
+Description:
+    Every datman script parses the main config file and a study's config file
+    on start up. When thousands of short jobs are submitted (e.g. by
+    dm_qc_report.py) this adds up. After running 'compile', datman.config
+    loads both from a single binary snapshot instead. Any config file that
+    has been modified since the snapshot was made is detected and parsed from
+    its YAML again, so the snapshot never needs to be deleted, though it
+    should be recompiled after config changes to keep start up fast.
+
+    Studies that fail validation are reported and left out of the snapshot.
+    The script exits with a non-zero status if any study failed.
+
+Example:
+    dm_config.py compile --config /archive/code/config/main_config.yml
+"""
+import logging
+import os
+import sys
+
+from docopt import docopt
+
+import datman.config
+from datman.exceptions import ConfigException
+
+logging.basicConfig(level=logging.WARN,
+                    format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+def main():
+    arguments = docopt(__doc__)
+    config_file = arguments['--config']
+    system = arguments['--system']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+    quiet = arguments['--quiet']
+
+    if verbose:
+        logger.setLevel(logging.INFO)
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger('datman.config').setLevel(logging.DEBUG)
+    if quiet:
+        logger.setLevel(logging.ERROR)
+
+    if arguments['compile']:
+        compile_snapshot(config_file, system)
+
+
+def compile_snapshot(config_file, system):
+    try:
+        snapshot, errors = datman.config.compile_snapshot(
+            filename=config_file, system=system)
+    except ConfigException as e:
+        logger.error("Can't compile configuration. Reason - {}".format(e))
+        sys.exit(1)
+
+    for study in sorted(errors):
+        logger.error("Study {} failed validation and was left out of the "
+                     "snapshot. Reason - {}".format(study, errors[study]))
+
+    logger.info("Wrote config snapshot {}".format(snapshot))
+
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
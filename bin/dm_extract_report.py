@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Merges the summaries written by sharded dm_xnat_extract.py runs.
+
+Usage:
+    dm_extract_report.py [options] <log_dir> [<study>]...
+
+Arguments:
+    <log_dir>           The folder given to dm_xnat_extract.py's --log-dir
+    <study>             Only report on these studies. Defaults to all
+                        studies with a summary in <log_dir>.
+
+Options:
+    --json              Print the merged report as JSON.
+    -v --verbose
+    -d --debug
+    -q --quiet
+
+Description:
+    Reports how many experiments each study's shards processed, which
+    experiments logged errors, and any shards that didn't finish or never
+    wrote a summary. Exits with a non-zero status if any shard is missing or
+    incomplete or any experiment logged errors, so it can be used as the
+    final step of a job array.
+"""
+import json
+import logging
+import os
+import sys
+
+from docopt import docopt
+
+import datman.sharding
+
+logging.basicConfig(level=logging.WARN,
+                    format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+def main():
+    arguments = docopt(__doc__)
+    log_dir = arguments['<log_dir>']
+    studies = arguments['<study>']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+    quiet = arguments['--quiet']
+
+    if verbose:
+        logger.setLevel(logging.INFO)
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    if quiet:
+        logger.setLevel(logging.ERROR)
+
+    summaries = [summary
+                 for summary in datman.sharding.read_summaries(log_dir)
+                 if not studies or summary['study'] in studies]
+    report = datman.sharding.merge_summaries(summaries)
+
+    for study in studies:
+        if study not in report:
+            logger.error("No summaries found for {}".format(study))
+
+    if arguments['--json']:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+
+    problems = [study for study, result in report.items()
+                if result['missing'] or result['incomplete'] or
+                result['failed']]
+    if problems or len(report) < len(studies):
+        sys.exit(1)
+
+
+def print_report(report):
+    for study in sorted(report):
+        result = report[study]
+        print("{}: {} experiments in {}/{} shards ({:.0f} seconds)".format(
+            study, result['experiments'], len(result['reported']),
+            result['shards'], result['seconds']))
+        if result['missing']:
+            print("    Missing shards: {}".format(
+                ", ".join(str(num) for num in result['missing'])))
+        if result['incomplete']:
+            print("    Incomplete shards: {}".format(
+                ", ".join(str(num) for num in result['incomplete'])))
+        for name in result['failed']:
+            print("    Errors logged for {}".format(name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Checks a study's processed series manifest against the files on disk.
+
+Usage:
+    dm_manifest.py verify [options] <study>
+    dm_manifest.py rebuild [options] <study>
+
+Arguments:
+    <study>             The name of a datman managed study
+
+Commands:
+    verify              Report recorded files that are missing or have
+                        changed since they were exported.
+    rebuild             Remove records for missing or changed files and add
+                        any exported files that arent recorded yet.
+
+Options:
+    --checksum          Compare file checksums as well as sizes, and when
+                        rebuilding record them for any files that dont have
+                        one yet. This reads every exported file and is slow.
+    --fix               When verifying, remove the records of any missing or
+                        changed files so they'll be exported again.
+    -v --verbose
+    -d --debug
+    -q --quiet
+
+Description:
+    dm_xnat_extract.py records every file it exports in the manifest
+    (processed_series.sqlite in the study's metadata folder) and skips any
+    series the manifest says are already exported. Files deleted or
+    replaced by hand won't be noticed until 'verify --fix' or 'rebuild' is
+    run. dm_xnat_extract.py doesn't record checksums, since that would mean
+    reading back every file it exports. Run 'rebuild --checksum' to add them
+    before using 'verify --checksum'.
+"""
+import logging
+import os
+import sys
+
+from docopt import docopt
+
+import datman.config
+import datman.manifest
+
+logging.basicConfig(level=logging.WARN,
+                    format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+def main():
+    arguments = docopt(__doc__)
+    study = arguments['<study>']
+    checksum = arguments['--checksum']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+    quiet = arguments['--quiet']
+
+    if verbose:
+        logger.setLevel(logging.INFO)
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    if quiet:
+        logger.setLevel(logging.ERROR)
+
+    config = datman.config.config(study=study)
+
+    with datman.manifest.ProcessedManifest.for_study(config) as manifest:
+        if arguments['verify']:
+            bad = verify(manifest, checksum, arguments['--fix'])
+            if bad and not arguments['--fix']:
+                sys.exit(1)
+        else:
+            removed, added = datman.manifest.rebuild(manifest, config,
+                                                     checksum=checksum)
+            logger.info("Removed {} records and added {} for {}".format(
+                removed, added, study))
+
+
+def verify(manifest, checksum, fix):
+    bad = manifest.verify(checksum=checksum)
+    for record in bad:
+        logger.warning("{} output {} is missing or has changed".format(
+            record.series, record.path))
+    if bad and fix:
+        manifest.remove(bad)
+        logger.info("Removed {} records".format(len(bad)))
+    return bad
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Manages a study's QC metadata database.
+
+Usage:
+    dm_metadata.py export [options] <study>
+
+Arguments:
+    <study>             The name of a datman managed study
+
+Commands:
+    export              Write the study's checklist and blacklist entries
+                        from its metadata database to checklist.csv and
+                        blacklist.csv in the study's metadata folder.
+
+Options:
+    -v --verbose
+    -d --debug
+    -q --quiet
+
+Description:
+    Studies with 'METADATA_BACKEND: sqlite' in their config keep their QC
+    checklist and blacklist entries in a database instead of the csv files.
+    Any tools outside of datman that still read the csv files can be kept
+    up to date by running 'export' (e.g. from cron).
+"""
+import logging
+import os
+import sys
+
+from docopt import docopt
+
+import datman.config
+import datman.utils
+from datman.exceptions import MetadataException
+
+logging.basicConfig(level=logging.WARN,
+                    format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+def main():
+    arguments = docopt(__doc__)
+    study = arguments['<study>']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+    quiet = arguments['--quiet']
+
+    if verbose:
+        logger.setLevel(logging.INFO)
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    if quiet:
+        logger.setLevel(logging.ERROR)
+
+    config = datman.config.config(study=study)
+
+    if arguments['export']:
+        export_csv(config)
+
+
+def export_csv(config):
+    meta_dir = config.get_path('meta')
+    try:
+        with datman.utils.open_metadata_db(config) as db:
+            if not db:
+                logger.error("Study {} does not use a metadata database. "
+                             "Nothing to export.".format(config.study_name))
+                sys.exit(1)
+            db.export_csv(
+                checklist_path=os.path.join(meta_dir, 'checklist.csv'),
+                blacklist_path=os.path.join(meta_dir, 'blacklist.csv'))
+    except MetadataException as e:
+        logger.error("Failed to export metadata for {}. Reason - {}".format(
+            config.study_name, e))
+        sys.exit(1)
+
+    logger.info("Exported metadata for {} to {}".format(
+        config.study_name, meta_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -369,6 +369,9 @@ def get_all_subjects(config):
 def new_subject(subject_id, config):
     try:
         subject = datman.scan.Scan(subject_id, config)
+        # Read the niftis now so that subjects with misnamed files are
+        # rejected here, instead of by the job submitted for them
+        subject.niftis
     except datman.scanid.ParseException:
         logger.error("{} does not conform to datman naming convention. "
                      "Ignoring.".format(subject_id))
@@ -1069,6 +1072,8 @@ def prepare_scan(subject_id, config):
     global REWRITE
     try:
         subject = datman.scan.Scan(subject_id, config)
+        # Misnamed files are only detected when the niftis are first read
+        subject.niftis
     except datman.scanid.ParseException as e:
         logger.error(e, exc_info=True)
         sys.exit(1)
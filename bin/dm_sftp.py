@@ -17,14 +17,16 @@ Options:
 """
 import logging
 import os
-import shutil
 import fnmatch
+import stat
 
 import pysftp
 
 from docopt import docopt
 import datman.config
-from datman.utils import make_temp_directory
+from datman.exceptions import StorageException
+from datman.storage import StorageBudget
+from datman.utils import make_zip
 
 logging.basicConfig(level=logging.WARN,
                     format="[%(asctime)s %(name)s] %(levelname)s: %(message)s")
@@ -64,6 +66,7 @@ def main():
             os.mkdir(zips_path)
 
     server_config = get_server_config(cfg)
+    budget = StorageBudget.for_config(cfg)
 
     for mrserver in server_config:
         mrusers, mrfolders, pass_file_name, port = server_config[mrserver]
@@ -98,7 +101,7 @@ def main():
                     #  process each folder in turn
                     logger.debug('Copying from:{}  to:{}'
                                  .format(valid_dir, zips_path))
-                    process_dir(sftp, valid_dir, zips_path)
+                    process_dir(sftp, valid_dir, zips_path, budget)
 
 
 def get_server_config(cfg):
@@ -182,10 +185,12 @@ def get_valid_remote_dirs(connection, mrfolders):
     return valid_dirs
 
 
-def process_dir(connection, directory, zips_path):
+def process_dir(connection, directory, zips_path, budget=None):
     """Process a directory on the ftp server,
     copy new files to zips_path
     """
+    if not budget:
+        budget = StorageBudget()
     with connection.cd(directory):
         try:
             files = connection.listdir()
@@ -195,35 +200,69 @@ def process_dir(connection, directory, zips_path):
                          .format(directory))
             return
         for file_name in files:
-            if connection.isfile(file_name):
-                get_file(connection, file_name, zips_path)
-            else:
-                get_folder(connection, file_name, zips_path)
+            try:
+                if connection.isfile(file_name):
+                    get_file(connection, file_name, zips_path, budget)
+                else:
+                    get_folder(connection, file_name, zips_path, budget)
+            except StorageException as e:
+                logger.error('Cant copy remote file {}. Reason: {}'
+                             .format(file_name, e))
 
 
-def get_folder(connection, folder_name, dst_path):
+def get_folder(connection, folder_name, dst_path, budget):
     expected_file = os.path.join(dst_path, folder_name + ".zip")
     if not download_needed(connection, folder_name, expected_file):
         logger.debug("File: {} already exists, skipping".format(folder_name))
         return
 
-    with make_temp_directory() as temp_dir:
+    # The zip will be no larger than the folder it's made from
+    size = get_remote_size(connection, folder_name)
+    with budget.temp_directory(size) as temp_dir, \
+            budget.reserve(dst_path, size):
         # Note 'get_r' is needed instead of 'get'
         connection.get_r(folder_name, temp_dir, preserve_mtime=True)
         source = os.path.join(temp_dir, folder_name)
-        dest = os.path.join(dst_path, folder_name)
-        new_zip = shutil.make_archive(dest, 'zip', source)
+        # Zip to a partial file first, so an interrupted copy is never
+        # mistaken for a finished one
+        partial = expected_file + '.part'
+        try:
+            make_zip(source, partial)
+            os.replace(partial, expected_file)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
         logger.info("Copied remote file {} to {}".format(folder_name,
-                                                         new_zip))
+                                                         expected_file))
 
 
-def get_file(connection, file_name, zips_path):
+def get_file(connection, file_name, zips_path, budget):
     target = os.path.join(zips_path, file_name)
-    if download_needed(connection, file_name, target):
-        logger.info('Copying new remote file: {}'.format(file_name))
-        connection.get(file_name, target, preserve_mtime=True)
-    else:
+    if not download_needed(connection, file_name, target):
         logger.debug("File: {} already exists, skipping".format(file_name))
+        return
+
+    logger.info('Copying new remote file: {}'.format(file_name))
+    partial = target + '.part'
+    with budget.reserve(zips_path, connection.stat(file_name).st_size):
+        try:
+            connection.get(file_name, partial, preserve_mtime=True)
+            os.replace(partial, target)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+
+def get_remote_size(connection, path):
+    """Returns the total size of the files beneath a remote folder."""
+    size = 0
+    for attrs in connection.listdir_attr(path):
+        item = '{}/{}'.format(path, attrs.filename)
+        if stat.S_ISDIR(attrs.st_mode):
+            size += get_remote_size(connection, item)
+        else:
+            size += attrs.st_size
+    return size
 
 
 def download_needed(sftp, filename, target):
@@ -109,8 +109,8 @@ def get_series(file_name):
     return int(os.path.basename(file_name).split("_")[1][1:])
 
 
-def is_blacklisted(resource_file, session):
-    blacklist = datman.utils.read_blacklist(subject=session)
+def is_blacklisted(resource_file, session, config):
+    blacklist = datman.utils.read_blacklist(subject=session, config=config)
     if not blacklist:
         return False
     series = get_series(resource_file)
@@ -204,7 +204,7 @@ def main():
                 try:
                     scan_filename = os.path.splitext(dcm_dict[series_num])[0]
                 except (IndexError, KeyError):
-                    if is_blacklisted(f, session_name):
+                    if is_blacklisted(f, session_name, cfg):
                         logger.info('Ignored blacklisted series {}'.format(f))
                         continue
                     logger.error('Corresponding dcm file not found for {}'
@@ -18,6 +18,13 @@ Options:
                           you are prompted for a password. Note that if
                           multiple servers are configured for a study the
                           login used should be valid for all servers.
+    --async               Upload dicoms to XNAT's prearchive without waiting
+                          for XNAT to archive them. Each upload is recorded in
+                          the study's import ledger and checked on (and
+                          archived once ready) while the next archive uploads,
+                          or on a later run if this one is interrupted.
+    --wait SECONDS        With --async, keep checking on unfinished imports
+                          for up to SECONDS before exiting. [default: 0]
     -v --verbose          Be chatty
     -d --debug            Be very chatty
     -q --quiet            Be quiet
@@ -26,6 +33,7 @@ Options:
 import logging
 import sys
 import os
+import time
 import zipfile
 import urllib.request
 
@@ -36,6 +44,8 @@ import datman.utils
 import datman.scanid
 import datman.xnat
 import datman.exceptions
+import datman.import_ledger
+import datman.storage
 
 logger = logging.getLogger(os.path.basename(__file__))
 
@@ -43,12 +53,16 @@ SERVERS = {}
 SERVER_OVERRIDE = None
 AUTH = None
 CFG = None
+LEDGER = None
+STORAGE = None
 
 
 def main():
     global SERVER_OVERRIDE
     global AUTH
     global CFG
+    global LEDGER
+    global STORAGE
 
     arguments = docopt(__doc__)
     verbose = arguments["--verbose"]
@@ -58,6 +72,8 @@ def main():
     SERVER_OVERRIDE = arguments["--server"]
     username = arguments["--username"]
     archive = arguments["<archive>"]
+    use_async = arguments["--async"]
+    wait = int(arguments["--wait"])
 
     # setup logging
     ch = logging.StreamHandler(sys.stdout)
@@ -81,6 +97,7 @@ def main():
     logger.addHandler(ch)
 
     CFG = datman.config.config(study=study)
+    STORAGE = datman.storage.StorageBudget.for_config(CFG)
     if username:
         AUTH = datman.xnat.get_auth(username)
 
@@ -101,11 +118,23 @@ def main():
     else:
         archives = os.listdir(dicom_dir)
 
+    if use_async:
+        LEDGER = datman.import_ledger.ImportLedger(os.path.join(
+            CFG.get_path("meta"), datman.import_ledger.IMPORT_LEDGER))
+        # Catch up on imports left unfinished by earlier runs first
+        check_imports()
+
     logger.debug("Processing files in: {}".format(dicom_dir))
     logger.info("Processing {} files".format(len(archives)))
 
     for file_name in archives:
         process_archive(file_name, dicom_dir)
+        if LEDGER:
+            check_imports()
+
+    if LEDGER:
+        check_imports(wait)
+        LEDGER.close()
 
 
 def is_valid_id(archive):
@@ -129,6 +158,11 @@ def process_archive(file_name, dicom_dir):
     # convention than file system uses.
     archive_file = os.path.join(dicom_dir, str(scanid) + ".zip")
 
+    if is_importing(archive_file):
+        logger.info("{} is still being imported by XNAT, skipping".format(
+            archive_file))
+        return
+
     xnat = datman.xnat.get_connection(CFG,
                                       site=scanid.site,
                                       url=SERVER_OVERRIDE,
@@ -166,6 +200,11 @@ def process_archive(file_name, dicom_dir):
                          .format(archive_file, xnat_subject.project,
                                  xnat_subject.name, e))
 
+    if is_importing(archive_file):
+        # Resources need the experiment to exist, so they're uploaded once
+        # XNAT has archived the dicoms
+        return
+
     if not resource_exists:
         logger.debug("Uploading resource from: {}".format(archive_file))
         try:
@@ -176,6 +215,87 @@ def process_archive(file_name, dicom_dir):
             pass
 
 
+def is_importing(archive_file):
+    """Check if an asynchronous upload of an archive is still in progress.
+    """
+    if not LEDGER:
+        return False
+    record = LEDGER.get(archive_file)
+    return record is not None and \
+        record.state == datman.import_ledger.QUEUED
+
+
+def check_imports(wait=0):
+    """Check on uploads XNAT is still importing, archiving any that are
+    ready.
+
+    Args:
+        wait (int, optional): The number of seconds to keep checking for
+            before giving up on unfinished imports until the next run.
+            Defaults to 0 (check each import that is due once).
+    """
+    deadline = time.time() + wait
+    while True:
+        for record in LEDGER.find(states=[datman.import_ledger.QUEUED],
+                                  due=True):
+            finish_import(record)
+
+        remaining = LEDGER.find(states=[datman.import_ledger.QUEUED])
+        if not remaining or time.time() >= deadline:
+            break
+        next_check = min(record.next_check for record in remaining)
+        time.sleep(max(min(next_check, deadline) - time.time(), 1))
+
+    if remaining:
+        logger.info("{} uploads are still being imported by XNAT and will "
+                    "be checked on the next run".format(len(remaining)))
+
+
+def finish_import(record):
+    """Check on a single queued upload, uploading its resources once XNAT
+    has archived it."""
+    try:
+        scanid = get_scanid(os.path.basename(record.archive))
+    except datman.scanid.ParseException as e:
+        LEDGER.failed(record.archive, str(e))
+        logger.error("Failed to find valid identifier for {}. Reason: {}"
+                     "".format(record.archive, e))
+        return
+
+    try:
+        xnat = datman.xnat.get_connection(CFG,
+                                          site=scanid.site,
+                                          url=SERVER_OVERRIDE,
+                                          auth=AUTH,
+                                          server_cache=SERVERS)
+    except Exception as e:
+        logger.error("Failed to connect to XNAT to check on {}. Reason - {}"
+                     "".format(record.archive, e))
+        LEDGER.retry_later(record.archive, str(e))
+        return
+
+    state = datman.import_ledger.check_import(LEDGER, record, xnat)
+
+    if state == datman.import_ledger.FAILED:
+        logger.error("XNAT failed to import {} to project {}. Check "
+                     "Prearchive. Reason - {}".format(
+                         record.archive, record.project,
+                         LEDGER.get(record.archive).message))
+        return
+
+    if state != datman.import_ledger.DONE:
+        return
+
+    logger.info("XNAT has archived {}".format(record.archive))
+    if not os.path.exists(record.archive):
+        return
+    logger.debug("Uploading resource from: {}".format(record.archive))
+    try:
+        upload_non_dicom_data(record.archive, record.project, scanid, xnat)
+    except Exception as e:
+        logger.debug("An exception occurred: {}".format(e))
+
+
 def get_xnat_subject(ident, xnat):
     """Get an XNAT subject from the server.
 
@@ -374,22 +494,46 @@ def upload_dicom_data(archive, xnat_project, scanid, xnat):
     # upload_non_dicom_data and added to resources - Dawn
 
     if not contains_niftis(archive):
-        xnat.put_dicoms(xnat_project, scanid.get_xnat_subject_id(),
-                        scanid.get_xnat_experiment_id(), archive)
+        put_dicoms(archive, archive, xnat_project, scanid, xnat)
         return
 
     # Need to account for when only niftis are available
-    with datman.utils.make_temp_directory() as temp:
+    storage = STORAGE or datman.storage.StorageBudget()
+    with storage.temp_directory(get_stripped_size(archive)) as temp:
         new_archive = strip_niftis(archive, temp)
 
         if new_archive:
-            xnat.put_dicoms(xnat_project, scanid.get_xnat_subject_id(),
-                            scanid.get_xnat_experiment_id(), new_archive)
+            put_dicoms(archive, new_archive, xnat_project, scanid, xnat)
         else:
             logger.info("No dicoms exist within archive {}, skipping dicom "
                         "upload!".format(archive))
 
 
+def put_dicoms(archive, upload_file, xnat_project, scanid, xnat):
+    """Upload dicoms, handing them off to the prearchive in async mode.
+
+    Args:
+        archive (str): The path to the original archive, used to track the
+            upload in the import ledger.
+        upload_file (str): The path to the zip file to upload.
+        xnat_project (str): The XNAT project to upload to.
+        scanid (:obj:`datman.scanid.Identifier`): The archive's ID.
+        xnat (:obj:`datman.xnat.xnat`): A connection to the server.
+    """
+    subject = scanid.get_xnat_subject_id()
+    experiment = scanid.get_xnat_experiment_id()
+
+    if not LEDGER:
+        xnat.put_dicoms(xnat_project, subject, experiment, upload_file)
+        return
+
+    LEDGER.start(archive, xnat_project, subject, experiment)
+    prearchive = xnat.put_dicoms_async(xnat_project, subject, experiment,
+                                       upload_file)
+    LEDGER.queued(archive, prearchive)
+    logger.info("Uploaded {} to prearchive {}".format(archive, prearchive))
+
+
 def contains_niftis(archive):
     with zipfile.ZipFile(archive) as zf:
         archive_files = zf.namelist()
@@ -397,6 +541,14 @@ def contains_niftis(archive):
     return niftis != []
 
 
+def get_stripped_size(archive):
+    """Estimate the temporary space strip_niftis needs for an archive: its
+    unpacked contents and a new zip file no larger than the original."""
+    with zipfile.ZipFile(archive) as zf:
+        unpacked = sum(item.file_size for item in zf.infolist())
+    return unpacked + os.path.getsize(archive)
+
+
 def strip_niftis(archive, temp):
     """
     Extract the everything except niftis to temp folder, rezip, and then
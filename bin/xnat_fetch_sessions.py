@@ -54,6 +54,8 @@ from zipfile import ZipFile
 from docopt import docopt
 
 import datman.config
+import datman.exceptions
+import datman.storage
 import datman.xnat
 import datman.utils
 
@@ -90,6 +92,7 @@ def main():
         return
 
     config = datman.config.config(study=study)
+    budget = datman.storage.StorageBudget.for_config(config)
 
     if use_server:
         add_server_handler(config)
@@ -105,10 +108,13 @@ def main():
             continue
         username, password = get_credentials(credentials_file)
         with datman.xnat.xnat(server, username, password) as xnat:
-            download_subjects(xnat, project, destination)
+            download_subjects(xnat, project, destination, budget)
 
 
-def download_subjects(xnat, xnat_project, destination):
+def download_subjects(xnat, xnat_project, destination, budget=None):
+    if not budget:
+        budget = datman.storage.StorageBudget()
+
     try:
         current_zips = os.listdir(destination)
     except FileNotFoundError:
@@ -149,15 +155,23 @@ def download_subjects(xnat, xnat_project, destination):
                             experiment.name, xnat_project, zip_path))
             return
 
-        with datman.utils.make_temp_directory() as temp:
-            try:
-                temp_zip = experiment.download(
-                    xnat, temp, zip_name=zip_name)
-            except Exception as e:
-                logger.error("Cant download experiment {}. Reason: {}"
-                             "".format(experiment, e))
-                continue
-            restructure_zip(temp_zip, zip_path)
+        # The zip may need to be unpacked to restructure it, and the result
+        # takes roughly the experiment's size again in the destination
+        try:
+            with budget.temp_directory(datman.storage.archive_footprint(
+                    experiment.size)) as temp, \
+                    budget.reserve(destination, experiment.size):
+                try:
+                    temp_zip = experiment.download(
+                        xnat, temp, zip_name=zip_name)
+                except Exception as e:
+                    logger.error("Cant download experiment {}. Reason: {}"
+                                 "".format(experiment, e))
+                    continue
+                restructure_zip(temp_zip, zip_path)
+        except datman.exceptions.StorageException as e:
+            logger.error("Cant download experiment {}. Reason: {}".format(
+                experiment, e))
 
 
 def update_needed(zip_file, experiment, xnat):
@@ -9,9 +9,14 @@ switch between multiple installations of datman or different computing systems.
 These can both be overridden at ``__init__.py``
 """
 
+import copy
 import inspect
+import json
 import logging
 import os
+import pickle
+import re
+import time
 
 import wrapt
 import yaml
@@ -22,15 +27,57 @@ from datman.exceptions import ConfigException, UndefinedSetting
 
 logger = logging.getLogger(__name__)
 
+# How often (in seconds) the config files are checked for changes. Cached
+# settings are discarded when a change is found.
+CACHE_CHECK_INTERVAL = 5
+
+# The name of the file (stored in CONFIG_DIR) that persists the index of
+# study / site tags to project names between runs.
+PROJECT_INDEX_FILE = ".datman_project_index.json"
+
+# Bump this whenever the layout of the config snapshot changes, so that
+# snapshots written by older versions get ignored.
+SNAPSHOT_VERSION = 1
+
+# Use the much faster libyaml parser when PyYAML was built with it
+try:
+    YAML_LOADER = yaml.CSafeLoader
+except AttributeError:
+    YAML_LOADER = yaml.SafeLoader
+
+# Maps each function wrapped by study_required to the position of its
+# 'study' argument, so the signature only has to be inspected once.
+_STUDY_ARG_POSITION = {}
+
+
+def _get_study_arg(func, args, kwargs):
+    """Find the 'study' argument given to a method wrapped by study_required.
+
+    This is needed in case user passes keyword args as positional parameters
+    e.g. config.get_path('nii', 'SPINS') instead of
+    config.get_path('nii', study='SPINS')
+    """
+    if "study" in kwargs:
+        return kwargs["study"]
+
+    unbound = getattr(func, "__func__", func)
+    try:
+        position = _STUDY_ARG_POSITION[unbound]
+    except KeyError:
+        params = list(inspect.signature(func).parameters)
+        position = params.index("study") if "study" in params else None
+        _STUDY_ARG_POSITION[unbound] = position
+
+    if position is None or position >= len(args):
+        return None
+    return args[position]
+
 
 @wrapt.decorator
 def study_required(func, instance, args, kwargs):
-    # This is needed in case user passes keyword args as positional parameters
-    # e.g. config.get_path('nii', 'SPINS') instead of
-    # config.get_path('nii', study='SPINS')
-    found_kwargs = inspect.getcallargs(func, *args, **kwargs)
-    if "study" in found_kwargs and found_kwargs["study"]:
-        instance.set_study(found_kwargs["study"])
+    study = _get_study_arg(func, args, kwargs)
+    if study:
+        instance.set_study(study)
     if not instance.study_config:
         raise ConfigException("Study not set.")
     return func(*args, **kwargs)
@@ -43,7 +90,8 @@ class config(object):
     study_name = None
     study_config_file = None
 
-    def __init__(self, filename=None, system=None, study=None):
+    def __init__(self, filename=None, system=None, study=None,
+                 use_snapshot=True):
         """
         Manages the datman configuration files.
 
@@ -58,7 +106,17 @@ class config(object):
                        DM_SYSTEM
             study    - Loads the settings for a specific study in addition to
                        the site-wide settings.
+            use_snapshot - Whether to read config files from the snapshot made
+                       by compile_snapshot() (if one exists). Files that
+                       have changed since the snapshot was made are always
+                       parsed again.
+
+        Resolved settings, paths and tags are cached per study and site, so
+        repeated lookups are cheap. The cache is discarded if any of the
+        config files are modified.
         """
+        self._sources = {}
+        self._clear_cache()
 
         if not filename:
             try:
@@ -66,7 +124,13 @@ class config(object):
             except KeyError:
                 raise ConfigException("Failed to find main config file")
 
+        if use_snapshot:
+            self._snapshot = read_snapshot(filename)
+        else:
+            self._snapshot = {}
+
         self.system_config = self.load_yaml(filename)
+        self.system_config_path = filename
 
         if not system:
             try:
@@ -91,10 +155,64 @@ class config(object):
             raise ConfigException(
                 f"configuration file {filename} not found. Try again."
             )
-        with open(filename, "r") as stream:
-            config_yaml = yaml.load(stream, Loader=yaml.SafeLoader)
+        mtime = os.path.getmtime(filename)
+        self._sources[filename] = mtime
 
-        return config_yaml
+        try:
+            snap_mtime, config_yaml = self._snapshot["files"][
+                os.path.abspath(filename)
+            ]
+        except KeyError:
+            pass
+        else:
+            if snap_mtime == mtime:
+                return config_yaml
+
+        return parse_yaml(filename)
+
+    def _clear_cache(self):
+        self._settings_cache = {}
+        self._path_cache = {}
+        self._tags_cache = {}
+        self._project_index = None
+        self._last_check = time.monotonic()
+
+    def _check_sources(self):
+        """
+        Discards all cached settings and reloads the configuration if any
+        of the config files read so far have changed on disk.
+
+        To keep lookups cheap the files are only checked once every
+        CACHE_CHECK_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if now - self._last_check < CACHE_CHECK_INTERVAL:
+            return
+        self._last_check = now
+
+        for path, mtime in self._sources.items():
+            try:
+                changed = os.path.getmtime(path) != mtime
+            except OSError:
+                changed = True
+            if changed:
+                break
+        else:
+            return
+
+        logger.debug("Configuration files changed on disk, reloading.")
+        self._sources = {}
+        self._clear_cache()
+        self.system_config = self.load_yaml(self.system_config_path)
+        system_settings = self._search_system_conf("SystemSettings")
+        try:
+            self.install_config = system_settings[self.system]
+        except KeyError:
+            raise ConfigException(
+                f"Installation {self.system} not found in main config file"
+            )
+        if self.study_config:
+            self.study_config = self.load_yaml(self.study_config_path)
 
     def set_study(self, study_name):
         """
@@ -107,6 +225,9 @@ class config(object):
 
         if study_name.lower() in valid_projects:
             study_name = study_name.upper()
+            if self.study_config and study_name == self.study_name:
+                # Already loaded, any changes are caught by _check_sources
+                return
         else:
             # This will raise an exception if given only the 'DTI' id because
             # two studies are mapped to this ID. Give set_study() a full
@@ -154,6 +275,10 @@ class config(object):
         One project tag (DTI) is shared between two xnat archives (DTI15T and
         DTI3T), the site is used to differentiate between them. As a result, if
         only a 'DTI' project tag is given this function raises an exception.
+
+        When the dashboard isn't available, tags are looked up in an index
+        built from all study config files (see _get_project_index) instead of
+        loading each study in turn.
         """
         logger.debug(f"Searching projects for: {filename}")
 
@@ -191,42 +316,133 @@ class config(object):
             self.set_study(tag)
             return tag
 
-        for project in projects.keys():
-            # search each project for a match to the study tag,
-            # this loop exits as soon as a match is found.
-            logger.debug(f"Searching project: {project}")
+        try:
+            candidates = self._get_project_index()[tag.lower()]
+        except KeyError:
+            # didn't find a match throw a warning
+            logger.warning(f"Failed to find a valid project for xnat id: {tag}")
+            raise ValueError
+
+        # If the same tag is used by more than one study, prefer the study
+        # that defines the ID's site
+        project = candidates[0][0]
+        for name, sites in candidates:
+            if site in sites:
+                project = name
+                break
+
+        # Hack to deal with DTI not being a unique tag :(
+        if project.upper() == "DTI15T" or project.upper() == "DTI3T":
+            if site == "TGH":
+                project = "DTI15T"
+            else:
+                project = "DTI3T"
+
+        self.set_study(project)
+        return project
+
+    def _get_project_index(self):
+        """
+        Returns a dictionary that maps each lower case study tag and site tag
+        to a list of [project, sites] pairs, in the order the projects are
+        listed in the 'Projects' setting.
+
+        The index is built once per config load, and saved to
+        PROJECT_INDEX_FILE in CONFIG_DIR so that later runs only need to check
+        the study config files' modification times instead of parsing every
+        one of them.
+        """
+        if self._project_index is not None:
+            return self._project_index
 
-            self.set_study(project)
-            site_tags = []
+        config_dir = self.get_key("CONFIG_DIR")
+        projects = self.get_key("Projects")
+        study_files = self._get_study_files()
+        mtimes = _get_mtimes(study_files.values())
+
+        index_file = os.path.join(config_dir, PROJECT_INDEX_FILE)
+        for saved in (self._snapshot.get("project_index"),
+                      _read_json(index_file)):
+            if (
+                saved
+                and saved.get("projects") == list(projects)
+                and saved.get("sources") == mtimes
+            ):
+                self._project_index = saved["index"]
+                return self._project_index
+
+        logger.debug("Building study tag index from project config files.")
+        self._project_index = self._build_project_index(study_files)
+
+        # Other jobs may be reading the index, so it's replaced in one step
+        temp_file = f"{index_file}.{os.getpid()}.tmp"
+        try:
+            with open(temp_file, "w") as fh:
+                json.dump(self._dump_project_index(mtimes), fh)
+            os.replace(temp_file, index_file)
+        except OSError as e:
+            logger.debug(f"Can't save study tag index {index_file}. {e}")
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+        return self._project_index
+
+    def _dump_project_index(self, mtimes):
+        return {
+            "projects": list(self.get_key("Projects")),
+            "sources": mtimes,
+            "index": self._project_index,
+        }
+
+    def _get_study_files(self):
+        """Returns a dictionary of project names mapped to their config file.
+        """
+        config_dir = self.get_key("CONFIG_DIR")
+        projects = self.get_key("Projects")
+        return {
+            project: os.path.join(config_dir, projects[project])
+            for project in projects
+        }
 
-            if "Sites" not in self.study_config.keys():
+    def _build_project_index(self, study_files):
+        """
+        Reads every study's config file to map its study tag and site tags to
+        the project name.
+        """
+        index = {}
+        for project, path in study_files.items():
+            logger.debug(f"Searching project: {project}")
+            try:
+                study_config = self.load_yaml(path)
+            except ConfigException as e:
+                logger.debug(f"Can't read config for {project}. {e}")
+                continue
+
+            if not study_config or "Sites" not in study_config:
                 logger.debug(f"No sites defined for {project}")
                 continue
 
-            for key, site_config in self.get_key("Sites").items():
+            all_sites = list(study_config["Sites"])
+            tags = {}
+
+            study_tag = study_config.get("STUDY_TAG")
+            if study_tag:
+                tags[study_tag.lower()] = set(all_sites)
+
+            for site, site_config in study_config["Sites"].items():
                 try:
-                    add_tags = [t.lower() for t in site_config["SITE_TAGS"]]
-                except KeyError:
-                    add_tags = []
-                site_tags.extend(add_tags)
-
-            site_tags.append(self.study_config["STUDY_TAG"].lower())
-
-            if tag.lower() in site_tags:
-                # Hack to deal with DTI not being a unique tag :(
-                if project.upper() == "DTI15T" or project.upper() == "DTI3T":
-                    if parts.site == "TGH":
-                        project = "DTI15T"
-                    else:
-                        project = "DTI3T"
-                # Needs to be set here in addition to at the top of the loop in
-                # case the wrong DTI study settings were encountered
-                # for the last set_study call. Ugh.
-                self.set_study(project)
-                return project
-        # didn't find a match throw a warning
-        logger.warn(f"Failed to find a valid project for xnat id: {tag}")
-        raise ValueError
+                    site_tags = site_config["SITE_TAGS"]
+                except (KeyError, TypeError):
+                    continue
+                if isinstance(site_tags, str):
+                    site_tags = [site_tags]
+                for site_tag in site_tags:
+                    tags.setdefault(site_tag.lower(), set()).add(site)
+
+            for tag, sites in tags.items():
+                index.setdefault(tag, []).append([project, sorted(sites)])
+
+        return index
 
     def _search_site_conf(self, site, key):
         """
@@ -362,9 +578,41 @@ class config(object):
         If 'ignore_defaults' is set the search is restricted to only site (if
         site was given) or only the current study (if site was not).
 
+        Values are cached, so dictionaries and lists are returned as copies
+        that can be changed without affecting later lookups.
+
         Raises UndefinedSetting if no value is found
         """
+        self._check_sources()
+
+        study = self.study_name if self.study_config else None
+        scope = (study, site, ignore_defaults, defaults_only)
+        settings = self._settings_cache.setdefault(scope, {})
+
+        try:
+            value = settings[key]
+        except KeyError:
+            try:
+                value = self._resolve_key(
+                    key, site, ignore_defaults, defaults_only
+                )
+            except UndefinedSetting as e:
+                # Misses are remembered too, so they dont have to be searched
+                # for again
+                value = UndefinedSetting(*e.args)
+            settings[key] = value
+
+        if isinstance(value, UndefinedSetting):
+            raise UndefinedSetting(*value.args)
+        if isinstance(value, (dict, list)):
+            return copy.deepcopy(value)
+        return value
 
+    def _resolve_key(self, key, site, ignore_defaults, defaults_only):
+        """
+        Does the actual search for get_key(). Results from this should be
+        cached because each call may need to search all four scopes.
+        """
         value = None
         if site and not defaults_only:
             value = self._get_setting(
@@ -394,6 +642,12 @@ class config(object):
     @study_required
     def get_path(self, path_type, study=None):
         """returns the absolute path to a folder type"""
+        self._check_sources()
+        try:
+            return self._path_cache[(self.study_name, path_type)]
+        except KeyError:
+            pass
+
         paths = self.get_key("Paths")
 
         try:
@@ -401,7 +655,9 @@ class config(object):
         except KeyError:
             raise UndefinedSetting(f"Path {path_type} not defined")
 
-        return os.path.join(self.get_study_base(), sub_dir)
+        path = os.path.join(self.get_study_base(), sub_dir)
+        self._path_cache[(self.study_name, path_type)] = path
+        return path
 
     @study_required
     def get_tags(self, site=None, study=None):
@@ -417,7 +673,17 @@ class config(object):
         site. If there's a key conflict between 'ExportInfo' (study config) and
         'ExportSettings' (system config) the values in 'ExportInfo' will
         override the values in 'ExportSettings'.
+
+        TagInfo instances are cached for each study and site. Each call
+        returns a copy whose settings can be changed without affecting later
+        calls, but which shares the cached instance's compiled TagMatcher.
         """
+        self._check_sources()
+        try:
+            return self._tags_cache[(self.study_name, site)].copy()
+        except KeyError:
+            pass
+
         if site:
             export_info = self.get_key("ExportInfo", site=site)
         else:
@@ -431,7 +697,9 @@ class config(object):
                 "defined in main configuration file."
             )
 
-        return TagInfo(export_settings, export_info)
+        tags = TagInfo(export_settings, export_info)
+        self._tags_cache[(self.study_name, site)] = tags
+        return tags.copy()
 
     @study_required
     def get_xnat_projects(self, study=None):
@@ -486,8 +754,151 @@ class config(object):
         return tags
 
 
+def parse_yaml(filename):
+    """Parse a YAML file with the fastest available safe loader."""
+    with open(filename, "r") as stream:
+        return yaml.load(stream, Loader=YAML_LOADER)
+
+
+def _get_mtimes(paths):
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def _read_json(filename):
+    try:
+        with open(filename, "r") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _validate_study(cfg, study):
+    """
+    Load a study and check that each site's export tags define valid
+    patterns. Raises an exception if any problems are found.
+    """
+    cfg.set_study(study)
+    for site in cfg.get_sites():
+        try:
+            tags = cfg.get_tags(site=site)
+        except UndefinedSetting:
+            # Sites that arent exported from XNAT dont need ExportInfo
+            continue
+        # Older configs give a tag's SeriesDescription pattern on its own
+        series_map = {
+            tag: pattern if isinstance(pattern, dict) else {
+                "SeriesDescription": pattern}
+            for tag, pattern in tags.series_map.items()
+        }
+        try:
+            TagMatcher(series_map)
+        except ConfigException as e:
+            raise ConfigException(f"Invalid export tags at site {site}. {e}")
+
+
+def get_snapshot_path(filename):
+    """Returns the location of the snapshot for a main config file."""
+    return filename + ".snapshot"
+
+
+def read_snapshot(filename):
+    """
+    Read the snapshot made by compile_snapshot() for a main config file.
+
+    An empty dictionary is returned if no usable snapshot exists. Individual
+    files in the snapshot still need to be checked for changes before use.
+    """
+    snapshot_path = get_snapshot_path(filename)
+    try:
+        with open(snapshot_path, "rb") as fh:
+            snapshot = pickle.load(fh)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable config snapshot {snapshot_path}."
+                       f" Reason - {e}")
+        return {}
+
+    if (
+        not isinstance(snapshot, dict)
+        or snapshot.get("version") != SNAPSHOT_VERSION
+    ):
+        logger.info(f"Ignoring outdated config snapshot {snapshot_path}")
+        return {}
+    return snapshot
+
+
+def compile_snapshot(filename=None, system=None):
+    """
+    Validate all configuration files and save them to a snapshot.
+
+    Short-lived jobs can read the snapshot in one step instead of parsing
+    the main config file and a study config file each time a
+    :obj:`config` is made. Every study listed in 'Projects' is loaded, and
+    its sites and tags are checked. Studies that fail validation are left
+    out of the snapshot (and will be parsed from their YAML files instead).
+
+    Args:
+        filename (:obj:`str`, optional): The main config file. Defaults to
+            the DM_CONFIG environment variable.
+        system (:obj:`str`, optional): The system to validate. Defaults to the
+            DM_SYSTEM environment variable.
+
+    Raises:
+        ConfigException: If the main config file can't be read.
+
+    Returns:
+        tuple: The path of the snapshot file and a dictionary of study names
+            mapped to the reason they failed validation.
+    """
+    cfg = config(filename=filename, system=system, use_snapshot=False)
+    files = {}
+
+    def add_file(path):
+        path = os.path.abspath(path)
+        files[path] = (os.path.getmtime(path), parse_yaml(path))
+
+    add_file(cfg.system_config_path)
+
+    errors = {}
+    study_files = cfg._get_study_files()
+    for study, path in study_files.items():
+        try:
+            _validate_study(cfg, study)
+        except Exception as e:
+            errors[study] = f"{type(e).__name__}: {e}"
+            continue
+        add_file(path)
+
+    cfg._get_project_index()
+    mtimes = _get_mtimes(study_files.values())
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "files": files,
+        "project_index": cfg._dump_project_index(mtimes),
+    }
+
+    snapshot_path = get_snapshot_path(cfg.system_config_path)
+    temp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as fh:
+        pickle.dump(snapshot, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    # Replace in one step so running jobs never see a partial snapshot
+    os.replace(temp_path, snapshot_path)
+    return snapshot_path, errors
+
+
 class TagInfo(object):
     def __init__(self, export_settings, site_settings=None):
+        self._series_map = None
+        self._matcher = None
+        self._original = None
         if not site_settings:
             self.tags = export_settings
             return
@@ -515,7 +926,34 @@ class TagInfo(object):
         """
         Maps the 'pattern' fields onto the expected tags. If multiple patterns
         exist, they're joined with '|'.
+
+        The map is only built on first access.
         """
+        if self._series_map is None:
+            self._series_map = self._make_series_map()
+        return self._series_map
+
+    @property
+    def matcher(self):
+        """A TagMatcher for the series map, compiled on first access."""
+        if self._matcher is None:
+            if self._original is not None:
+                self._matcher = self._original.matcher
+            else:
+                self._matcher = TagMatcher(self.series_map)
+        return self._matcher
+
+    def copy(self):
+        """
+        Returns a copy whose settings can be changed without affecting this
+        instance. The copy uses this instance's TagMatcher, so it's only
+        compiled once.
+        """
+        tags = TagInfo(copy.deepcopy(self.tags))
+        tags._original = self._original or self
+        return tags
+
+    def _make_series_map(self):
         series_map = {}
         for tag in self:
             try:
@@ -553,3 +991,79 @@ class TagInfo(object):
 
     def __repr__(self):
         return str(self.tags)
+
+
+class TagMatcher(object):
+    """
+    Assigns tags to scans based on their series description and image type.
+
+    Every tag's patterns are compiled once, when the matcher is made, and
+    kept in the order the tags were defined in so that matching a scan always
+    gives the same result. Matches are also remembered for each series
+    description, since most scans in a study share a handful of descriptions.
+
+    Args:
+        series_map (dict): Tags mapped to their 'Pattern' settings (as given
+            by TagInfo.series_map).
+
+    Raises:
+        ConfigException: If a tag's patterns aren't valid regular expressions.
+    """
+
+    def __init__(self, series_map):
+        self.series_map = series_map
+        self._patterns = []
+        for tag, settings in series_map.items():
+            self._patterns.append((
+                tag,
+                settings,
+                self._compile(tag, settings["SeriesDescription"],
+                              re.IGNORECASE),
+                self._compile(tag, settings.get("ImageType"))
+            ))
+        self._found = {}
+
+    def _compile(self, tag, pattern, flags=0):
+        if isinstance(pattern, list):
+            pattern = "|".join(pattern)
+        if not isinstance(pattern, str):
+            return None
+        try:
+            return re.compile(pattern, flags)
+        except re.error as e:
+            raise ConfigException(f"Invalid pattern for tag {tag}. Reason - "
+                                  f"{e}")
+
+    def match(self, description):
+        """
+        Returns a dictionary of every tag whose SeriesDescription pattern
+        matches the description, mapped to its settings.
+        """
+        try:
+            found = self._found[description]
+        except KeyError:
+            found = [(tag, settings)
+                     for tag, settings, regex, _ in self._patterns
+                     if regex.search(description)]
+            self._found[description] = found
+        return dict(found)
+
+    def filter_image_type(self, matches, image_type):
+        """
+        Returns the tags from 'matches' whose ImageType pattern matches.
+
+        Raises:
+            KeyError: If one of the tags doesn't define an ImageType.
+        """
+        filtered = {}
+        for tag, _, _, regex in self._patterns:
+            if tag not in matches:
+                continue
+            if regex is None:
+                raise KeyError(f"Tag {tag} does not define ImageType")
+            if regex.search(image_type):
+                filtered[tag] = matches[tag]
+        return filtered
+
+    def __repr__(self):
+        return f"<datman.config.TagMatcher {list(self.series_map)}>"
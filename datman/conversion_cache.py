@@ -0,0 +1,208 @@
+"""
+A local cache of converted DICOM series.
+
+Renaming or re-tagging a session, or correcting a subject ID, means every
+series has to be exported again under its new name. The DICOMs haven't
+changed though, so running dcm2niix (or dcm2mnc, etc.) on them again just
+reproduces the same files. The cache stores each converter's raw output
+under a key made from:
+
+    * the series' SeriesInstanceUID,
+    * a hash of the SOPInstanceUIDs of all of its DICOM files, so a series
+      that gained or lost images is converted again,
+    * the conversion command (without its input and output paths), and the
+      path, size and modification time of the converter itself, so
+      different options or an upgraded converter never reuse old outputs.
+
+Outputs are copied out of the cache with hard links when the cache and the
+destination are on the same file system, and copied otherwise.
+
+.. note::
+    A hard linked output shares its contents with the cache entry, so an
+    exported file that is edited in place (rather than replaced) changes the
+    cached copy too. Put the cache on a different file system from the
+    study data if exported files are ever edited in place.
+
+.. code-block:: python
+
+    cache = ConversionCache('/scratch/datman/conversions')
+    key = cache.make_key(series_dir, 'dcm2niix -z y -b y -o {out} {src}')
+    if not cache.materialise(key, tmp_dir):
+        ...convert...
+        cache.put(key, tmp_dir)
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+import pydicom as dicom
+
+logger = logging.getLogger(__name__)
+
+# Where a converter's messages are stored in each cache entry.
+LOG_FILE = ".conversion.log"
+
+
+class ConversionCache(object):
+    """
+    Converted series outputs, stored by content.
+
+    Args:
+        root (:obj:`str`): The folder to store the cache in. It will be
+            created if it doesnt exist.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def make_key(self, series_dir, command):
+        """
+        Get the cache key for converting a series.
+
+        Args:
+            series_dir (:obj:`str`): The folder holding the series' DICOMs.
+            command (:obj:`str`): The conversion command, with placeholders
+                (or nothing at all) in place of any paths that change from
+                one conversion to the next. The first word must be the
+                converter.
+
+        Returns:
+            str: The key, or None if the series has no readable DICOMs.
+        """
+        series_uid, instance_uids = read_uids(series_dir)
+        if not series_uid:
+            return None
+        digest = hashlib.sha256()
+        for part in [series_uid, "\n".join(instance_uids), command,
+                     _describe_converter(command)]:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """Returns the folder of the cached outputs for a key, if any."""
+        if not key:
+            return None
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return entry
+        return None
+
+    def materialise(self, key, dest_dir):
+        """
+        Copy or link the cached outputs for a key into a folder.
+
+        Args:
+            key (:obj:`str`): A key from make_key().
+            dest_dir (:obj:`str`): The folder to add the outputs to.
+
+        Returns:
+            tuple: The converter's messages and a list of the paths created,
+            or None if nothing is cached for the key.
+        """
+        entry = self.get(key)
+        if not entry:
+            return None
+
+        created = []
+        messages = b""
+        for name in sorted(os.listdir(entry)):
+            source = os.path.join(entry, name)
+            if name == LOG_FILE:
+                with open(source, "rb") as fh:
+                    messages = fh.read()
+                continue
+            dest = os.path.join(dest_dir, name)
+            _link_or_copy(source, dest)
+            created.append(dest)
+        logger.debug(f"Used cached conversion {key} for {dest_dir}")
+        return messages, created
+
+    def put(self, key, source_dir, messages=None):
+        """
+        Add a converter's outputs to the cache.
+
+        The entry is assembled in a temporary folder and moved into place in
+        one step, so other processes never see a partial entry.
+
+        Args:
+            key (:obj:`str`): A key from make_key().
+            source_dir (:obj:`str`): The folder the converter wrote to. Only
+                files directly inside it are stored.
+            messages (bytes, optional): The converter's messages, to give
+                back when the entry is used. Defaults to None.
+        """
+        if not key or self.get(key):
+            return
+        entry = self._entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=".tmp_", dir=os.path.dirname(entry))
+        try:
+            for name in os.listdir(source_dir):
+                source = os.path.join(source_dir, name)
+                if not os.path.isfile(source):
+                    continue
+                _link_or_copy(source, os.path.join(staging, name))
+            if messages:
+                with open(os.path.join(staging, LOG_FILE), "wb") as fh:
+                    fh.write(messages)
+            os.rename(staging, entry)
+        except OSError as e:
+            # Another process may have added the same entry first
+            logger.debug(f"Couldn't add conversion {key} to cache. Reason - "
+                         f"{e}")
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def __repr__(self):
+        return f"<datman.conversion_cache.ConversionCache {self.root}>"
+
+
+def read_uids(series_dir):
+    """
+    Returns the SeriesInstanceUID of the DICOMs in a folder and a sorted
+    list of their SOPInstanceUIDs. The series UID is None if there are no
+    readable DICOMs.
+    """
+    series_uid = None
+    instance_uids = []
+    for name in sorted(os.listdir(series_dir)):
+        path = os.path.join(series_dir, name)
+        if not os.path.isfile(path):
+            continue
+        try:
+            header = dicom.dcmread(
+                path, stop_before_pixels=True,
+                specific_tags=["SeriesInstanceUID", "SOPInstanceUID"]
+            )
+        except Exception:
+            continue
+        uid = str(header.get("SOPInstanceUID", ""))
+        if not uid:
+            continue
+        series_uid = series_uid or str(header.get("SeriesInstanceUID", ""))
+        instance_uids.append(uid)
+    return series_uid or None, sorted(instance_uids)
+
+
+def _describe_converter(command):
+    """Identifies the installed version of a command's converter."""
+    converter = command.split()[0]
+    path = shutil.which(converter) or converter
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path
+    return f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _link_or_copy(source, dest):
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
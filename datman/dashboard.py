@@ -1,5 +1,31 @@
+"""
+Functions for reading and updating the QC dashboard's database.
+
+The dashboard package is only imported, and the database connection only
+made, the first time a function here needs it (or when connect() is called).
+Scripts that import this module but never touch the database don't pay for
+either. 'dash_found' reports whether the dashboard is installed.
+
+The connection pool can be sized with the environment variables listed in
+POOL_SETTINGS, or by calling connect() with the same options before any
+other function. Several calls can be grouped with session(), which commits
+any pending changes and releases the connection back to the pool when it
+exits.
+
+Long running scripts can call enable_write_behind() so that the updates
+they make with queue_write() happen on a background thread instead of
+holding up data processing. See WriteQueue for details.
+"""
+import atexit
+import collections
+import contextlib
+import fcntl
+import importlib.util
+import inspect
+import json
 import logging
 import os
+import threading
 from datetime import datetime
 from functools import wraps
 
@@ -8,19 +34,148 @@ from datman.exceptions import DashboardException
 
 logger = logging.getLogger(__name__)
 
-try:
-    from dashboard import queries, monitors, connect_db
-except ImportError:
-    dash_found = False
+# Connection pool options mapped to the environment variables that set them.
+# Unset options use the dashboard's defaults.
+POOL_SETTINGS = {
+    "pool_size": "DM_DASH_POOL_SIZE",
+    "max_overflow": "DM_DASH_MAX_OVERFLOW",
+    "pool_timeout": "DM_DASH_POOL_TIMEOUT",
+    "pool_recycle": "DM_DASH_POOL_RECYCLE",
+}
+
+dash_found = importlib.util.find_spec("dashboard") is not None
+if not dash_found:
     logger.error("Dashboard not found, proceeding without it.")
-else:
-    connect_db()
-    dash_found = True
+
+# These are set by connect()
+queries = None
+monitors = None
+_db = None
+_connected = False
+
+_connect_lock = threading.Lock()
+_local = threading.local()
+
+# How many rows to request per query when eager loading records
+EAGER_LOAD_CHUNK = 500
+
+SubjectRecord = collections.namedtuple(
+    "SubjectRecord", ["name", "site", "bids_name", "is_phantom", "sessions"]
+)
+SessionRecord = collections.namedtuple(
+    "SessionRecord", ["name", "num", "date", "signed_off", "reviewer", "scans"]
+)
+ScanRecord = collections.namedtuple(
+    "ScanRecord",
+    ["name", "tag", "series", "description", "bids_name", "blacklisted",
+     "comment"],
+)
+
+# The file write behind updates that failed are saved to, to be retried. It's
+# kept in each study's metadata folder (see get_spool_path())
+SPOOL_FILE = "dashboard_spool.jsonl"
+
+# Set by enable_write_behind()
+_write_queue = None
+
+
+def get_pool_settings():
+    """Returns the connection pool options set in the environment."""
+    settings = {}
+    for option, variable in POOL_SETTINGS.items():
+        value = os.environ.get(variable)
+        if value is None:
+            continue
+        try:
+            settings[option] = int(value)
+        except ValueError:
+            raise DashboardException(
+                f"{variable} must be an integer. Received: {value}"
+            )
+    return settings
+
+
+def connect(**pool_options):
+    """
+    Import the dashboard and connect to its database, if not done already.
+
+    Args:
+        **pool_options: Connection pool options (e.g. pool_size) that
+            override those set by the environment variables in POOL_SETTINGS.
+            They're ignored if already connected.
+    """
+    global queries, monitors, _db, _connected, dash_found
+
+    with _connect_lock:
+        if _connected or not dash_found:
+            return
+
+        try:
+            import dashboard
+        except ImportError as e:
+            dash_found = False
+            logger.error("Dashboard could not be imported, proceeding "
+                         f"without it. Reason - {e}")
+            return
+
+        options = get_pool_settings()
+        options.update(pool_options)
+        if options and not _accepts_options(dashboard.connect_db):
+            logger.warning(
+                "Installed dashboard does not accept connection pool "
+                f"settings. Ignoring {options}"
+            )
+            options = {}
+        dashboard.connect_db(**options)
+
+        queries = dashboard.queries
+        monitors = dashboard.monitors
+        _db = getattr(dashboard, "db", None)
+        _connected = True
+
+
+def _accepts_options(func):
+    params = inspect.signature(func).parameters.values()
+    return any(param.kind == param.VAR_KEYWORD for param in params)
+
+
+@contextlib.contextmanager
+def session():
+    """
+    Group several dashboard calls into a single unit of work.
+
+    When the outermost session() block exits any pending changes are
+    committed (or rolled back, if an exception was raised) and the
+    connection is returned to the pool, so that long running scripts dont
+    hold a connection open while busy with other work.
+    """
+    if not dash_found:
+        yield
+        return
+
+    connect()
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+    outermost = depth == 0 and _db is not None
+    try:
+        yield
+        if outermost:
+            _db.session.commit()
+    except Exception:
+        if outermost:
+            _db.session.rollback()
+        raise
+    finally:
+        _local.depth = depth
+        if outermost:
+            _db.session.remove()
 
 
 def dashboard_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        if not _connected:
+            connect()
         if not dash_found:
             logger.warning(
                 "Dashboard not installed or configured correctly, "
@@ -323,6 +478,172 @@ def add_scan(name, tag=None, series=None, description=None, source_id=None):
     )
 
 
+@dashboard_required
+@scanid_required
+def get_scans_for_session(name):
+    """
+    Returns all scans for a session with one query.
+
+    Args:
+        name (:obj:`str` or :obj:`datman.scanid.Identifier`): A session ID.
+            Session 1 is used if the ID has no session number.
+
+    Returns:
+        dict: Scan names (without description) mapped to their database
+        record. An empty dictionary is returned if the session doesnt exist.
+    """
+    session = get_session(name)
+    if not session:
+        return {}
+    return {scan.name: scan for scan in session.scans}
+
+
+@dashboard_required
+def add_scans(file_names):
+    """
+    Add many scans to the database, visiting each session only once.
+
+    This does the same work as calling get_scan(name, create=True) for each
+    file name, but the session, its existing scans and its study's allowed
+    tags are only looked up once per session instead of once per scan. Scans
+    that already exist are not modified.
+
+    Args:
+        file_names (list): A list of datman style file names (path and
+            extension are optional).
+
+    Returns:
+        dict: Each file name mapped to its scan record. File names that
+        could not be added are logged and left out.
+    """
+    records = {}
+    for ident, scans in _group_by_session(file_names).items():
+        with session():
+            records.update(_add_session_scans(ident, scans))
+    return records
+
+
+def _add_session_scans(ident, scans):
+    try:
+        db_session = get_session(ident, create=True)
+        allowed_tags = _get_allowed_tags(ident)
+    except DashboardException as e:
+        logger.error(f"Failed adding scans for session {ident}. "
+                     f"Reason - {e}")
+        return {}
+
+    records = {}
+    existing = {scan.name: scan for scan in db_session.scans}
+    for file_name, tag, series, description in scans:
+        scan_name = _get_scan_name(ident, tag, series)
+        if scan_name in existing:
+            records[file_name] = existing[scan_name]
+            continue
+
+        if tag not in allowed_tags:
+            logger.error(
+                f"Scan name {scan_name} contains tag not configured for "
+                f"study {ident.study}"
+            )
+            continue
+
+        try:
+            scan = db_session.add_scan(scan_name, series, tag, description)
+        except Exception as e:
+            logger.error(f"Failed adding scan {scan_name}. Reason - {e}")
+            continue
+        existing[scan_name] = scan
+        records[file_name] = scan
+    return records
+
+
+@dashboard_required
+def find_scans(file_names):
+    """
+    Look up the scan records for many files, querying each session's scans
+    only once.
+
+    Args:
+        file_names (list): A list of datman style file names (path and
+            extension are optional).
+
+    Returns:
+        dict: Each file name mapped to its scan record. File names with no
+        record are left out.
+    """
+    records = {}
+    for ident, scans in _group_by_session(file_names).items():
+        existing = get_scans_for_session(ident)
+        for file_name, tag, series, _ in scans:
+            scan_name = _get_scan_name(ident, tag, series)
+            if scan_name in existing:
+                records[file_name] = existing[scan_name]
+    return records
+
+
+@dashboard_required
+def update_sidecars_bulk(side_cars):
+    """
+    Add JSON side car contents to many scan records, querying each session's
+    scans only once.
+
+    Args:
+        side_cars (list): Full paths to datman named JSON side car files.
+
+    Returns:
+        list: The side car files that could not be added.
+    """
+    failed = []
+    with session():
+        records = find_scans(side_cars)
+        for side_car in side_cars:
+            try:
+                scan = records[side_car]
+            except KeyError:
+                logger.error(f"No dashboard record found for {side_car}")
+                failed.append(side_car)
+                continue
+            try:
+                scan.add_json(side_car)
+            except Exception as e:
+                logger.error("Failed to add JSON side car to dashboard "
+                             f"record for {side_car}. Reason - {e}")
+                failed.append(side_car)
+    return failed
+
+
+@dashboard_required
+def add_scan_errors(errors):
+    """
+    Add conversion errors to many scan records, querying each session's
+    scans only once.
+
+    Args:
+        errors (list): Pairs of a datman style file name and the error
+            message to add to its scan.
+
+    Returns:
+        list: The file names whose errors could not be added.
+    """
+    failed = []
+    with session():
+        records = find_scans([file_name for file_name, _ in errors])
+        for file_name, message in errors:
+            try:
+                scan = records[file_name]
+            except KeyError:
+                logger.error(f"No dashboard record found for {file_name}")
+                failed.append(file_name)
+                continue
+            try:
+                scan.add_error(message)
+            except Exception as e:
+                logger.error("Failed to add conversion error to dashboard "
+                             f"record for {file_name}. Reason - {e}")
+                failed.append(file_name)
+    return failed
+
+
 @dashboard_required
 def get_project(name=None, tag=None, site=None):
     """
@@ -351,6 +672,46 @@ def get_project(name=None, tag=None, site=None):
     return studies[0]
 
 
+@dashboard_required
+def get_study_records(study, site=None, phantoms=False, scans=True):
+    """
+    Returns read only records for every subject in a study, with their
+    sessions, scans, sign off and blacklist state.
+
+    Walking the database objects returned by get_project() loads each
+    subject's sessions and each session's scans with a separate query. This
+    loads them all up front with a small, fixed number of queries and copies
+    what's needed into plain named tuples, so the records can be used freely
+    (and after the database session has closed) without touching the
+    database again.
+
+    Args:
+        study (:obj:`str`): A study name (e.g. 'SPINS').
+        site (:obj:`str`, optional): Only return subjects from this site.
+        phantoms (bool, optional): Whether to include phantoms. Defaults to
+            False.
+        scans (bool, optional): Whether to load each session's scans. If
+            False, sessions are returned with no scans, which is much faster
+            when only sessions are needed (e.g. for sign offs). Defaults to
+            True.
+
+    Returns:
+        list: A list of SubjectRecords, sorted by name. Sessions are sorted
+        by session number and scans by name.
+    """
+    db_study = get_project(study)
+    timepoints = [
+        tp for tp in db_study.timepoints
+        if (phantoms or not tp.is_phantom) and
+        (not site or _get_site(tp.name) == site)
+    ]
+    _eager_load(timepoints, scans=scans)
+    return sorted(
+        (_make_subject_record(tp, scans=scans) for tp in timepoints),
+        key=lambda record: record.name
+    )
+
+
 @dashboard_required
 def get_default_user():
     try:
@@ -369,6 +730,362 @@ def get_default_user():
     return user[0]
 
 
+def get_spool_path(config):
+    """Returns the spool file for the study a config is set to."""
+    return os.path.join(config.get_path("meta"), SPOOL_FILE)
+
+
+def enable_write_behind(spool, max_items=100, max_delay=30):
+    """
+    Make queue_write() hand updates to a background thread.
+
+    Any updates saved to the spool file by an earlier run are queued again
+    first. The queue is flushed when the interpreter exits.
+
+    Args:
+        spool (:obj:`str`): The file to save failed updates to, usually the
+            study's (see get_spool_path()).
+        max_items (int, optional): How many queued items trigger a write.
+            Defaults to 100.
+        max_delay (int, optional): The most seconds to wait before writing
+            queued items. Defaults to 30.
+
+    Returns:
+        :obj:`WriteQueue`: The queue, or None if the dashboard isn't
+        installed.
+    """
+    global _write_queue
+    if _write_queue is None and dash_found:
+        _write_queue = WriteQueue(
+            spool=spool, max_items=max_items, max_delay=max_delay
+        )
+        atexit.register(_write_queue.close)
+    return _write_queue
+
+
+def queue_write(operation, items):
+    """
+    Run one of the bulk updates in WRITE_OPERATIONS on a list of items.
+
+    If enable_write_behind() has been called the update is queued and this
+    returns immediately. Otherwise the update is run before returning.
+    """
+    if _write_queue is None:
+        WRITE_OPERATIONS[operation](items)
+        return
+    _write_queue.put(operation, items)
+
+
+class WriteQueue(object):
+    """
+    Applies dashboard updates in batches on a background thread.
+
+    Queued items are written once 'max_items' are waiting or 'max_delay'
+    seconds have passed, whichever comes first. Consecutive items for the
+    same operation are written with one bulk call and operations are always
+    applied in the order they were queued. If a bulk call raises an exception
+    (e.g. the database is unreachable) its items, and every update queued
+    after them, are appended to the spool file, which is written out again
+    the next time a WriteQueue is created.
+    Individual items that are rejected (e.g. a scan with an unknown tag) are
+    only logged, since retrying them would fail again.
+    """
+
+    def __init__(self, spool, max_items=100, max_delay=30):
+        self.spool = spool
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self._pending = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+
+        self._replay_spool()
+
+        self._thread = threading.Thread(
+            target=self._run, name="dashboard-write-queue", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, operation, items):
+        if operation not in WRITE_OPERATIONS:
+            raise DashboardException(
+                f"Unrecognized dashboard operation {operation}"
+            )
+        with self._cond:
+            if self._closed:
+                raise DashboardException(
+                    "Can't queue dashboard update, write queue is closed."
+                )
+            self._pending.append((operation, list(items)))
+            if self._size() >= self.max_items:
+                self._cond.notify()
+
+    def flush(self):
+        """Write everything queued so far before returning."""
+        with self._write_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            self._save(self._write(batch))
+
+    def close(self):
+        """Write any remaining items and stop the background thread."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _size(self):
+        return sum(len(items) for _, items in self._pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and self._size() < self.max_items:
+                    self._cond.wait(self.max_delay)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def _write(self, batch):
+        """
+        Write a batch of queued updates, returning any that still need to be
+        saved. Once one bulk call fails every later update in the batch is
+        returned too, so that they're never applied out of order.
+        """
+        merged = []
+        for operation, items in batch:
+            if merged and merged[-1][0] == operation:
+                merged[-1][1].extend(items)
+            else:
+                merged.append((operation, list(items)))
+
+        for num, (operation, items) in enumerate(merged):
+            try:
+                WRITE_OPERATIONS[operation](items)
+            except Exception as e:
+                logger.error(
+                    f"Failed dashboard update {operation} for {len(items)} "
+                    f"items. Saving it and {len(merged) - num - 1} later "
+                    f"updates to {self.spool} to retry later. Reason - {e}"
+                )
+                return merged[num:]
+        return []
+
+    def _save(self, updates):
+        if not updates:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.spool), exist_ok=True)
+            with open(self.spool, "a") as spool:
+                fcntl.flock(spool, fcntl.LOCK_EX)
+                spool.writelines(_format_spooled(updates))
+        except OSError as e:
+            logger.error(f"Failed to save dashboard updates to {self.spool}, "
+                         f"they will be lost. Reason - {e}")
+
+    def _replay_spool(self):
+        """
+        Retry the updates saved to the spool file by earlier runs.
+
+        The spool stays locked until they've been written, and is only
+        rewritten (with any that failed again) afterwards, so a crash part
+        way through never loses saved updates.
+        """
+        try:
+            spool = open(self.spool, "r+")
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.error(f"Can't read saved dashboard updates from "
+                         f"{self.spool}. Reason - {e}")
+            return
+
+        with spool:
+            fcntl.flock(spool, fcntl.LOCK_EX)
+            batch = []
+            for line in spool:
+                try:
+                    entry = json.loads(line)
+                    batch.append((entry["operation"], entry["items"]))
+                except (ValueError, KeyError):
+                    logger.error(f"Ignoring malformed saved update: {line}")
+            if not batch:
+                return
+
+            logger.info(f"Retrying {len(batch)} saved dashboard updates.")
+            failed = self._write(batch)
+            try:
+                spool.seek(0)
+                spool.truncate()
+                spool.writelines(_format_spooled(failed))
+            except OSError as e:
+                logger.error(f"Failed to update saved dashboard updates in "
+                             f"{self.spool}. Reason - {e}")
+
+    def __repr__(self):
+        return f"<datman.dashboard.WriteQueue {self.spool}>"
+
+
+# The bulk updates that can be queued, by name. Each accepts a list of items
+# that can be saved as JSON.
+WRITE_OPERATIONS = {
+    "add_scans": add_scans,
+    "update_sidecars": update_sidecars_bulk,
+    "add_scan_errors": add_scan_errors,
+}
+
+
+def _format_spooled(updates):
+    """Returns the spool file lines for a list of (operation, items) pairs.
+    """
+    return [
+        json.dumps({"operation": operation, "items": items}) + "\n"
+        for operation, items in updates
+    ]
+
+
+def _eager_load(timepoints, scans=True):
+    """
+    Load the sessions (and scans, if 'scans' is True) of many timepoints,
+    along with any single records they refer to (e.g. QC reviews), in one
+    query per relationship.
+
+    This relies on the dashboard's models being mapped with SQLAlchemy. If
+    that fails for any reason the relationships are left to load lazily,
+    which is slower but gives the same results.
+    """
+    if not timepoints:
+        return
+    try:
+        from sqlalchemy import inspect as sa_inspect
+        from sqlalchemy.orm import object_session, selectinload
+
+        tp_mapper = sa_inspect(type(timepoints[0]))
+        sess_mapper = tp_mapper.relationships["sessions"].mapper
+        scan_mapper = sess_mapper.relationships["scans"].mapper
+
+        sessions = selectinload(tp_mapper.attrs.sessions.class_attribute)
+        options = [sessions]
+        options.extend(
+            sessions.selectinload(attr) for attr in
+            _scalar_relationships(sess_mapper, exclude=tp_mapper)
+        )
+        if scans:
+            scan_loader = sessions.selectinload(
+                sess_mapper.attrs.scans.class_attribute)
+            options.append(scan_loader)
+            options.extend(
+                scan_loader.selectinload(attr) for attr in
+                _scalar_relationships(scan_mapper, exclude=sess_mapper)
+            )
+
+        primary_key = tp_mapper.primary_key[0]
+        db_session = object_session(timepoints[0])
+        ids = [getattr(tp, primary_key.key) for tp in timepoints]
+        for start in range(0, len(ids), EAGER_LOAD_CHUNK):
+            db_session.query(tp_mapper).filter(
+                primary_key.in_(ids[start:start + EAGER_LOAD_CHUNK])
+            ).options(*options).all()
+    except Exception as e:
+        logger.debug(f"Can't eager load dashboard records, they will be "
+                     f"loaded as needed instead. Reason - {e}")
+
+
+def _scalar_relationships(mapper, exclude):
+    """
+    Returns the class attributes of a model's many-to-one and one-to-one
+    relationships, except those pointing back to 'exclude' (its parent).
+    """
+    return [
+        rel.class_attribute for rel in mapper.relationships
+        if not rel.uselist and rel.mapper is not exclude
+    ]
+
+
+def _make_subject_record(timepoint, scans=True):
+    sessions = []
+    for num in sorted(timepoint.sessions):
+        db_session = timepoint.sessions[num]
+        signed_off = bool(db_session.signed_off)
+        scan_records = ()
+        if scans:
+            scan_records = tuple(
+                _make_scan_record(scan) for scan in
+                sorted(db_session.scans, key=lambda scan: scan.name)
+            )
+        sessions.append(SessionRecord(
+            name=f"{timepoint.name}_{int(num):02d}",
+            num=int(num),
+            date=db_session.date,
+            signed_off=signed_off,
+            reviewer=str(db_session.reviewer) if signed_off else None,
+            scans=scan_records,
+        ))
+    return SubjectRecord(
+        name=timepoint.name,
+        site=_get_site(timepoint.name),
+        bids_name=timepoint.bids_name,
+        is_phantom=bool(timepoint.is_phantom),
+        sessions=tuple(sessions),
+    )
+
+
+def _make_scan_record(scan):
+    _, tag, series = scan.name.rsplit("_", 2)
+    blacklisted = bool(scan.blacklisted())
+    return ScanRecord(
+        name=scan.name,
+        tag=tag,
+        series=series,
+        description=scan.description,
+        bids_name=scan.bids_name,
+        blacklisted=blacklisted,
+        comment=scan.get_comment() if blacklisted else None,
+    )
+
+
+def _get_site(subject_id):
+    try:
+        return datman.scanid.parse(subject_id).site
+    except datman.scanid.ParseException:
+        return None
+
+
+def _group_by_session(file_names):
+    """
+    Parse a list of datman file names and group them by session.
+
+    Returns a dictionary of session identifiers mapped to a list of
+    (file_name, tag, series, description) tuples. Invalid names are logged
+    and left out.
+    """
+    sessions = {}
+    for file_name in file_names:
+        try:
+            ident, tag, series, descr = datman.scanid.parse_filename(
+                file_name)
+        except datman.scanid.ParseException:
+            logger.error(f"{file_name} is not a valid datman file name. "
+                         "Ignoring.")
+            continue
+        sessions.setdefault(ident, []).append(
+            (file_name, tag, series, descr))
+    return sessions
+
+
+def _get_allowed_tags(ident):
+    studies = queries.get_study(tag=ident.study, site=ident.site)
+    if len(studies) != 1:
+        raise DashboardException(
+            f"Can't identify study for {ident}. {len(studies)} matches found."
+        )
+    return {st.tag for st in studies[0].study.scantypes}
+
+
 def _get_scan_name(ident, tag, series):
     name = "_".join([str(ident), tag, str(series)])
     return name
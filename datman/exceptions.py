@@ -46,3 +46,9 @@ class ConfigException(Exception):
 
 class UndefinedSetting(Exception):
     pass
+
+
+class StorageException(Exception):
+    """For transfers that can't get the disk space they need."""
+
+    pass
@@ -0,0 +1,20 @@
+"""
+Extracts data from XNAT into a study's data folders.
+
+This is the library behind dm_xnat_extract.py, for programs that need to
+extract sessions without running the script (e.g. a service that extracts
+each session as it arrives).
+
+.. code-block:: python
+
+    config = datman.config.config(study='SPINS')
+    with Extractor(config, tags=['T1']) as extractor:
+        extractor.add_listener(lambda event, **details: print(event, details))
+        extractor.extract(extractor.collect_experiment('SPN01_CMH_0001_01_01'))
+"""
+from .exporters import DEFAULT_EXPORTERS
+from .extractor import EVENTS, Extractor, split_dicom_archive
+from .registry import DEFAULT_FORMATS, ExportFormat
+
+__all__ = ["DEFAULT_EXPORTERS", "DEFAULT_FORMATS", "EVENTS", "ExportFormat",
+           "Extractor", "split_dicom_archive"]
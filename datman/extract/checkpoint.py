@@ -0,0 +1,261 @@
+"""
+Lets an interrupted extraction be resumed without re-extracting everything.
+
+Each series is exported into a hidden staging folder beside its real output
+folder and only renamed into place once the exporter has finished, so a
+half-written file never appears under a real output name. Every run keeps a
+journal of the staging folders it's using, in the study's metadata folder:
+
+    started   -> The export is writing to the staging folder.
+    promoting -> The export finished and its files are being renamed into
+                 place.
+    finished  -> The staging folder is gone.
+
+A run holds a lock on its journal until it exits. When the next run starts,
+any journal that isn't locked belongs to a run that was killed, and
+recover() cleans up after it: staging folders of unfinished exports are
+deleted (so the series is exported again) and finished exports that were
+only partly renamed into place are completed. It also deletes any journals
+left with a temporary name by a run killed while creating its journal.
+"""
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_PREFIX = "extract_checkpoint_"
+STAGING_PREFIX = ".dm_staging_"
+TEMP_SUFFIX = ".tmp"
+
+# The number of seconds before an unlocked journal with a temporary name is
+# assumed to be abandoned. A new journal only has one for a moment.
+STALE_TEMP_AGE = 60
+
+STARTED = "started"
+PROMOTING = "promoting"
+FINISHED = "finished"
+
+
+class CheckpointJournal(object):
+    """
+    A run's record of the exports it's staging.
+
+    Args:
+        folder (:obj:`str`): The folder to keep the journal in.
+
+    Raises:
+        OSError: If the journal can't be created or locked.
+    """
+
+    def __init__(self, folder):
+        self.path = os.path.join(
+            folder, f"{JOURNAL_PREFIX}{platform.node()}_{os.getpid()}_"
+                    f"{uuid.uuid4().hex[:8]}.jsonl")
+        self._lock = threading.Lock()
+        self._pending = set()
+        # The journal is locked before it's given a name recover() looks
+        # for, so another run can never mistake it for an abandoned one
+        temp_path = self.path + TEMP_SUFFIX
+        self._fh = open(temp_path, "a")
+        try:
+            fcntl.flock(self._fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.rename(temp_path, self.path)
+        except OSError:
+            self._fh.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def stage(self, target_dir, name):
+        """
+        Make a staging folder for an export and record that it has started.
+
+        Args:
+            target_dir (:obj:`str`): The folder the outputs belong in.
+            name (:obj:`str`): A name to identify the export by.
+
+        Returns:
+            str: The staging folder.
+        """
+        staging = os.path.join(
+            target_dir, f"{STAGING_PREFIX}{name}_{uuid.uuid4().hex[:8]}")
+        # Journal it first so a folder is never left behind unrecorded
+        self._write(staging, STARTED)
+        os.makedirs(staging)
+        return staging
+
+    def promote(self, staging, target_dir):
+        """
+        Move a finished export's files into place and remove its staging
+        folder.
+
+        Returns:
+            list: The final paths of the files moved.
+        """
+        self._write(staging, PROMOTING)
+        moved = move_staged(staging, target_dir)
+        self.discard(staging)
+        return moved
+
+    def discard(self, staging):
+        """Delete a staging folder and everything left in it."""
+        shutil.rmtree(staging, ignore_errors=True)
+        self._write(staging, FINISHED)
+
+    def _write(self, staging, state):
+        entry = json.dumps({"staging": staging, "state": state})
+        with self._lock:
+            if state == FINISHED:
+                self._pending.discard(staging)
+            else:
+                self._pending.add(staging)
+            self._fh.write(entry + "\n")
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def close(self):
+        """Close the journal, deleting it if no exports are unfinished."""
+        with self._lock:
+            if self._fh.closed:
+                return
+            if not self._pending:
+                os.remove(self.path)
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f"<datman.extract.checkpoint.CheckpointJournal {self.path}>"
+
+
+def move_staged(staging, target_dir):
+    """
+    Rename everything in a staging folder into the target folder. Files that
+    already exist in the target folder are left alone.
+
+    Returns:
+        list: The final paths of the files moved.
+    """
+    moved = []
+    for name in sorted(os.listdir(staging)):
+        dest = os.path.join(target_dir, name)
+        if os.path.exists(dest):
+            logger.error(f"Output file {dest} already exists. Skipping")
+            continue
+        os.replace(os.path.join(staging, name), dest)
+        moved.append(dest)
+    return moved
+
+
+def recover(folder):
+    """
+    Clean up after any runs that were killed before they finished.
+
+    Args:
+        folder (:obj:`str`): The folder holding the journals.
+
+    Returns:
+        int: The number of interrupted exports found.
+    """
+    interrupted = 0
+    pattern = os.path.join(folder, JOURNAL_PREFIX + "*.jsonl")
+    for path in sorted(glob.glob(pattern)):
+        with _lock_abandoned(path) as fh:
+            if not fh:
+                continue
+            states = read_journal(fh)
+            for staging, state in states.items():
+                if state == FINISHED:
+                    continue
+                interrupted += 1
+                _recover_export(staging, state)
+            os.remove(path)
+
+    for path in glob.glob(pattern + TEMP_SUFFIX):
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except OSError:
+            continue
+        if age < STALE_TEMP_AGE:
+            continue
+        with _lock_abandoned(path) as fh:
+            if fh:
+                logger.info(f"Removing abandoned checkpoint journal {path}")
+                os.remove(path)
+    return interrupted
+
+
+@contextlib.contextmanager
+def _lock_abandoned(path):
+    """
+    Yields a journal opened and locked, or None if a running extraction
+    still has it locked or it was removed or renamed before it was locked.
+    """
+    try:
+        fh = open(path, "r+")
+    except FileNotFoundError:
+        yield None
+        return
+    except OSError as e:
+        logger.error(f"Can't read checkpoint journal {path}. Reason - {e}")
+        yield None
+        return
+
+    with fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Still in use by a running extraction
+            yield None
+            return
+        try:
+            unchanged = os.path.samestat(os.stat(path),
+                                         os.fstat(fh.fileno()))
+        except FileNotFoundError:
+            unchanged = False
+        # If its run finished after it was opened, there's nothing to do
+        yield fh if unchanged else None
+
+
+def read_journal(fh):
+    """Returns each staging folder in a journal mapped to its last state."""
+    states = {}
+    for line in fh:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # The run was killed while writing this line
+            continue
+        states[entry["staging"]] = entry["state"]
+    return states
+
+
+def _recover_export(staging, state):
+    if not os.path.isdir(staging):
+        return
+    if state == PROMOTING:
+        target_dir = os.path.dirname(staging)
+        logger.warning(f"Finishing interrupted move of outputs from "
+                       f"{staging} to {target_dir}")
+        try:
+            move_staged(staging, target_dir)
+        except OSError as e:
+            logger.error(f"Failed to move outputs from {staging}. "
+                         f"Reason - {e}")
+    else:
+        logger.warning(f"Removing unfinished export {staging}. It will be "
+                       "exported again.")
+    shutil.rmtree(staging, ignore_errors=True)
@@ -0,0 +1,250 @@
+"""
+Functions that convert a downloaded DICOM series to each export format.
+
+Every exporter is called as:
+
+    exporter(extractor, seriesdir, outputdir, stem, scan)
+
+Where 'extractor' is the :obj:`datman.extract.Extractor` running the export,
+'seriesdir' the folder of DICOMs, 'outputdir' the folder to write to, 'stem'
+the datman name to give the outputs (without an extension) and 'scan' the
+:obj:`datman.xnat.XNATScan` being exported. Exporters may return a list of
+the files they created. An exporter should run any external command through
+extractor.run_conversion (so that its outputs can be cached) or
+datman.utils.run with extractor.dryrun, and make any temporary folders with
+extractor.make_temp_directory (so that disk space is reserved for them).
+
+Exporters of formats with workers (see :mod:`datman.extract.registry`) run
+in their own threads, alongside the exports of other series and formats, so
+they must not change any shared state (e.g. the working directory).
+
+Additional formats can be supported by passing an 'exporters' dictionary to
+the Extractor, mapping each format name (as used in the 'formats' setting of
+a tag) to its exporter, or by installing a plugin.
+"""
+import logging
+import os
+import re
+from glob import glob
+
+import pydicom as dicom
+
+import datman.utils
+from datman.storage import get_folder_size
+
+logger = logging.getLogger(__name__)
+
+# The file name given to converter outputs before they're renamed after
+# their series. Outputs must not depend on the series name to be cached.
+CACHE_STEM = "dm_series"
+
+
+def export_mnc(extractor, seriesdir, outputdir, stem, scan=None):
+    """Converts a DICOM series to MINC format"""
+    outputfile = os.path.join(outputdir, stem) + ".mnc"
+
+    try:
+        check_create_dir(outputdir)
+    except Exception:
+        return
+
+    if os.path.exists(outputfile):
+        logger.warning(f"{seriesdir}: output {outputfile} exists. Skipping")
+        return
+
+    logger.debug(f"Exporting series {seriesdir} to {outputfile}")
+    cmd = 'dcm2mnc -fname {} -dname "" {}/* {}'
+    with extractor.make_temp_directory(get_folder_size(seriesdir)) as tmpdir:
+        extractor.run_conversion(seriesdir, tmpdir,
+                                 cmd.format(CACHE_STEM, seriesdir, tmpdir),
+                                 cmd.format(CACHE_STEM, "{src}", "{out}"))
+        return move_outputs(tmpdir, outputdir, stem, extractor.dryrun)
+
+
+def export_nii(extractor, seriesdir, outputdir, stem, scan=None):
+    """Converts a DICOM series to NifTi format"""
+    try:
+        check_create_dir(outputdir)
+    except Exception:
+        return
+
+    logger.info(f"Exporting series {seriesdir}")
+
+    outputs = []
+    cmd = "dcm2niix -z y -b y -o {} {}"
+    # convert into tmpdir
+    with extractor.make_temp_directory(get_folder_size(seriesdir)) as tmpdir:
+        _, log_msgs = extractor.run_conversion(
+            seriesdir, tmpdir, cmd.format(tmpdir, seriesdir),
+            cmd.format("{out}", "{src}"))
+        # move nii and files (BIDS, dirs, etc) from tmpdir/ to nii/
+        for f in glob(f"{tmpdir}/*"):
+            bn = os.path.basename(f)
+            ext = datman.utils.get_extension(f)
+            # regex is made up of 14 digit timestamp and 1-3 digit series num
+            regex = "files_(.*)_([0-9]{14})_([0-9]{1,3})(.*)?" + ext
+            m = re.search(regex, bn)
+            if not m:
+                logger.error(f"Unable to parse file {bn} using the regex")
+                continue
+
+            if scan and scan.multiecho:
+                try:
+                    echo = int(m.group(4).split("e")[-1][0])
+                    stem = scan.echo_dict[echo]
+                except Exception:
+                    logger.error("Unable to parse valid echo number from file "
+                                 f"{bn}")
+                    return outputs
+
+            outputfile = os.path.join(outputdir, stem) + ext
+            if os.path.exists(outputfile):
+                logger.error(f"Output file {outputfile} already exists. "
+                             "Skipping")
+                continue
+
+            return_code, _ = datman.utils.run(f"mv {f} {outputfile}",
+                                              extractor.dryrun)
+            if return_code:
+                logger.debug(f"Moving dcm2niix output {f} to {outputdir} "
+                             "has failed")
+                continue
+            outputs.append(outputfile)
+            error_log = os.path.join(outputdir, stem) + ".err"
+            extractor.report_issues(error_log, str(log_msgs))
+    return outputs
+
+
+def export_nrrd(extractor, seriesdir, outputdir, stem, scan=None):
+    """Converts a DICOM series to NRRD format"""
+    outputfile = os.path.join(outputdir, stem) + ".nrrd"
+    try:
+        check_create_dir(outputdir)
+    except Exception:
+        return
+    if os.path.exists(outputfile):
+        logger.warning(f"{seriesdir}: output {outputfile} exists. Skipping")
+        return
+
+    logger.debug(f"Exporting series {seriesdir} to {outputfile}")
+
+    nrrd_script = extractor.nrrd_script
+    cmd = "{} {} {} {}"
+    with extractor.make_temp_directory(get_folder_size(seriesdir)) as tmpdir:
+        extractor.run_conversion(
+            seriesdir, tmpdir,
+            cmd.format(nrrd_script, seriesdir, CACHE_STEM, tmpdir),
+            cmd.format(nrrd_script, "{src}", CACHE_STEM, "{out}"))
+        return move_outputs(tmpdir, outputdir, stem, extractor.dryrun)
+
+
+def export_dcm(extractor, seriesdir, outputdir, stem, scan=None):
+    """Copies a DICOM for each echo number in a scan series."""
+    try:
+        check_create_dir(outputdir)
+    except Exception:
+        return
+
+    logger.info(f"Exporting series {seriesdir}")
+
+    dcmfile = None
+    if scan and scan.multiecho:
+        dcm_dict = {}
+        for path in glob(seriesdir + "/*"):
+            try:
+                dcm_echo_num = dicom.read_file(path).EchoNumbers
+                if dcm_echo_num not in dcm_dict.keys():
+                    dcm_dict[int(dcm_echo_num)] = path
+                if len(dcm_dict.keys()) == 2:
+                    break
+            except dicom.filereader.InvalidDicomError:
+                pass
+
+    else:
+        for path in glob(seriesdir + "/*"):
+            try:
+                dicom.read_file(path)
+                dcmfile = path
+                break
+            except dicom.filereader.InvalidDicomError:
+                pass
+
+    outputs = []
+    if scan and scan.multiecho:
+        for echo_num, dcm_echo_num in zip(scan.echo_dict.keys(),
+                                          dcm_dict.keys()):
+            outputfile = os.path.join(outputdir,
+                                      scan.echo_dict[echo_num] + ".dcm")
+            if os.path.exists(outputfile):
+                logger.error(f"Output file {outputfile} already exists. "
+                             "Skipping")
+                continue
+            logger.debug(f"Exporting a dcm file from {seriesdir} to "
+                         f"{outputfile}")
+            cmd = f"cp {dcm_dict[dcm_echo_num]} {outputfile}"
+            datman.utils.run(cmd, extractor.dryrun)
+            outputs.append(outputfile)
+
+    elif dcmfile:
+        outputfile = os.path.join(outputdir, stem) + ".dcm"
+        if os.path.exists(outputfile):
+            logger.error(f"Output file {outputfile} already exists. Skipping")
+            return
+        logger.debug(f"Exporting a dcm file from {seriesdir} to {outputfile}")
+        cmd = f"cp {dcmfile} {outputfile}"
+        datman.utils.run(cmd, extractor.dryrun)
+        outputs.append(outputfile)
+
+    else:
+        logger.error(f"No dicom files found in {seriesdir}")
+        return
+    return outputs
+
+
+DEFAULT_EXPORTERS = {
+    "mnc": export_mnc,
+    "nii": export_nii,
+    "nrrd": export_nrrd,
+    "dcm": export_dcm,
+}
+
+
+def move_outputs(tmpdir, outputdir, stem, dryrun=False):
+    """Moves converter outputs named after CACHE_STEM to their real names.
+
+    Returns:
+        list: The paths of the moved files.
+    """
+    outputs = []
+    for name in os.listdir(tmpdir):
+        if not name.startswith(CACHE_STEM):
+            continue
+        outputfile = os.path.join(outputdir, stem + name[len(CACHE_STEM):])
+        if os.path.exists(outputfile):
+            logger.error(f"Output file {outputfile} already exists. Skipping")
+            continue
+        datman.utils.run(f"mv {os.path.join(tmpdir, name)} {outputfile}",
+                         dryrun)
+        outputs.append(outputfile)
+    return outputs
+
+
+def check_create_dir(target):
+    """Checks to see if a directory exists, creates if not"""
+    if not os.path.isdir(target):
+        logger.info(f"Creating dir: {target}")
+        try:
+            os.makedirs(target, exist_ok=True)
+        except OSError as e:
+            logger.error(f"Failed creating dir: {target}")
+            raise e
+
+
+def is_valid_dicom(filename):
+    try:
+        dicom.read_file(filename)
+    except IOError:
+        return
+    except dicom.errors.InvalidDicomError:
+        return
+    return True
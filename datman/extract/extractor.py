@@ -0,0 +1,1330 @@
+"""
+Extracts sessions from XNAT into a study's data folders.
+"""
+import concurrent.futures
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import zipfile
+from datetime import datetime
+from glob import glob
+
+import datman.conversion_cache
+import datman.dashboard as dashboard
+import datman.extract.checkpoint as checkpoint
+import datman.manifest
+import datman.scanid
+import datman.storage
+import datman.utils
+import datman.xnat
+from datman.exceptions import StorageException, UndefinedSetting
+from datman.extract.exporters import is_valid_dicom
+from datman.extract.registry import ExportPool, get_formats
+
+logger = logging.getLogger(__name__)
+
+# The events an Extractor reports to its listeners, and the details given
+# with each.
+EVENTS = {
+    # experiment (:obj:`datman.scanid.Identifier`)
+    "experiment_started",
+    # experiment, error (:obj:`str` or None if the experiment was processed)
+    "experiment_finished",
+    # experiment, series (:obj:`str`, the datman name), formats (list)
+    "series_exported",
+    # experiment, series, format, error (:obj:`str`)
+    "export_failed",
+    # experiment, path (:obj:`str`)
+    "resource_downloaded",
+}
+
+# The ways experiments can be prioritized, most important first by default:
+#   requested - Experiments the caller asked for by name.
+#   missing - Sessions with nothing exported yet, according to the manifest.
+#   newest - The most recently uploaded experiments (by XNAT insert_date).
+DEFAULT_PRIORITY = ["requested", "missing", "newest"]
+
+# The number of XNAT project listings to request at once
+LISTING_WORKERS = 4
+
+FIRST_COMPLETED = concurrent.futures.FIRST_COMPLETED
+
+
+class Extractor(object):
+    """
+    Downloads and exports a study's XNAT experiments.
+
+    All settings are given when the extractor is made, so several extractors
+    (e.g. for different studies) can be used in one process. A single
+    extractor may also be used by several threads at once, as long as no two
+    threads process the same experiment at the same time.
+
+    Args:
+        config (:obj:`datman.config.config`): A config for the study to
+            extract. Its study must already be set.
+        server (:obj:`str`, optional): An XNAT server to use instead of the
+            ones in the study's config. Defaults to None.
+        auth (tuple, optional): A username and password for XNAT. Defaults to
+            the credentials found by datman.xnat.get_connection.
+        tags (list, optional): Only export scans with these tags. Defaults to
+            all tags.
+        dryrun (bool, optional): Report what would be done without changing
+            anything. Implies update_dashboard=False. Defaults to False.
+        update_dashboard (bool, optional): Whether to add sessions and scans
+            to the dashboard. Defaults to True.
+        use_manifest (bool, optional): Whether to check and update the
+            study's processed series manifest. Defaults to True.
+        manifest_wal (bool, optional): Whether the manifest uses SQLite's
+            write-ahead log. This must be turned off when processes on other
+            machines use the manifest too. Defaults to True.
+        conversion_cache (:obj:`str`, optional): The folder of a conversion
+            cache to use. Defaults to the CONVERSION_CACHE setting, if any.
+        exporters (dict, optional): Export format names mapped to their
+            exporter function or :obj:`datman.extract.ExportFormat`. If
+            given, these are the only formats available. Defaults to the
+            formats in :mod:`datman.extract.registry` and any installed
+            plugins.
+        nrrd_script (:obj:`str`, optional): The script that converts DICOMs
+            to NRRD. Defaults to 'dcm_to_nrrd.sh' on the PATH.
+        bulk_download (bool, optional): Whether to download all of an
+            experiment's scans that need exporting in a single request,
+            instead of one request per scan. Defaults to False.
+        storage (:obj:`datman.storage.StorageBudget`, optional): The budget
+            that downloads and temporary folders reserve disk space from.
+            Defaults to a budget made from the study's settings.
+        checkpoint (bool, optional): Whether to export each series into a
+            staging folder and journal its progress, so that exports
+            interrupted by a killed run are cleaned up and redone by the
+            next one (see :mod:`datman.extract.checkpoint`). Defaults to
+            True.
+        priority (list, optional): The order iter_experiments() yields
+            experiments in, as a list of the criteria in DEFAULT_PRIORITY,
+            most important first. Defaults to the EXTRACT_PRIORITY setting,
+            or DEFAULT_PRIORITY if it isn't set.
+    """
+
+    def __init__(self, config, server=None, auth=None, tags=None,
+                 dryrun=False, update_dashboard=True, use_manifest=True,
+                 manifest_wal=True, conversion_cache=None, exporters=None,
+                 nrrd_script=None, bulk_download=False, storage=None,
+                 checkpoint=True, priority=None):
+        self.config = config
+        self.study = config.study_name
+        self.server = server
+        self.auth = auth
+        self.tags = tags
+        self.dryrun = dryrun
+        self.update_dashboard = update_dashboard and not dryrun
+        self.use_manifest = use_manifest
+        self.manifest_wal = manifest_wal
+        self.formats = get_formats(exporters, config)
+        self.exporters = {name: fmt.exporter
+                          for name, fmt in self.formats.items()}
+        self.nrrd_script = (nrrd_script or shutil.which("dcm_to_nrrd.sh") or
+                            "dcm_to_nrrd.sh")
+        self.conversion_cache = self._open_conversion_cache(conversion_cache)
+        self.bulk_download = bulk_download
+        self.storage = (storage or
+                        datman.storage.StorageBudget.for_config(config))
+        self.checkpoint = checkpoint and not dryrun
+        self.priority = self._get_priority_order(priority)
+
+        self._servers = {}
+        self._listeners = []
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._manifests = []
+        self._journal = None
+        self._pool = None
+
+    def _get_priority_order(self, priority):
+        if priority is None:
+            try:
+                priority = self.config.get_key("EXTRACT_PRIORITY")
+            except UndefinedSetting:
+                priority = DEFAULT_PRIORITY
+        if isinstance(priority, str):
+            priority = [item.strip() for item in priority.split(",")
+                        if item.strip()]
+        unknown = [item for item in priority if item not in DEFAULT_PRIORITY]
+        if unknown:
+            raise ValueError(f"Unknown experiment priority {unknown}. Must be "
+                             f"one of {DEFAULT_PRIORITY}")
+        return list(priority)
+
+    def _open_conversion_cache(self, cache_dir):
+        if not cache_dir:
+            try:
+                cache_dir = self.config.get_key("CONVERSION_CACHE")
+            except UndefinedSetting:
+                return None
+        try:
+            return datman.conversion_cache.ConversionCache(cache_dir)
+        except OSError as e:
+            logger.warning(f"Can't use conversion cache {cache_dir}, all "
+                           f"series will be converted. Reason - {e}")
+            return None
+
+    @property
+    def manifest(self):
+        """This thread's connection to the study's manifest (or None)."""
+        if not self.use_manifest:
+            return None
+        try:
+            return self._local.manifest
+        except AttributeError:
+            pass
+        try:
+            manifest = datman.manifest.ProcessedManifest.for_study(
+                self.config, wal=self.manifest_wal)
+        except Exception as e:
+            logger.warning("Can't open processed series manifest for "
+                           f"{self.study}, searching output folders instead. "
+                           f"Reason - {e}")
+            manifest = None
+        self._local.manifest = manifest
+        if manifest:
+            with self._lock:
+                self._manifests.append(manifest)
+        return manifest
+
+    @property
+    def journal(self):
+        """The run's checkpoint journal (or None).
+
+        The first time it's used, any exports interrupted by earlier runs are
+        cleaned up.
+        """
+        if not self.checkpoint:
+            return None
+        with self._lock:
+            if self._journal is None:
+                self._journal = self._open_journal()
+            return self._journal or None
+
+    def _open_journal(self):
+        try:
+            folder = self.config.get_path("meta")
+            interrupted = checkpoint.recover(folder)
+            journal = checkpoint.CheckpointJournal(folder)
+        except Exception as e:
+            logger.warning(f"Can't keep a checkpoint journal for "
+                           f"{self.study}, interrupted exports wont be "
+                           f"detected. Reason - {e}")
+            return False
+        if interrupted:
+            logger.warning(f"Cleaned up {interrupted} exports interrupted by "
+                           "an earlier run")
+        return journal
+
+    @property
+    def pool(self):
+        """The pool that runs exports with each format's limits."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ExportPool(self.formats)
+            return self._pool
+
+    def close(self):
+        """Wait for running exports, then close the extractor's connections
+        to the manifest and its checkpoint journal."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown()
+        with self._lock:
+            if self._journal:
+                self._journal.close()
+            self._journal = None
+            for manifest in self._manifests:
+                try:
+                    manifest.close()
+                except Exception:
+                    # Connections can only be closed by the thread that made
+                    # them, any others are closed when the thread exits
+                    pass
+            self._manifests = []
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def add_listener(self, callback):
+        """
+        Call a function whenever an event happens.
+
+        The callback is called as callback(event, **details), where event is
+        one of EVENTS. Callbacks are run in the thread that caused the event
+        and any exceptions they raise are logged and ignored.
+        """
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            self._listeners.remove(callback)
+
+    def _notify(self, event, **details):
+        with self._lock:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            try:
+                callback(event, **details)
+            except Exception as e:
+                logger.error(f"Listener {callback} failed for event {event}. "
+                             f"Reason - {e}")
+
+    def get_connection(self, site):
+        """Returns a connection to the XNAT server for a site."""
+        with self._lock:
+            return datman.xnat.get_connection(self.config,
+                                              site=site,
+                                              url=self.server,
+                                              auth=self.auth,
+                                              server_cache=self._servers)
+
+    def collect_experiment(self, experiment_id):
+        """
+        Find a single experiment on XNAT.
+
+        Returns:
+            list: A list holding the XNAT connection, project name and
+            Identifier for the experiment, or an empty list if it can't be
+            found.
+        """
+        ident = datman.utils.validate_subject_id(experiment_id, self.config)
+
+        try:
+            convention = self.config.get_key("XNAT_CONVENTION",
+                                             site=ident.site)
+        except UndefinedSetting:
+            convention = "DATMAN"
+
+        if convention == "KCNI":
+            try:
+                settings = self.config.get_key("ID_MAP")
+            except UndefinedSetting:
+                settings = None
+            ident = datman.scanid.get_kcni_identifier(ident, settings)
+
+        xnat = self.get_connection(ident.site)
+
+        # get the list of XNAT projects linked to the datman study
+        xnat_projects = self.config.get_xnat_projects(self.study)
+
+        # identify which xnat project the subject is in
+        xnat_project = xnat.find_project(ident.get_xnat_subject_id(),
+                                         xnat_projects)
+        if not xnat_project:
+            logger.error(f"Failed to find experiment {experiment_id}. Ensure "
+                         "it matches an existing experiment ID in XNAT.")
+            return []
+
+        return [(xnat, xnat_project, ident)]
+
+    def collect_all_experiments(self, requested=None):
+        """
+        Find all of the study's experiments on XNAT.
+
+        Args:
+            requested (list, optional): Experiment IDs to put first, if the
+                'requested' priority is used.
+
+        Returns:
+            list: A list of tuples holding the XNAT connection, project name
+            and Identifier of each experiment, in order of priority.
+        """
+        return list(self.iter_experiments(requested))
+
+    def iter_experiments(self, requested=None):
+        """
+        Find the study's experiments on XNAT, yielding them as they're found.
+
+        The listings of all the study's XNAT projects are requested at once
+        and experiments are yielded as soon as the first one arrives. The
+        experiments found so far are always yielded in order of priority, so
+        an important experiment from a listing that arrives late still goes
+        ahead of any that haven't been yielded yet.
+
+        Args:
+            requested (list, optional): Experiment IDs to put first, if the
+                'requested' priority is used.
+
+        Yields:
+            tuple: The XNAT connection, project name and Identifier of each
+            experiment.
+        """
+        requested = set(requested or [])
+        exported = None
+        if "missing" in self.priority:
+            exported = self._get_exported_sessions()
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=LISTING_WORKERS)
+        pending = {}
+        for xnat, project in self._get_listings():
+            future = executor.submit(xnat.get_experiment_listing, project)
+            pending[future] = (xnat, project)
+
+        found = []
+        order = itertools.count()
+        try:
+            while pending or found:
+                arrived = [future for future in pending if future.done()]
+                if not arrived and not found:
+                    arrived, _ = concurrent.futures.wait(
+                        pending, return_when=FIRST_COMPLETED)
+                for future in arrived:
+                    xnat, project = pending.pop(future)
+                    for item in self._read_listing(future, project):
+                        ident = self._parse_experiment(item.get("label"),
+                                                       project)
+                        if not ident:
+                            continue
+                        key = self._get_priority(ident, item, requested,
+                                                 exported)
+                        heapq.heappush(found, (key, next(order),
+                                               (xnat, project, ident)))
+                if found:
+                    yield heapq.heappop(found)[-1]
+        finally:
+            executor.shutdown(wait=False)
+
+    def _get_listings(self):
+        """Returns the XNAT connection and project of each listing to get.
+        """
+        listings = []
+        for project, sites in self.get_projects().items():
+            for site in sites:
+                xnat = self.get_connection(site)
+                # Sites that share a project and server share a listing
+                if (xnat.server, project) in [
+                        (conn.server, proj) for conn, proj in listings]:
+                    continue
+                listings.append((xnat, project))
+        return listings
+
+    def _read_listing(self, future, project):
+        try:
+            return future.result()
+        except Exception as e:
+            logger.error(f"Failed to get experiments for XNAT project "
+                         f"{project}. Reason - {e}")
+            return []
+
+    def _parse_experiment(self, exper_id, project):
+        """Returns an Identifier for an experiment ID, or None if it's not
+        valid."""
+        try:
+            ident = datman.utils.validate_subject_id(exper_id, self.config)
+        except datman.scanid.ParseException:
+            logger.error(f"Invalid experiment ID {exper_id} in "
+                         f"project {project}.")
+            return None
+        if ident.session is None and not datman.scanid.is_phantom(ident):
+            logger.error(f"Invalid experiment ID {exper_id} in "
+                         f"project {project}. Reason - Not a "
+                         "phantom, but missing session number")
+            return None
+        return ident
+
+    def _get_exported_sessions(self):
+        """Returns the names of sessions with exported series, or None if
+        they can't be found."""
+        manifest = self.manifest
+        if not manifest:
+            logger.debug("No manifest, experiments with nothing exported "
+                         "wont be prioritized.")
+            return None
+        try:
+            return manifest.sessions()
+        except Exception as e:
+            logger.warning(f"Can't find exported sessions in manifest. "
+                           f"Reason - {e}")
+            return None
+
+    def _get_priority(self, ident, item, requested, exported):
+        """Returns a sort key that puts the most important experiments
+        first."""
+        key = []
+        for criterion in self.priority:
+            if criterion == "requested":
+                key.append(0 if (item.get("label") in requested or
+                                 str(ident) in requested) else 1)
+            elif criterion == "missing":
+                key.append(1 if exported and str(ident) in exported else 0)
+            elif criterion == "newest":
+                key.append(-get_timestamp(item.get("insert_date")))
+        return tuple(key)
+
+    def get_projects(self):
+        """Find all XNAT projects and the list of scan sites uploaded to each
+        one.
+
+        Returns:
+            dict: A map of XNAT project names to the sites uploaded to it.
+        """
+        projects = {}
+        for site in self.config.get_sites():
+            xnat_project = self.config.get_key("XNAT_Archive", site=site)
+            projects.setdefault(xnat_project, set()).add(site)
+        return projects
+
+    def extract(self, experiments):
+        """Process each (connection, project, Identifier) tuple in turn."""
+        for xnat, project, ident in experiments:
+            self.process_experiment(xnat, project, ident)
+
+    def process_experiment(self, xnat, project, ident):
+        """
+        Download and export a single experiment.
+
+        Returns:
+            bool: True if the experiment was found and processed. Individual
+            scans may still have failed.
+        """
+        self._notify("experiment_started", experiment=ident)
+        try:
+            error = self._process_experiment(xnat, project, ident)
+        except Exception as e:
+            self._notify("experiment_finished", experiment=ident,
+                         error=str(e))
+            raise
+        self._notify("experiment_finished", experiment=ident, error=error)
+        return error is None
+
+    def _process_experiment(self, xnat, project, ident):
+        experiment_label = ident.get_xnat_experiment_id()
+
+        logger.info(f"Processing experiment: {experiment_label}")
+
+        try:
+            xnat_experiment = xnat.get_experiment(
+                project, ident.get_xnat_subject_id(), experiment_label)
+        except Exception as e:
+            error = (f"Unable to retrieve experiment {experiment_label} from "
+                     f"XNAT server. {type(e).__name__}: {e}")
+            logger.error(error)
+            return error
+
+        if self.update_dashboard:
+            self._update_session(ident, xnat_experiment)
+
+        if xnat_experiment.resource_files:
+            self.process_resources(xnat, ident, xnat_experiment)
+        if xnat_experiment.scans:
+            self.process_scans(xnat, ident, xnat_experiment)
+        return None
+
+    def _update_session(self, ident, xnat_experiment):
+        experiment_label = ident.get_xnat_experiment_id()
+        logger.debug(f"Adding session {experiment_label} to dashboard")
+        try:
+            db_session = dashboard.get_session(ident, create=True)
+        except dashboard.DashboardException as e:
+            logger.error(f"Failed adding session {experiment_label}. "
+                         f"Reason: {e}")
+            return
+        set_alt_ids(db_session, ident)
+        set_date(db_session, xnat_experiment)
+
+    def process_resources(self, xnat, ident, xnat_experiment):
+        """Export any non-dicom resources from the XNAT archive"""
+        logger.info(f"Extracting {len(xnat_experiment.resource_files)} "
+                    f"resources from {xnat_experiment.name}")
+
+        base_path = os.path.join(self.config.get_path("resources"),
+                                 str(ident))
+
+        if not os.path.isdir(base_path):
+            logger.info(f"Creating resources dir {base_path}")
+            try:
+                os.makedirs(base_path, exist_ok=True)
+            except OSError:
+                logger.error(f"Failed creating resources dir {base_path}")
+                return
+
+        for label in xnat_experiment.resource_IDs:
+            if label == "No Label":
+                target_path = os.path.join(base_path, "MISC")
+            else:
+                target_path = os.path.join(base_path, label)
+
+            try:
+                target_path = datman.utils.define_folder(target_path)
+            except OSError:
+                logger.error(f"Failed creating target folder: {target_path}")
+                continue
+
+            xnat_resource_id = xnat_experiment.resource_IDs[label]
+
+            try:
+                resources = xnat.get_resource_list(xnat_experiment.project,
+                                                   xnat_experiment.subject,
+                                                   xnat_experiment.name,
+                                                   xnat_resource_id)
+            except Exception as e:
+                logger.error(f"Failed getting resource {xnat_resource_id} "
+                             f"for experiment {xnat_experiment.name}. "
+                             f"Reason - {e}")
+                continue
+
+            if not resources:
+                continue
+
+            for resource in resources:
+                resource_path = os.path.join(target_path, resource["URI"])
+                if os.path.isfile(resource_path):
+                    logger.debug(f"Resource {resource['name']} from "
+                                 f"experiment {xnat_experiment.name} already "
+                                 "exists")
+                    continue
+
+                logger.info(f"Downloading {resource['name']} from "
+                            f"experiment {xnat_experiment.name}")
+                if self.download_resource(xnat, xnat_experiment,
+                                          xnat_resource_id, resource["URI"],
+                                          resource_path):
+                    self._notify("resource_downloaded", experiment=ident,
+                                 path=resource_path)
+
+    def download_resource(self, xnat, xnat_experiment, xnat_resource_id,
+                          xnat_resource_uri, target_path):
+        """
+        Download a single resource file from XNAT. Target path should be
+        full path to store the file, including filename
+        """
+
+        try:
+            source = xnat.get_resource(xnat_experiment.project,
+                                       xnat_experiment.subject,
+                                       xnat_experiment.name,
+                                       xnat_resource_id,
+                                       xnat_resource_uri,
+                                       zipped=False)
+        except Exception as e:
+            logger.error("Failed downloading resource archive from "
+                         f"{xnat_experiment.name} with reason: {e}")
+            return
+
+        # check that the target path exists
+        target_dir = os.path.split(target_path)[0]
+        if not os.path.exists(target_dir):
+            try:
+                os.makedirs(target_dir, exist_ok=True)
+            except OSError:
+                logger.error(f"Failed to create directory: {target_dir}")
+                return
+
+        # copy the downloaded file to the target location
+        copied = None
+        try:
+            if not self.dryrun:
+                shutil.copyfile(source, target_path)
+                copied = target_path
+        except (IOError, OSError):
+            logger.error(f"Failed copying resource {source} to target "
+                         f"{target_path}")
+
+        # finally delete the temporary archive
+        try:
+            os.remove(source)
+        except OSError:
+            logger.error(f"Failed to remove temporary archive {source} on "
+                         f"system {platform.node()}")
+        return copied
+
+    def process_scans(self, xnat, ident, xnat_experiment):
+        """Download scans from an XNAT experiment and convert to valid formats.
+
+        Args:
+            xnat (:obj:`datman.xnat.xnat`): A connection to the experiment's
+                XNAT server.
+            ident (:obj:`datman.scanid.Identifier`): A valid datman
+                Identifier to name files after.
+            xnat_experiment (:obj:`datman.xnat.XNATExperiment`): An
+                experiment from the XNAT server to download dicoms from.
+        """
+
+        logger.info(f"Processing scans in experiment {xnat_experiment.name}")
+
+        # load the export info from the site config files
+        tags = self.config.get_tags(site=ident.site)
+
+        if not tags.series_map:
+            logger.error("Failed to get export info for study "
+                         f"{self.study} at site {ident.site}")
+            return
+
+        valid_scans = []
+        for scan in xnat_experiment.scans:
+            if self._check_scan(ident, scan, xnat_experiment, tags):
+                valid_scans.append(scan)
+
+        if self.update_dashboard:
+            self._add_to_dashboard(
+                [name for scan in valid_scans for name in scan.names])
+
+        exports = []
+        for scan in valid_scans:
+            for fname, tag in zip(scan.names, scan.tags):
+                if self.tags and (tag not in self.tags):
+                    continue
+                export_formats = self.get_export_formats(ident, fname, tags,
+                                                         tag)
+                if export_formats:
+                    exports.append((scan, fname, export_formats))
+
+        side_cars = []
+        download_size = 0
+        if self.bulk_download:
+            # The conversions' temporary folders are made in the download
+            # folder, so they never wait for space while it's held
+            download_size = datman.storage.archive_footprint(
+                sum({scan.series: scan.size
+                     for scan, _, _ in exports}.values())) + sum(
+                _conversion_space(scan, export_formats)
+                for scan, _, export_formats in exports)
+        with contextlib.ExitStack() as stack:
+            try:
+                temp = stack.enter_context(
+                    self.make_temp_directory(download_size))
+            except StorageException as e:
+                error = (f"Not enough disk space to download experiment "
+                         f"{xnat_experiment.name}. Reason - {e}")
+                logger.error(error)
+                for _, fname, export_formats in exports:
+                    self._report_failed_export(ident, fname, export_formats,
+                                               error)
+                return
+
+            series_dirs = {}
+            if self.bulk_download and exports:
+                series_dirs = self.download_scans(
+                    xnat, xnat_experiment,
+                    [scan for scan, _, _ in exports], temp)
+
+            # Exports of each series run in the background while the next
+            # is downloaded
+            pending = []
+            for scan, fname, export_formats in exports:
+                src_dir = series_dirs.get(scan.series)
+                pending.append(self.start_export(
+                    xnat, ident, scan, fname, export_formats,
+                    src_dir=src_dir, temp_root=temp if src_dir else None))
+            for job in pending:
+                side_cars.extend(path for path in job.result()
+                                 if path.endswith(".json"))
+
+        if self.update_dashboard and dashboard.dash_found:
+            self._add_side_cars(side_cars)
+
+    def download_scans(self, xnat, xnat_experiment, scans, dest):
+        """
+        Download the dicoms of several scans in a single request.
+
+        Args:
+            xnat (:obj:`datman.xnat.xnat`): A connection to the experiment's
+                XNAT server.
+            xnat_experiment (:obj:`datman.xnat.XNATExperiment`): The
+                experiment the scans belong to.
+            scans (list): The :obj:`datman.xnat.XNATScan` objects to get.
+            dest (:obj:`str`): The folder to unpack them in.
+
+        Returns:
+            dict: Scan IDs mapped to the folder holding their dicoms. Scans
+            that couldn't be found in the download are left out, so they'll
+            be downloaded on their own instead.
+        """
+        scan_ids = sorted({scan.series for scan in scans})
+        logger.info(f"Downloading dicoms for {len(scan_ids)} series from "
+                    f"{xnat_experiment.name}")
+        try:
+            archive = xnat.get_dicoms(xnat_experiment.project,
+                                      xnat_experiment.subject,
+                                      xnat_experiment.name,
+                                      scan_ids,
+                                      os.path.join(dest, "dicoms.zip"))
+        except Exception as e:
+            logger.error("Failed to download dicoms for experiment "
+                         f"{xnat_experiment.name} in one request, each "
+                         f"series will be downloaded separately. Reason - {e}")
+            return {}
+
+        try:
+            unpacked = split_dicom_archive(archive, dest, scan_ids)
+        except Exception as e:
+            logger.error(f"Failed unpacking dicom archive for "
+                         f"{xnat_experiment.name}. Reason - {e}")
+            return {}
+        finally:
+            os.remove(archive)
+
+        series_dirs = {}
+        for scan_id, folder in unpacked.items():
+            series_dir = find_dicom_dir(folder)
+            if series_dir:
+                series_dirs[scan_id] = series_dir
+        return series_dirs
+
+    def _check_scan(self, ident, scan, xnat_experiment, tags):
+        """Name a scan and check that it can be exported."""
+        if not scan.raw_dicoms_exist():
+            logger.warning(f"Skipping series {scan.series} for session "
+                           f"{xnat_experiment.name}. No RAW dicoms exist")
+            return False
+
+        if scan.is_derived():
+            logger.warning(f"Series {scan.series} in session "
+                           f"{xnat_experiment.name} is a derived scan. "
+                           "Skipping.")
+            return False
+
+        if not scan.description:
+            logger.error(f"Can't find description for series {scan.series} "
+                         f"from session {xnat_experiment.name}")
+            return False
+
+        try:
+            scan.set_datman_name(str(ident), tags.matcher)
+        except Exception as e:
+            logger.info(f"Failed to make file name for series {scan.series} "
+                        f"in session {xnat_experiment.name}. Reason "
+                        f"{type(e).__name__}: {e}")
+            return False
+
+        if len(scan.tags) > 1 and not scan.multiecho:
+            logger.error("Multiple export patterns match for "
+                         f"{xnat_experiment.name}, descr: "
+                         f"{scan.description}, tags: {scan.tags}")
+            return False
+        return True
+
+    def _add_to_dashboard(self, scan_names):
+        logger.info(f"Adding scans {scan_names} to dashboard")
+        try:
+            dashboard.queue_write("add_scans", scan_names)
+        except Exception as e:
+            logger.error(f"Failed adding scans to dashboard with error: {e}")
+
+    def _add_side_cars(self, side_cars):
+        """Add JSON side cars to their dashboard records."""
+        if not side_cars:
+            return
+        try:
+            dashboard.queue_write("update_sidecars", side_cars)
+        except Exception as e:
+            logger.error(f"Failed to add JSON side cars to dashboard. "
+                         f"Reason - {e}")
+
+    def get_export_formats(self, ident, file_stem, tags, tag):
+        """Returns the formats a series still needs to be exported to."""
+        try:
+            blacklist_entry = datman.utils.read_blacklist(scan=file_stem,
+                                                          config=self.config)
+        except datman.scanid.ParseException:
+            logger.error(f"{file_stem} is not a datman ID. Skipping.")
+            return
+
+        if blacklist_entry:
+            logger.warning(f"Skipping export of {file_stem} due to blacklist "
+                           f"entry '{blacklist_entry}'")
+            return
+
+        try:
+            export_formats = tags.get(tag)["formats"]
+        except KeyError:
+            logger.error(f"Export settings for tag: {tag} not found for "
+                         f"study: {self.study}")
+            return
+
+        export_formats = self.series_is_processed(ident, file_stem,
+                                                  export_formats)
+        if not export_formats:
+            logger.debug(f"Scan: {file_stem} has been processed. Skipping")
+            return
+
+        return export_formats
+
+    def series_is_processed(self, ident, file_stem, export_formats):
+        """Returns the formats that exported files dont exist for yet.
+
+        The manifest is checked first. Output folders are only searched for
+        formats it has no record of, and any files found there are added to
+        it so they dont have to be searched for again.
+        """
+        manifest = self.manifest
+        if manifest:
+            export_formats = manifest.remaining(file_stem, export_formats)
+        remaining_formats = []
+        for f in export_formats:
+            outputs = self.find_outputs(ident, file_stem, f)
+            if not outputs:
+                remaining_formats.append(f)
+            elif manifest and not self.dryrun:
+                manifest.add(file_stem, f, outputs)
+        return remaining_formats
+
+    def find_outputs(self, ident, file_stem, export_format):
+        """Returns the paths of all files exported for a series in one
+        format.
+        """
+        outfile = os.path.join(self.get_output_dir(ident, export_format),
+                               file_stem)
+        # need to use wildcards here as dont really know what the
+        # file extensions will be
+        return [p for p in glob(outfile + ".*") if os.path.isfile(p)]
+
+    def record_outputs(self, ident, file_stem, export_format, uid):
+        """Add the files just exported for a series to the manifest."""
+        manifest = self.manifest
+        if not manifest or self.dryrun:
+            return
+        try:
+            manifest.add(file_stem, export_format,
+                         self.find_outputs(ident, file_stem, export_format),
+                         uid=uid)
+        except Exception as e:
+            logger.error(f"Failed adding {export_format} outputs for "
+                         f"{file_stem} to the manifest. Reason - {e}")
+
+    def get_output_dir(self, ident, export_format):
+        return os.path.join(self.config.get_path(export_format),
+                            ident.get_full_subjectid_with_timepoint())
+
+    def export_series(self, xnat, ident, xnat_scan, output_name,
+                      export_formats, src_dir=None):
+        """
+        Export a series to each of the given formats.
+
+        Args:
+            src_dir (:obj:`str`, optional): A folder holding the series'
+                dicoms. If not given, they're downloaded from XNAT.
+
+        Returns:
+            list: The paths of the files created.
+        """
+        return self.start_export(xnat, ident, xnat_scan, output_name,
+                                 export_formats, src_dir).result()
+
+    def start_export(self, xnat, ident, xnat_scan, output_name,
+                     export_formats, src_dir=None, temp_root=None):
+        """
+        Start exporting a series to each of the given formats.
+
+        The series is downloaded (if src_dir isn't given) before this
+        returns, and each format is then exported by the extractor's pool.
+        The space reserved for the download also covers the exports'
+        temporary folders, which are made inside it.
+
+        Args:
+            src_dir (:obj:`str`, optional): A folder holding the series'
+                dicoms. If not given, they're downloaded from XNAT.
+            temp_root (:obj:`str`, optional): A folder that already has space
+                reserved for the exports' temporary folders. Only used with
+                src_dir.
+
+        Returns:
+            :obj:`concurrent.futures.Future`: The paths of the files created,
+            once every format has finished.
+        """
+        result = concurrent.futures.Future()
+        if not export_formats:
+            result.set_result([])
+            return result
+
+        cleanup = contextlib.ExitStack()
+        with cleanup:
+            if not src_dir:
+                # scan hasn't been completely processed, get it from XNAT
+                logger.info("Getting scan from XNAT")
+                try:
+                    temp_root = cleanup.enter_context(
+                        self.make_temp_directory(
+                            datman.storage.archive_footprint(xnat_scan.size) +
+                            _conversion_space(xnat_scan, export_formats)))
+                except StorageException as e:
+                    error = (f"Not enough disk space to get series "
+                             f"{xnat_scan.series} for experiment "
+                             f"{xnat_scan.experiment}. Reason - {e}")
+                else:
+                    src_dir = get_dicom_archive_from_xnat(xnat, xnat_scan,
+                                                          temp_root)
+                    error = (f"Failed getting series {xnat_scan.series} for "
+                             f"experiment {xnat_scan.experiment} from XNAT")
+
+            if not src_dir:
+                logger.error(error)
+                self._report_failed_export(ident, output_name, export_formats,
+                                           error)
+                result.set_result([])
+                return result
+
+            jobs = [(export_format,
+                     self.pool.submit(export_format, self._run_export, ident,
+                                      xnat_scan, output_name, export_format,
+                                      src_dir, temp_root))
+                    for export_format in export_formats]
+            # The download is kept until the last job finishes
+            cleanup = cleanup.pop_all()
+
+        remaining = [len(jobs)]
+        lock = threading.Lock()
+
+        def finish(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                result.set_result(self._finish_export(ident, output_name,
+                                                      jobs))
+            except Exception as e:
+                result.set_exception(e)
+            finally:
+                cleanup.close()
+
+        for _, job in jobs:
+            job.add_done_callback(finish)
+        return result
+
+    def _run_export(self, ident, xnat_scan, output_name, export_format,
+                    src_dir, temp_root=None):
+        created = []
+        previous = getattr(self._local, "temp_root", None)
+        self._local.temp_root = temp_root
+        try:
+            error = self._export(ident, xnat_scan, output_name,
+                                 export_format, src_dir, created)
+        finally:
+            self._local.temp_root = previous
+        return created, error
+
+    def _report_failed_export(self, ident, output_name, export_formats,
+                              error):
+        for export_format in export_formats:
+            self._notify("export_failed", experiment=ident,
+                         series=output_name, format=export_format,
+                         error=error)
+
+    def _finish_export(self, ident, output_name, jobs):
+        """Report the results of a series' export jobs."""
+        created = []
+        exported = []
+        for export_format, job in jobs:
+            try:
+                outputs, error = job.result()
+            except Exception as e:
+                outputs, error = [], f"{type(e).__name__}: {e}"
+            created.extend(outputs)
+            if error:
+                self._notify("export_failed", experiment=ident,
+                             series=output_name, format=export_format,
+                             error=error)
+            else:
+                exported.append(export_format)
+
+        logger.info("Completed exports")
+        if exported:
+            self._notify("series_exported", experiment=ident,
+                         series=output_name, formats=exported)
+        return created
+
+    def _export(self, ident, xnat_scan, output_name, export_format, src_dir,
+                created):
+        """Export a series to one format. Returns an error message if it
+        fails."""
+        target_dir = self.get_output_dir(ident, export_format)
+        try:
+            target_dir = datman.utils.define_folder(target_dir)
+        except OSError:
+            error = f"Failed creating target folder: {target_dir}"
+            logger.error(error)
+            return error
+
+        try:
+            exporter = self.exporters[export_format]
+        except KeyError:
+            error = f"Export format {export_format} not defined"
+            logger.error(error)
+            return error
+
+        journal = self.journal
+        staging = None
+        if journal:
+            try:
+                staging = journal.stage(target_dir,
+                                        f"{output_name}.{export_format}")
+            except OSError as e:
+                error = f"Failed creating staging folder in {target_dir}"
+                logger.error(f"{error}. Reason - {e}")
+                return error
+
+        logger.info(f"Exporting scan {xnat_scan.names} to format "
+                    f"{export_format}")
+        try:
+            outputs = exporter(self, src_dir, staging or target_dir,
+                               output_name, xnat_scan)
+        except Exception as e:
+            logger.error(f"An error happened exporting {export_format} from "
+                         f"scan {xnat_scan.series} in experiment "
+                         f"{xnat_scan.experiment}")
+            if staging:
+                journal.discard(staging)
+            return f"{type(e).__name__}: {e}"
+
+        outputs = outputs or []
+        if staging:
+            try:
+                moved = journal.promote(staging, target_dir)
+            except OSError as e:
+                error = (f"Failed moving {export_format} outputs for "
+                         f"{output_name} into place")
+                logger.error(f"{error}. Reason - {e}")
+                return error
+            outputs = [path for path in (
+                os.path.join(target_dir, os.path.relpath(out, staging))
+                for out in outputs) if path in moved]
+        created.extend(outputs)
+        self.record_outputs(ident, output_name, export_format, xnat_scan.uid)
+        return None
+
+    @contextlib.contextmanager
+    def make_temp_directory(self, size=0):
+        """
+        Make a temporary folder, once there's disk space for it.
+
+        Exports already have space reserved for their temporary folders along
+        with the series' download, so folders made while exporting are put
+        there instead of reserving more. An export waiting for space that
+        only its own download could free would never get it.
+
+        Args:
+            size (int, optional): The number of bytes to reserve for the
+                folder's contents. Defaults to 0.
+        """
+        temp_root = getattr(self._local, "temp_root", None)
+        if not temp_root:
+            with self.storage.temp_directory(
+                    size, prefix="dm_xnat_extract_") as temp_dir:
+                yield temp_dir
+            return
+
+        temp_dir = tempfile.mkdtemp(prefix="dm_xnat_extract_", dir=temp_root)
+        try:
+            yield temp_dir
+        finally:
+            datman.storage.remove_folder(temp_dir)
+
+    def run_conversion(self, seriesdir, outputdir, cmd, cache_cmd):
+        """Runs a conversion command, unless its outputs are already cached.
+
+        Args:
+            seriesdir (:obj:`str`): The folder of DICOMs being converted.
+            outputdir (:obj:`str`): An empty folder the command writes to.
+            cmd (:obj:`str`): The command to run.
+            cache_cmd (:obj:`str`): The same command with placeholders in
+                place of the input and output folders, used to identify it in
+                the conversion cache.
+
+        Returns:
+            tuple: The return code and the converter's messages.
+        """
+        cache = self.conversion_cache
+        key = None
+        if cache and not self.dryrun:
+            try:
+                key = cache.make_key(seriesdir, cache_cmd)
+            except Exception as e:
+                logger.warning(f"Can't check conversion cache for "
+                               f"{seriesdir}. Reason - {e}")
+            cached = cache.materialise(key, outputdir)
+            if cached:
+                logger.info(f"Using cached conversion of {seriesdir}")
+                return 0, cached[0]
+
+        return_code, messages = datman.utils.run(cmd, self.dryrun)
+        if key and not return_code:
+            try:
+                cache.put(key, outputdir, messages)
+            except Exception as e:
+                logger.warning(f"Failed to cache conversion of {seriesdir}. "
+                               f"Reason - {e}")
+        return return_code, messages
+
+    def report_issues(self, dest, messages):
+        # The only issue we care about currently is if files are missing
+        if "missing images" not in messages:
+            return
+        try:
+            with open(dest, "w") as output:
+                output.write(messages)
+        except Exception as e:
+            logger.error(f"Failed writing dcm2niix conversion errors to "
+                         f"{dest}. Reason - {type(e).__name__} {e}")
+        if not (self.update_dashboard and dashboard.dash_found):
+            return
+        scan_name = os.path.splitext(os.path.basename(dest))[0]
+        # Queued like the scans themselves, so that it's only written once
+        # the scan's record has been added
+        try:
+            dashboard.queue_write("add_scan_errors", [[scan_name, messages]])
+        except Exception as e:
+            logger.error(f"Failed to add conversion errors to dashboard "
+                         f"record for {scan_name}. Reason - {e}")
+
+    def __repr__(self):
+        return f"<datman.extract.Extractor {self.study}>"
+
+
+def get_timestamp(date):
+    """Returns the seconds since the epoch for one of XNAT's dates, or 0 if
+    it can't be read."""
+    for date_format in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S",
+                        "%Y-%m-%d"):
+        try:
+            return datetime.strptime(date, date_format).timestamp()
+        except (TypeError, ValueError):
+            continue
+    return 0
+
+
+def set_date(session, experiment):
+    if not experiment.date:
+        logger.debug(f"No scanning date found for {session}, leaving blank.")
+        return
+
+    try:
+        date = datetime.strptime(experiment.date, "%Y-%m-%d")
+    except ValueError:
+        logger.error(f"Invalid date {experiment.date} for scan session "
+                     f"{session}")
+        return
+
+    if date == session.date:
+        return
+
+    session.date = date
+    session.save()
+
+
+def set_alt_ids(session, ident):
+    if not isinstance(ident, datman.scanid.KCNIIdentifier):
+        return
+    session.timepoint.kcni_name = ident.get_xnat_subject_id()
+    session.kcni_name = ident.get_xnat_experiment_id()
+    session.save()
+
+
+def get_dicom_archive_from_xnat(xnat, xnat_scan, tempdir):
+    """
+    Downloads and extracts a dicom archive from XNAT to a local temp folder.
+    Returns the path to the folder of .dcm files inside the tempdir.
+    """
+    # make a copy of the dicom files in a local directory
+    logger.info(f"Downloading dicoms for: {xnat_scan.experiment}, series: "
+                f"{xnat_scan.series}")
+    try:
+        dicom_archive = xnat.get_dicom(xnat_scan.project,
+                                       xnat_scan.subject,
+                                       xnat_scan.experiment,
+                                       xnat_scan.series,
+                                       os.path.join(tempdir, "dicoms.zip"))
+    except Exception:
+        logger.error(f"Failed to download dicom archive for: "
+                     f"{xnat_scan.subject}, series: {xnat_scan.series}")
+        return None
+
+    logger.info("Unpacking archive")
+
+    try:
+        with zipfile.ZipFile(dicom_archive, "r") as myzip:
+            myzip.extractall(tempdir)
+    except Exception:
+        logger.error("An error occurred unpacking dicom archive for: "
+                     f"{xnat_scan.subject}. Skipping")
+        os.remove(dicom_archive)
+        return None
+
+    logger.info("Deleting archive file")
+    os.remove(dicom_archive)
+
+    base_dir = find_dicom_dir(tempdir)
+    if not base_dir:
+        logger.warning("There were no valid dicom files in XNAT session "
+                       f"{xnat_scan.subject}, series {xnat_scan.series}")
+    return base_dir
+
+
+def find_dicom_dir(folder):
+    """Returns the folder of the first valid dicom found beneath a folder.
+    """
+    for root, dirname, filenames in os.walk(folder):
+        for filename in sorted(filenames):
+            f = os.path.join(root, filename)
+            if is_valid_dicom(f):
+                return root
+    return None
+
+
+def split_dicom_archive(archive, dest, scan_ids):
+    """
+    Unpack a zip file of several scans' dicoms (from xnat.get_dicoms) into
+    a separate folder for each scan.
+
+    XNAT stores each scan's files beneath a folder named
+    '<scan ID>-<scan type>' inside a 'scans' folder. Files that aren't
+    beneath a folder for one of the given scan IDs are skipped.
+
+    Args:
+        archive (:obj:`str`): The path to the zip file.
+        dest (:obj:`str`): The folder to create the scan folders in.
+        scan_ids (list): The IDs of the scans in the archive.
+
+    Returns:
+        dict: Each scan ID found mapped to the folder its files were
+        unpacked into.
+    """
+    # Longest first so that IDs like '1' don't claim the files of '1-2'
+    ordered = sorted(scan_ids, key=len, reverse=True)
+    unpacked = {}
+    with zipfile.ZipFile(archive, "r") as myzip:
+        for member in myzip.infolist():
+            if member.is_dir():
+                continue
+            parts = member.filename.split("/")
+            try:
+                folder = parts[parts.index("scans") + 1]
+            except (ValueError, IndexError):
+                continue
+            scan_id = _match_scan(folder, ordered)
+            if scan_id is None:
+                logger.debug(f"Skipping unexpected file {member.filename}")
+                continue
+            scan_dir = os.path.join(dest, f"series_{scan_id}")
+            myzip.extract(member, scan_dir)
+            unpacked[scan_id] = scan_dir
+    return unpacked
+
+
+def _match_scan(folder, scan_ids):
+    for scan_id in scan_ids:
+        if folder == scan_id or folder.startswith(scan_id + "-"):
+            return scan_id
+    return None
+
+
+def _conversion_space(xnat_scan, export_formats):
+    """Returns the space to reserve for the temporary folders of a series'
+    exports. Each format may convert a copy of the series at the same time.
+    """
+    return (xnat_scan.size or 0) * len(export_formats)
@@ -0,0 +1,235 @@
+"""
+The export formats an Extractor can convert series to, and the pool that
+runs their exporters.
+
+Each format is described by an ExportFormat: the exporter that does the
+conversion (see :mod:`datman.extract.exporters`) and what it needs to run:
+
+    - workers: The number of series that may be exported to the format at
+      once. Formats with 0 workers are exported inline, by the thread
+      processing the experiment, which suits cheap exporters like the dcm
+      copier.
+    - cpus: The number of CPUs each export keeps busy. Exports of all formats
+      share the machine's CPUs, so a CPU heavy converter can't starve the
+      rest.
+
+Other packages can add formats without any changes to datman by declaring
+an entry point in the 'datman.exporters' group, named after the format and
+pointing to either an ExportFormat or an exporter function. e.g. in the
+package's setup.cfg:
+
+    [options.entry_points]
+    datman.exporters =
+        sidecar = mypackage.exporters:export_sidecar
+
+The number of workers for each format can be changed for a study with the
+EXPORT_WORKERS setting, e.g.
+
+    EXPORT_WORKERS:
+      nii: 8
+"""
+import concurrent.futures
+import logging
+import os
+import threading
+
+from datman.exceptions import UndefinedSetting
+from datman.extract.exporters import (export_dcm, export_mnc, export_nii,
+                                      export_nrrd)
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = "datman.exporters"
+
+
+class ExportFormat(object):
+    """
+    An export format and the resources its exporter needs.
+
+    Args:
+        name (:obj:`str`): The format's name, as used in the 'formats'
+            setting of a tag.
+        exporter (function): The function that exports a series to this
+            format.
+        workers (int, optional): The most series that may be exported to this
+            format at once. 0 runs every export inline. Defaults to 0.
+        cpus (int, optional): The number of CPUs each export uses. Defaults
+            to 0.
+    """
+
+    def __init__(self, name, exporter, workers=0, cpus=0):
+        self.name = name
+        self.exporter = exporter
+        self.workers = workers
+        self.cpus = cpus
+
+    def copy(self, **changes):
+        settings = {"name": self.name, "exporter": self.exporter,
+                    "workers": self.workers, "cpus": self.cpus}
+        settings.update(changes)
+        return ExportFormat(**settings)
+
+    def __repr__(self):
+        return (f"<datman.extract.ExportFormat {self.name} - "
+                f"workers: {self.workers}, cpus: {self.cpus}>")
+
+
+DEFAULT_FORMATS = {
+    fmt.name: fmt for fmt in [
+        ExportFormat("nii", export_nii, workers=2, cpus=1),
+        ExportFormat("mnc", export_mnc, workers=1, cpus=1),
+        ExportFormat("nrrd", export_nrrd, workers=1, cpus=1),
+        ExportFormat("dcm", export_dcm),
+    ]
+}
+
+
+def get_formats(exporters=None, config=None):
+    """
+    Collect the export formats available to an Extractor.
+
+    Args:
+        exporters (dict, optional): Format names mapped to an exporter
+            function or ExportFormat. If given, these are the only formats
+            used. Defaults to DEFAULT_FORMATS and any installed plugins.
+        config (:obj:`datman.config.config`, optional): A study config to
+            read the EXPORT_WORKERS setting from.
+
+    Returns:
+        dict: Format names mapped to their ExportFormat.
+    """
+    if exporters:
+        formats = {name: as_format(name, exporter)
+                   for name, exporter in exporters.items()}
+    else:
+        formats = dict(DEFAULT_FORMATS)
+        formats.update(load_plugins())
+
+    if config is None:
+        return formats
+    try:
+        workers = config.get_key("EXPORT_WORKERS")
+    except UndefinedSetting:
+        return formats
+    for name, count in workers.items():
+        if name not in formats:
+            logger.warning(f"EXPORT_WORKERS given for unknown export format "
+                           f"{name}")
+            continue
+        formats[name] = formats[name].copy(workers=int(count))
+    return formats
+
+
+def as_format(name, exporter):
+    """Returns an ExportFormat for an exporter function or ExportFormat."""
+    if isinstance(exporter, ExportFormat):
+        return exporter if exporter.name == name else exporter.copy(
+            name=name)
+    return ExportFormat(name, exporter)
+
+
+def load_plugins():
+    """Returns the export formats installed by other packages."""
+    formats = {}
+    for entry_point in _get_entry_points(ENTRY_POINT_GROUP):
+        try:
+            plugin = entry_point.load()
+        except Exception as e:
+            logger.error(f"Failed to load export format {entry_point.name}. "
+                         f"Reason - {e}")
+            continue
+        if not (isinstance(plugin, ExportFormat) or callable(plugin)):
+            logger.error(f"Export format plugin {entry_point.name} is not an "
+                         "exporter or ExportFormat. Ignoring.")
+            continue
+        formats[entry_point.name] = as_format(entry_point.name, plugin)
+    return formats
+
+
+def _get_entry_points(group):
+    try:
+        import importlib.metadata as metadata
+    except ImportError:
+        # Python < 3.8
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group))
+    found = metadata.entry_points()
+    if hasattr(found, "select"):
+        return list(found.select(group=group))
+    return list(found.get(group, []))
+
+
+class ExportPool(object):
+    """
+    Runs exports with each format's concurrency and CPU limits.
+
+    Every format with workers gets its own thread pool. The exporters mostly
+    wait on converters running in their own processes (e.g. dcm2niix), so
+    threads are enough to keep several conversions running at once.
+
+    Args:
+        formats (dict): Format names mapped to their ExportFormat.
+        cpus (int, optional): The number of CPUs exports may use at once.
+            Defaults to the number of CPUs on the machine.
+    """
+
+    def __init__(self, formats, cpus=None):
+        self.formats = formats
+        self.cpus = cpus or os.cpu_count() or 1
+        self._free_cpus = self.cpus
+        self._cpus_freed = threading.Condition()
+        self._executors = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name, function, *args):
+        """
+        Run an export of format 'name'.
+
+        Returns:
+            :obj:`concurrent.futures.Future`: The export's result. Inline
+            exports have already finished when it's returned.
+        """
+        fmt = self.formats.get(name) or ExportFormat(name, None)
+        if fmt.workers > 0:
+            return self._get_executor(fmt).submit(self._run, fmt, function,
+                                                  *args)
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(self._run(fmt, function, *args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _get_executor(self, fmt):
+        with self._lock:
+            if fmt.name not in self._executors:
+                self._executors[fmt.name] = \
+                    concurrent.futures.ThreadPoolExecutor(
+                        max_workers=fmt.workers,
+                        thread_name_prefix=f"export_{fmt.name}")
+            return self._executors[fmt.name]
+
+    def _run(self, fmt, function, *args):
+        needed = min(fmt.cpus, self.cpus)
+        with self._cpus_freed:
+            while self._free_cpus < needed:
+                self._cpus_freed.wait()
+            self._free_cpus -= needed
+        try:
+            return function(*args)
+        finally:
+            with self._cpus_freed:
+                self._free_cpus += needed
+                self._cpus_freed.notify_all()
+
+    def shutdown(self):
+        """Wait for running exports and stop the worker threads."""
+        with self._lock:
+            executors = list(self._executors.values())
+            self._executors = {}
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+    def __repr__(self):
+        return (f"<datman.extract.ExportPool "
+                f"{', '.join(sorted(self.formats))}>")
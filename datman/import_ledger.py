@@ -0,0 +1,233 @@
+"""
+Keeps track of dicom archives uploaded to XNAT's prearchive.
+
+When dm_xnat_upload.py uploads asynchronously, XNAT builds and archives
+each session after the upload has finished. The ledger (IMPORT_LEDGER in the
+study's metadata folder) records every upload in progress along with its
+prearchive path, so the uploader can go on to the next archive while XNAT
+works, check back later with an increasing delay, and pick up where it left
+off if it's interrupted.
+
+Each entry moves through these states:
+
+    UPLOADING -> QUEUED -> DONE
+                      \\-> FAILED
+
+An entry still UPLOADING when a run starts was interrupted and has to be
+uploaded again. QUEUED entries are checked with check_import() once their
+next check time has passed.
+"""
+import collections
+import logging
+import sqlite3
+import time
+
+from datman.exceptions import XnatException
+
+logger = logging.getLogger(__name__)
+
+# The ledger's file name, stored in the study's 'meta' folder
+IMPORT_LEDGER = "import_ledger.sqlite"
+
+UPLOADING = "UPLOADING"
+QUEUED = "QUEUED"
+DONE = "DONE"
+FAILED = "FAILED"
+
+# Prearchive statuses that mean the session needs someone to look at it
+PREARCHIVE_FAILURES = ("ERROR", "CONFLICT")
+
+ImportRecord = collections.namedtuple(
+    "ImportRecord",
+    ["archive", "project", "subject", "experiment", "prearchive", "state",
+     "attempts", "next_check", "message"]
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS imports (
+    archive TEXT PRIMARY KEY,
+    project TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    experiment TEXT NOT NULL,
+    prearchive TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_check REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS imports_state ON imports (state, next_check);
+"""
+
+
+class ImportLedger(object):
+    """
+    A study's record of uploads waiting to be archived by XNAT.
+
+    Args:
+        path (:obj:`str`): The full path to the ledger. It will be created if
+            it doesnt exist.
+        base_delay (int, optional): Seconds to wait before checking on a new
+            upload. The delay doubles after every check that finds the
+            session still in progress. Defaults to 30.
+        max_delay (int, optional): The longest delay between checks, in
+            seconds. Defaults to 900.
+        timeout (int, optional): How many seconds to wait for another
+            process's write to finish before giving up. Defaults to 60.
+    """
+
+    def __init__(self, path, base_delay=30, max_delay=900, timeout=60):
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        self._conn.executescript(_SCHEMA)
+
+    def get(self, archive):
+        """Returns the ImportRecord for an archive, or None."""
+        row = self._conn.execute(
+            f"SELECT {', '.join(ImportRecord._fields)} FROM imports "
+            "WHERE archive = ?", (archive,)
+        ).fetchone()
+        return ImportRecord(*row) if row else None
+
+    def find(self, states=None, due=False):
+        """
+        Returns a list of ImportRecords.
+
+        Args:
+            states (list, optional): Only return entries in these states.
+                Defaults to all states.
+            due (bool, optional): Only return entries whose next check time
+                has passed. Defaults to False.
+        """
+        query = f"SELECT {', '.join(ImportRecord._fields)} FROM imports"
+        clauses = []
+        params = []
+        if states:
+            clauses.append(f"state IN ({', '.join('?' * len(states))})")
+            params.extend(states)
+        if due:
+            clauses.append("next_check <= ?")
+            params.append(time.time())
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY next_check, archive"
+        return [ImportRecord(*row) for row in self._conn.execute(query,
+                                                                 params)]
+
+    def pending(self):
+        """Returns entries that are still being uploaded or archived."""
+        return self.find(states=[UPLOADING, QUEUED])
+
+    def start(self, archive, project, subject, experiment):
+        """Record that an archive is about to be uploaded."""
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO imports (archive, project, subject, "
+                "experiment, state, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (archive, project, subject, experiment, UPLOADING,
+                 time.time())
+            )
+
+    def queued(self, archive, prearchive):
+        """Record that an upload finished and XNAT is processing it."""
+        self._update(archive, state=QUEUED, prearchive=prearchive,
+                     attempts=0, next_check=time.time() + self.base_delay)
+
+    def retry_later(self, archive, message=None):
+        """Push an entry's next check back, doubling the delay each time."""
+        record = self.get(archive)
+        attempts = record.attempts + 1 if record else 1
+        delay = min(self.base_delay * 2 ** attempts, self.max_delay)
+        self._update(archive, attempts=attempts,
+                     next_check=time.time() + delay, message=message)
+
+    def done(self, archive, message=None):
+        self._update(archive, state=DONE, message=message)
+
+    def failed(self, archive, message):
+        self._update(archive, state=FAILED, message=message)
+
+    def remove(self, archive):
+        with self._conn:
+            self._conn.execute("DELETE FROM imports WHERE archive = ?",
+                               (archive,))
+
+    def _update(self, archive, **fields):
+        fields["updated"] = time.time()
+        with self._conn:
+            self._conn.execute(
+                f"UPDATE imports SET "
+                f"{', '.join(f'{name} = ?' for name in fields)} "
+                "WHERE archive = ?",
+                list(fields.values()) + [archive]
+            )
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f"<datman.import_ledger.ImportLedger {self.path}>"
+
+
+def check_import(ledger, record, xnat):
+    """
+    Check on a queued upload and archive it if XNAT has finished building it.
+
+    Args:
+        ledger (:obj:`ImportLedger`): The ledger holding the record.
+        record (:obj:`ImportRecord`): The upload to check.
+        xnat (:obj:`datman.xnat.xnat`): A connection to the server the
+            archive was uploaded to.
+
+    Returns:
+        str: The record's new state.
+    """
+    try:
+        status = xnat.get_prearchive_status(record.project,
+                                            record.prearchive)
+    except XnatException as e:
+        ledger.retry_later(record.archive, str(e))
+        return QUEUED
+
+    if status is None:
+        # Either XNAT archived it on its own or someone removed it
+        if _experiment_exists(xnat, record):
+            ledger.done(record.archive)
+            return DONE
+        ledger.failed(record.archive, "Session is no longer in the "
+                                      "prearchive and was not archived")
+        return FAILED
+
+    if status in PREARCHIVE_FAILURES:
+        ledger.failed(record.archive, f"Prearchive status is {status}")
+        return FAILED
+
+    if status != "READY":
+        ledger.retry_later(record.archive, f"Prearchive status is {status}")
+        return QUEUED
+
+    try:
+        xnat.archive_prearchive_session(record.prearchive)
+    except Exception as e:
+        ledger.retry_later(record.archive, f"Failed to archive session. "
+                                           f"Reason - {e}")
+        return QUEUED
+    ledger.done(record.archive)
+    return DONE
+
+
+def _experiment_exists(xnat, record):
+    try:
+        xnat.get_experiment(record.project, record.subject,
+                            record.experiment)
+    except Exception:
+        return False
+    return True
@@ -0,0 +1,349 @@
+"""
+Maintains a persistent index of the files in a study's session folders.
+
+Many datman scripts need to find the files for a subject, or the files with
+a certain tag, series number or extension. Crawling the study's folders to
+answer this is slow on network file systems, especially when several scripts
+(or one script, once per subject) do it repeatedly. The index records each
+file's path, its parsed datman file name fields, size and modification time
+in a SQLite database in the study's metadata folder. When refreshed, only
+folders whose modification time has changed are listed again.
+
+.. note::
+    A folder's modification time only changes when entries are added, removed
+    or renamed in it. Files that are modified in place keep their old size and
+    modification time in the index until their folder changes or a full
+    refresh is done.
+
+.. code-block:: python
+
+    config = datman.config.config(study='SPINS')
+    with StudyIndex(config) as index:
+        index.refresh()
+        t1s = index.find(subject='SPN01_CMH_0001_01', tag='T1', ext='.nii.gz')
+
+"""
+import collections
+import logging
+import os
+import sqlite3
+
+import datman.scanid as scanid
+import datman.utils
+from datman.exceptions import UndefinedSetting
+
+logger = logging.getLogger(__name__)
+
+# The index file name, stored in the study's 'meta' folder
+INDEX_FILE = "file_index.sqlite"
+
+# The path types (from the 'Paths' setting) indexed by default
+DEFAULT_FOLDERS = ("nii", "dcm", "mnc", "nrrd", "resources")
+
+FileRecord = collections.namedtuple(
+    "FileRecord",
+    [
+        "path",
+        "folder",
+        "session",
+        "subject",
+        "tag",
+        "series",
+        "description",
+        "ext",
+        "size",
+        "mtime",
+    ],
+)
+FileRecord.__doc__ = """A single indexed file.
+
+'folder' is the path type (e.g. 'nii') the file was found under and
+'session' is the name of the top level folder it's in (e.g. the subject ID
+for nii folders). 'subject' is the subject ID with timepoint, taken from the
+file name or, for files that arent named according to the datman convention,
+from the session folder. The tag, series and description are None for files
+that arent named according to the datman convention.
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    folder TEXT NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    session TEXT,
+    subject TEXT,
+    tag TEXT,
+    series TEXT,
+    description TEXT,
+    ext TEXT,
+    size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_subject ON files (subject);
+CREATE INDEX IF NOT EXISTS files_tag ON files (tag);
+"""
+
+
+class StudyIndex(object):
+    """
+    An index of all files in a study's session folders.
+
+    Args:
+        config (:obj:`datman.config.config`): A datman config object. If
+            'study' is not given it must already be set to a study.
+        study (:obj:`str`, optional): The study to index. Defaults to None.
+        index_path (:obj:`str`, optional): Where to store the index. Defaults
+            to INDEX_FILE in the study's metadata folder.
+        folders (tuple, optional): The path types to index. Path types that
+            arent defined for the study are skipped. Defaults to
+            DEFAULT_FOLDERS.
+    """
+
+    def __init__(self, config, study=None, index_path=None,
+                 folders=DEFAULT_FOLDERS):
+        if study:
+            config.set_study(study)
+        self.study = config.study_name
+
+        self.roots = {}
+        for folder in folders:
+            try:
+                self.roots[folder] = os.path.normpath(config.get_path(folder))
+            except UndefinedSetting:
+                logger.debug(f"Path {folder} not defined for {self.study}, "
+                             "not indexing it.")
+
+        if not index_path:
+            index_path = os.path.join(config.get_path("meta"), INDEX_FILE)
+        self.index_path = index_path
+
+        self._conn = sqlite3.connect(index_path, timeout=60)
+        self._conn.executescript(_SCHEMA)
+
+    def refresh(self, full=False):
+        """
+        Bring the index up to date with the file system.
+
+        Args:
+            full (bool, optional): Whether to list every folder again, even
+                if its modification time is unchanged. Defaults to False.
+
+        Returns:
+            int: The number of folders that had to be listed.
+        """
+        listed = 0
+        with self._conn:
+            for folder, root in self.roots.items():
+                listed += self._refresh_tree(folder, root, full)
+        logger.debug(f"Refreshed file index for {self.study}, listed "
+                     f"{listed} folders.")
+        return listed
+
+    def _refresh_tree(self, folder, root, full):
+        listed = 0
+        stack = [(root, None)]
+        while stack:
+            path, parent = stack.pop()
+
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                self._forget_dir(path)
+                continue
+
+            known = self._conn.execute(
+                "SELECT mtime FROM dirs WHERE path = ?", (path,)
+            ).fetchone()
+            old_subdirs = {
+                row[0] for row in self._conn.execute(
+                    "SELECT path FROM dirs WHERE parent = ?", (path,)
+                )
+            }
+
+            if known and known[0] == mtime and not full:
+                stack.extend((subdir, path) for subdir in old_subdirs)
+                continue
+
+            listed += 1
+            records, subdirs = self._list_dir(folder, root, path)
+
+            for removed in old_subdirs - set(subdirs):
+                self._forget_dir(removed)
+
+            self._conn.execute("DELETE FROM files WHERE dir = ?", (path,))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(rec.path, path) + tuple(rec[1:]) for rec in records],
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)",
+                (path, parent, folder, mtime),
+            )
+            stack.extend((subdir, path) for subdir in subdirs)
+
+        return listed
+
+    def _list_dir(self, folder, root, path):
+        """
+        Returns a list of FileRecords for the files in a folder and a list of
+        its subfolders.
+        """
+        if path == root:
+            session = None
+        else:
+            session = os.path.relpath(path, root).split(os.sep)[0]
+        session_subject = _get_subject(session)
+
+        records = []
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                entries = list(entries)
+        except OSError as e:
+            logger.error(f"Can't index folder {path}. Reason - {e}")
+            return records, subdirs
+
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                # Dont follow links to folders, in case they form a loop
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # Broken links are still worth knowing about
+                stat = None
+            records.append(
+                _make_record(entry.path, folder, session, session_subject,
+                             stat)
+            )
+        return records, subdirs
+
+    def _forget_dir(self, path):
+        """Remove a folder and everything beneath it from the index."""
+        prefix = path + os.sep
+        for table, column in (("files", "dir"), ("dirs", "path")):
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE {column} = ? OR "
+                f"substr({column}, 1, ?) = ?",
+                (path, len(prefix), prefix),
+            )
+
+    def find(self, subject=None, session=None, tag=None, series=None,
+             ext=None, folder=None):
+        """
+        Find indexed files matching all of the given fields.
+
+        Args:
+            subject (:obj:`str` or :obj:`datman.scanid.Identifier`, optional):
+                A subject ID. Only the study, site, subject and timepoint are
+                compared.
+            session (:obj:`str`, optional): The name of a top level folder
+                (e.g. 'SPN01_CMH_0001_01_01' for resources).
+            tag (:obj:`str`, optional): A scan tag.
+            series (:obj:`str` or int, optional): A series number.
+            ext (:obj:`str`, optional): A file extension (e.g. '.nii.gz')
+            folder (:obj:`str`, optional): A path type (e.g. 'nii').
+
+        Returns:
+            list: A list of FileRecords, sorted by path.
+        """
+        clauses = []
+        params = []
+
+        if subject:
+            clauses.append("subject = ?")
+            params.append(_get_subject(subject) or str(subject))
+        if session:
+            clauses.append("session = ?")
+            params.append(session)
+        if tag:
+            clauses.append("tag = ?")
+            params.append(tag)
+        if series is not None:
+            clauses.append("CAST(series AS INTEGER) = ?")
+            params.append(int(series))
+        if ext:
+            if not ext.startswith("."):
+                ext = "." + ext
+            clauses.append("ext = ?")
+            params.append(ext)
+        if folder:
+            clauses.append("folder = ?")
+            params.append(folder)
+
+        query = (
+            "SELECT path, folder, session, subject, tag, series, description,"
+            " ext, size, mtime FROM files"
+        )
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY path"
+        return [FileRecord(*row) for row in self._conn.execute(query, params)]
+
+    def sessions(self, folder="nii"):
+        """Returns the names of all top level folders for a path type."""
+        try:
+            root = self.roots[folder]
+        except KeyError:
+            return []
+        rows = self._conn.execute(
+            "SELECT path FROM dirs WHERE parent = ?", (root,)
+        )
+        return sorted(os.path.basename(row[0]) for row in rows)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f"<datman.index.StudyIndex {self.study}: {self.index_path}>"
+
+
+def _get_subject(name):
+    """Returns the subject ID with timepoint for a name, if it's valid."""
+    if not name:
+        return None
+    if isinstance(name, scanid.Identifier):
+        return name.get_full_subjectid_with_timepoint()
+    try:
+        ident = scanid.parse(name)
+    except scanid.ParseException:
+        return None
+    return ident.get_full_subjectid_with_timepoint()
+
+
+def _make_record(path, folder, session, session_subject, stat):
+    name = os.path.basename(path)
+    ext = datman.utils.get_extension(name)
+    stem = name[: -len(ext)] if ext else name
+
+    try:
+        ident, tag, series, description = scanid.parse_filename(stem)
+    except scanid.ParseException:
+        subject = session_subject
+        tag = series = description = None
+    else:
+        subject = ident.get_full_subjectid_with_timepoint()
+
+    size = stat.st_size if stat else None
+    mtime = stat.st_mtime if stat else None
+    return FileRecord(path, folder, session, subject, tag, series,
+                      description, ext, size, mtime)
@@ -0,0 +1,288 @@
+"""
+Records which series have already been exported, and in which formats.
+
+dm_xnat_extract used to find out whether a series still needed to be
+exported by searching each format's output folder for files named after it.
+For a large study that means tens of thousands of file system searches every
+night just to find there is nothing to do. The manifest (MANIFEST_FILE in the
+study's metadata folder) instead records every exported file, along with the
+format it was exported to, its size, checksum and the SeriesInstanceUID of
+the series it came from, so the check becomes a single indexed lookup.
+
+The manifest is only a record of what was written. Files deleted or replaced
+outside of datman will not be noticed until it is checked against the disk
+with ProcessedManifest.verify() (or 'dm_manifest.py verify'), and files
+exported before the manifest existed can be added with rebuild() (or
+'dm_manifest.py rebuild').
+
+.. code-block:: python
+
+    with ProcessedManifest.for_study(config) as manifest:
+        todo = manifest.remaining(file_stem, ['nii', 'dcm'])
+"""
+import collections
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+import datman.scanid as scanid
+from datman.index import StudyIndex
+
+logger = logging.getLogger(__name__)
+
+# The manifest's file name, stored in the study's 'meta' folder
+MANIFEST_FILE = "processed_series.sqlite"
+
+OutputRecord = collections.namedtuple(
+    "OutputRecord",
+    ["series", "format", "path", "size", "checksum", "uid"]
+)
+OutputRecord.__doc__ = """A single exported file.
+
+'series' is the datman name of the series it was exported from (without an
+extension) and 'format' is the export format (e.g. 'nii'). The checksum is
+None until rebuild() is run with checksums and 'uid' is None whenever the
+SeriesInstanceUID wasn't known.
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT PRIMARY KEY,
+    series TEXT NOT NULL,
+    subject TEXT,
+    format TEXT NOT NULL,
+    size INTEGER,
+    checksum TEXT,
+    uid TEXT,
+    added REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outputs_series ON outputs (series, format);
+CREATE INDEX IF NOT EXISTS outputs_uid ON outputs (uid);
+"""
+
+
+class ProcessedManifest(object):
+    """
+    A study's record of exported series.
+
+    Args:
+        path (:obj:`str`): The full path to the manifest. It will be created
+            if it doesnt exist.
+        timeout (int, optional): How many seconds to wait for another
+            process's write to finish before giving up. Defaults to 60.
+        wal (bool, optional): Whether to use SQLite's write-ahead log, which
+            lets readers work while another process is writing. This only
+            works when every process using the manifest is on the same host,
+            so it should be turned off when the manifest is shared between
+            machines (e.g. by sharded extraction jobs). Defaults to True.
+    """
+
+    def __init__(self, path, timeout=60, wal=True):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        journal_mode = "WAL" if wal else "DELETE"
+        self._conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    @classmethod
+    def for_study(cls, config, **kwargs):
+        """Open the manifest in the metadata folder of the config's study."""
+        return cls(os.path.join(config.get_path("meta"), MANIFEST_FILE),
+                   **kwargs)
+
+    def formats(self, series):
+        """Returns the set of formats a series has been exported to."""
+        return {row[0] for row in self._conn.execute(
+            "SELECT DISTINCT format FROM outputs WHERE series = ?", (series,)
+        )}
+
+    def sessions(self):
+        """Returns the names of the sessions that have exported series."""
+        found = set()
+        for (series,) in self._conn.execute(
+                "SELECT DISTINCT series FROM outputs"):
+            try:
+                ident, _, _, _ = scanid.parse_filename(series)
+            except scanid.ParseException:
+                continue
+            found.add(str(ident))
+        return found
+
+    def remaining(self, series, export_formats):
+        """Returns the formats from 'export_formats' with no recorded files.
+        """
+        done = self.formats(series)
+        return [fmt for fmt in export_formats if fmt not in done]
+
+    def find(self, series=None, export_format=None, uid=None):
+        """Returns a list of OutputRecords matching all of the given fields.
+        """
+        clauses = []
+        params = []
+        for column, value in (("series", series), ("format", export_format),
+                              ("uid", uid)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        query = ("SELECT series, format, path, size, checksum, uid FROM "
+                 "outputs")
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY path"
+        return [OutputRecord(*row) for row in self._conn.execute(query,
+                                                                 params)]
+
+    def add(self, series, export_format, paths, uid=None, checksum=False):
+        """
+        Record the files a series was exported to.
+
+        Args:
+            series (:obj:`str`): The datman name of the series.
+            export_format (:obj:`str`): The format the files are in.
+            paths (list): The full paths of the exported files. Paths that
+                don't exist are skipped.
+            uid (:obj:`str`, optional): The SeriesInstanceUID of the series.
+                Defaults to None.
+            checksum (bool, optional): Whether to record each file's
+                checksum. This reads every file, so it's left to
+                rebuild(). Defaults to False.
+
+        Returns:
+            int: The number of files recorded.
+        """
+        rows = []
+        for path in paths:
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                logger.debug(f"Not adding missing file {path} to manifest")
+                continue
+            rows.append((
+                os.path.abspath(path),
+                series,
+                _get_subject(series),
+                export_format,
+                size,
+                get_checksum(path) if checksum else None,
+                uid,
+                time.time()
+            ))
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, "
+                "?)", rows
+            )
+        return len(rows)
+
+    def remove(self, records):
+        """Forget the given OutputRecords (or paths)."""
+        paths = [getattr(rec, "path", rec) for rec in records]
+        with self._conn:
+            self._conn.executemany("DELETE FROM outputs WHERE path = ?",
+                                   [(path,) for path in paths])
+
+    def verify(self, checksum=False):
+        """
+        Check every recorded file against the disk.
+
+        Args:
+            checksum (bool, optional): Whether to compare checksums as well as
+                sizes. Records without a checksum are only compared by size.
+                Defaults to False.
+
+        Returns:
+            list: The OutputRecords of files that are missing or changed.
+        """
+        bad = []
+        for record in self.find():
+            try:
+                size = os.stat(record.path).st_size
+            except OSError:
+                bad.append(record)
+                continue
+            if size != record.size:
+                bad.append(record)
+            elif checksum and record.checksum and \
+                    get_checksum(record.path) != record.checksum:
+                bad.append(record)
+        return bad
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f"<datman.manifest.ProcessedManifest {self.path}>"
+
+
+def rebuild(manifest, config, export_formats=("nii", "dcm", "mnc", "nrrd"),
+            checksum=False):
+    """
+    Reconcile a manifest with the files on disk.
+
+    Records for missing or changed files are removed and any exported files
+    that aren't recorded yet are added. When checksums are requested, any
+    records that don't have one yet are given one. The study's file index
+    is used to find the exported files, so only folders that changed since
+    the index was last refreshed are listed again.
+
+    Args:
+        manifest (:obj:`ProcessedManifest`): The manifest to update.
+        config (:obj:`datman.config.config`): A config for the manifest's
+            study.
+        export_formats (tuple, optional): The formats to look for files in.
+        checksum (bool, optional): Whether to compare and record checksums.
+            Defaults to False, since reading every file is slow.
+
+    Returns:
+        tuple: The number of records removed and the number added.
+    """
+    stale = manifest.verify(checksum=checksum)
+    manifest.remove(stale)
+
+    if checksum:
+        for rec in manifest.find():
+            if rec.checksum is None:
+                manifest.add(rec.series, rec.format, [rec.path], uid=rec.uid,
+                             checksum=True)
+
+    known = {rec.path for rec in manifest.find()}
+    added = 0
+    with StudyIndex(config, folders=export_formats) as index:
+        index.refresh()
+        for export_format in export_formats:
+            found = collections.defaultdict(list)
+            for rec in index.find(folder=export_format):
+                if rec.tag is None or rec.path in known:
+                    continue
+                name = os.path.basename(rec.path)
+                found[name[:len(name) - len(rec.ext)]].append(rec.path)
+            for series, paths in found.items():
+                added += manifest.add(series, export_format, paths,
+                                      checksum=checksum)
+    return len(stale), added
+
+
+def get_checksum(path):
+    """Returns the sha256 checksum of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _get_subject(series):
+    try:
+        ident, _, _, _ = scanid.parse_filename(series)
+    except scanid.ParseException:
+        return None
+    return ident.get_full_subjectid_with_timepoint()
@@ -0,0 +1,400 @@
+"""
+A SQLite store for QC checklist and blacklist entries.
+
+Studies without a dashboard keep their QC sign offs in 'checklist.csv' and
+their blacklisted scans in 'blacklist.csv'. Every update to either file
+rewrites it completely, so many QC jobs updating one study at the same time
+are slow and can lose each other's entries. Setting 'METADATA_BACKEND' to
+'sqlite' in a study's config stores the entries in a database
+(METADATA_DB in the study's metadata folder) instead, where each update is a
+single transaction and lookups by subject are indexed.
+
+datman.utils.read_checklist, update_checklist, read_blacklist and
+update_blacklist will use the database automatically when it's configured,
+and MetadataDB.export_csv can write the entries back out in the old format
+for any tools that still need the files.
+
+This module also manages the subject metadata snapshot. This is a single
+file (SNAPSHOT_FILE in the study's metadata folder) holding a study's
+complete checklist and blacklist, along with the modification times of the
+files they were read from. datman.utils.get_subject_metadata loads it in one
+read instead of re-parsing the checklist and blacklist every time, and
+rebuilds it whenever one of those files changes.
+
+.. note::
+    By default the database uses SQLite's rollback journal, so it's safe for
+    QC jobs running on different machines to share it. If every process
+    using the database is on the same host, 'METADATA_WAL: True' turns on
+    SQLite's write-ahead log, which lets readers work while another process
+    is writing. The write-ahead log must not be used if the metadata folder
+    is shared between machines over a network file system.
+"""
+import logging
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+
+import datman.scanid as scanid
+from datman.exceptions import MetadataException
+
+logger = logging.getLogger(__name__)
+
+# The database's file name, stored in the study's 'meta' folder
+METADATA_DB = "metadata.sqlite"
+
+# The subject metadata snapshot's file name, stored in the study's 'meta'
+# folder
+SNAPSHOT_FILE = ".subject_metadata.snapshot"
+SNAPSHOT_VERSION = 1
+
+# The first SQLite version to support 'INSERT ... ON CONFLICT'
+UPSERT_VERSION = (3, 24, 0)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checklist (
+    subject TEXT PRIMARY KEY,
+    comment TEXT NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS blacklist (
+    series TEXT PRIMARY KEY,
+    subject TEXT NOT NULL,
+    session TEXT NOT NULL,
+    comment TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blacklist_subject ON blacklist (subject);
+CREATE INDEX IF NOT EXISTS blacklist_session ON blacklist (session);
+"""
+
+
+class MetadataDB(object):
+    """
+    A study's QC checklist and blacklist entries.
+
+    Args:
+        path (:obj:`str`): The full path to the database file. It will be
+            created if it doesnt exist.
+        timeout (int, optional): How many seconds to wait for another
+            process's write to finish before giving up. Defaults to 60.
+        wal (bool, optional): Whether to use SQLite's write-ahead log, which
+            lets readers work while another process is writing. This only
+            works when every process using the database is on the same host.
+            Defaults to False.
+    """
+
+    def __init__(self, path, timeout=60, wal=False):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        if wal:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        else:
+            self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.executescript(_SCHEMA)
+
+    def is_empty(self):
+        for table in ("checklist", "blacklist"):
+            if self._conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                return False
+        return True
+
+    def read_checklist(self, subject=None):
+        """
+        Returns a dictionary of subject IDs (without session) mapped to their
+        QC comments, or the comment for a single subject if one is given
+        (None if they're not in the checklist).
+        """
+        if subject:
+            row = self._conn.execute(
+                "SELECT comment FROM checklist WHERE subject = ?",
+                (_get_subject(subject),)
+            ).fetchone()
+            return row[0] if row else None
+
+        return dict(self._conn.execute(
+            "SELECT subject, comment FROM checklist ORDER BY subject"
+        ))
+
+    def update_checklist(self, entries, overwrite=True):
+        """
+        Add or update checklist entries in a single transaction.
+
+        Args:
+            entries (dict): Subject IDs mapped to their QC comment (an empty
+                string for new, unreviewed subjects).
+            overwrite (bool, optional): Whether to replace the comment of
+                subjects that are already in the checklist. Defaults to True.
+
+        Raises:
+            MetadataException: If any subject ID is invalid. No entries are
+                added in this case.
+        """
+        rows = []
+        for subject, comment in entries.items():
+            try:
+                subid = _get_subject(subject)
+            except scanid.ParseException:
+                raise MetadataException(
+                    f"Attempt to add invalid subject ID {subject} to QC "
+                    "checklist"
+                )
+            rows.append((subid, comment or ""))
+
+        with self._conn:
+            _upsert(self._conn, "checklist", ["subject", "comment"], rows,
+                    overwrite)
+
+    def read_blacklist(self, scan=None, subject=None):
+        """
+        Returns a dictionary of blacklisted scan names mapped to the reason
+        they were blacklisted, optionally restricted to one subject (with or
+        without a session number), or the comment for a single scan if one is
+        given (None if it's not blacklisted).
+        """
+        if scan:
+            row = self._conn.execute(
+                "SELECT comment FROM blacklist WHERE series = ?", (scan,)
+            ).fetchone()
+            return row[0] if row else None
+
+        query = "SELECT series, comment FROM blacklist"
+        params = ()
+        if subject:
+            try:
+                ident = scanid.parse(subject)
+            except scanid.ParseException:
+                query += " WHERE substr(series, 1, ?) = ?"
+                params = (len(subject), subject)
+            else:
+                if ident.session:
+                    query += " WHERE session = ?"
+                    params = (
+                        ident.get_full_subjectid_with_timepoint_session(),)
+                else:
+                    query += " WHERE subject = ?"
+                    params = (ident.get_full_subjectid_with_timepoint(),)
+        query += " ORDER BY series"
+        return dict(self._conn.execute(query, params))
+
+    def update_blacklist(self, entries, overwrite=True):
+        """
+        Add or update blacklist entries in a single transaction.
+
+        Args:
+            entries (dict): Scan names (without path or extension) mapped to
+                the reason for blacklisting them. Entries with an empty
+                comment are skipped.
+            overwrite (bool, optional): Whether to replace the comment of
+                scans that are already blacklisted. Defaults to True.
+
+        Raises:
+            MetadataException: If any scan name is invalid. No entries are
+                added in this case.
+        """
+        rows = []
+        for scan_name, comment in entries.items():
+            try:
+                ident, _, _, _ = scanid.parse_filename(scan_name)
+            except scanid.ParseException:
+                raise MetadataException(
+                    f"Attempt to add invalid scan name {scan_name} to "
+                    "blacklist"
+                )
+            if not comment:
+                logger.error(
+                    "Can't add blacklist entry with empty comment. "
+                    f"Skipping {scan_name}"
+                )
+                continue
+            rows.append((
+                scan_name,
+                ident.get_full_subjectid_with_timepoint(),
+                ident.get_full_subjectid_with_timepoint_session(),
+                comment,
+            ))
+
+        with self._conn:
+            _upsert(self._conn, "blacklist",
+                    ["series", "subject", "session", "comment"], rows,
+                    overwrite)
+
+    def export_csv(self, checklist_path=None, blacklist_path=None):
+        """
+        Write the entries to files in the 'checklist.csv' and 'blacklist.csv'
+        formats. Each file is replaced in a single step, so readers never see
+        a partially written file.
+        """
+        if checklist_path:
+            _replace_file(checklist_path,
+                          format_checklist(self.read_checklist()))
+        if blacklist_path:
+            _replace_file(blacklist_path,
+                          format_blacklist(self.read_blacklist()))
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f"<datman.metadata.MetadataDB {self.path}>"
+
+
+def get_stamps(sources):
+    """
+    Returns the modification time and size of each source file (or None if
+    it doesnt exist). These should be collected before the sources are read
+    so that any change made while reading them invalidates the snapshot.
+    """
+    stamps = {}
+    for path in sources:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stamps[path] = None
+        else:
+            stamps[path] = (stat.st_mtime_ns, stat.st_size)
+    return stamps
+
+
+def read_snapshot(path, sources, max_age=None):
+    """
+    Read a subject metadata snapshot.
+
+    Args:
+        path (:obj:`str`): The full path to the snapshot.
+        sources (list): The files the snapshot was built from.
+        max_age (int, optional): How many seconds the snapshot stays valid
+            for. Only needed when there are no source files to check (e.g.
+            when the metadata comes from the dashboard). Defaults to None.
+
+    Returns:
+        tuple: The checklist and blacklist dictionaries, or None if the
+        snapshot doesnt exist or is out of date.
+    """
+    try:
+        with open(path, "rb") as snapshot_file:
+            snapshot = pickle.load(snapshot_file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug(f"Ignoring unreadable metadata snapshot {path}. "
+                     f"Reason - {e}")
+        return None
+
+    if not isinstance(snapshot, dict) or \
+            snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    if snapshot["sources"] != get_stamps(sources):
+        return None
+    if max_age is not None and time.time() - snapshot["created"] > max_age:
+        return None
+    return snapshot["checklist"], snapshot["blacklist"]
+
+
+def write_snapshot(path, stamps, checklist, blacklist):
+    """
+    Save a study's checklist and blacklist to a snapshot.
+
+    Args:
+        path (:obj:`str`): The full path to write to.
+        stamps (dict): The source file stamps from get_stamps(), collected
+            before the checklist and blacklist were read.
+        checklist (dict): The study's complete checklist.
+        blacklist (dict): The study's complete blacklist.
+    """
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "created": time.time(),
+        "sources": stamps,
+        "checklist": checklist,
+        "blacklist": blacklist,
+    }
+    _replace_file(path, pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+
+
+def format_checklist(entries):
+    """Returns the lines of a 'checklist.csv' file for the given entries."""
+    return sorted(f"qc_{sub}.html {entries[sub]}\n" for sub in entries)
+
+
+def format_blacklist(entries):
+    """Returns the lines of a 'blacklist.csv' file for the given entries."""
+    lines = ["series\treason\n"]
+    lines.extend(sorted(f"{scan} {entries[scan]}\n" for scan in entries))
+    return lines
+
+
+def _get_subject(subject):
+    return scanid.parse(subject).get_full_subjectid_with_timepoint()
+
+
+def _upsert(conn, table, columns, rows, overwrite):
+    """
+    Insert rows, keeping or replacing (if 'overwrite' is set) the other
+    columns of any whose key (the first column) already exists.
+
+    SQLite only supports 'INSERT ... ON CONFLICT' from version 3.24, so older
+    versions insert what's missing and then update the existing rows.
+    """
+    names = ", ".join(columns)
+    values = ", ".join("?" * len(columns))
+    if sqlite3.sqlite_version_info >= UPSERT_VERSION:
+        query = (f"INSERT INTO {table} ({names}) VALUES ({values}) "
+                 f"ON CONFLICT ({columns[0]}) ")
+        if overwrite:
+            query += "DO UPDATE SET " + ", ".join(
+                f"{col} = excluded.{col}" for col in columns[1:]
+            )
+        else:
+            query += "DO NOTHING"
+        conn.executemany(query, rows)
+        return
+
+    conn.executemany(
+        f"INSERT OR IGNORE INTO {table} ({names}) VALUES ({values})", rows
+    )
+    if overwrite:
+        conn.executemany(
+            f"UPDATE {table} SET "
+            + ", ".join(f"{col} = ?" for col in columns[1:])
+            + f" WHERE {columns[0]} = ?",
+            [row[1:] + row[:1] for row in rows]
+        )
+
+
+def _replace_file(path, contents):
+    """
+    Replace a file in a single step. 'contents' may be bytes or a list of
+    lines.
+    """
+    dest_dir = os.path.dirname(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix=".tmp_")
+    try:
+        if isinstance(contents, bytes):
+            with os.fdopen(handle, "wb") as tmp_file:
+                tmp_file.write(contents)
+        else:
+            with os.fdopen(handle, "w") as tmp_file:
+                tmp_file.writelines(contents)
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode)
+        else:
+            os.chmod(tmp_path, 0o666 & ~_get_umask())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
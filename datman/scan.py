@@ -3,16 +3,18 @@ A class to make access to all information about a single scan easy
 and uniform.
 
 WARNING: This class currently assumes the contents of the directories
-does not change after the object is created. Certain attribute values may
+does not change after they are first read. Certain attribute values may
 become out of date if this is not true.
 
 """
-import glob
 import os
 
 import datman.scanid as scanid
 import datman.utils
 
+# The file extensions that are collected as series from each folder type
+SERIES_EXTS = {"nii": [".nii", ".nii.gz"], "dcm": [".dcm"]}
+
 
 class DatmanNamed(object):
     """
@@ -89,6 +91,11 @@ class Scan(DatmanNamed):
     May raise a ParseException if the given subject_id does not match the
     datman naming convention
 
+    The series found in the nii and dcm folders are only looked up the first
+    time they're accessed and are cached after that. Accessing
+    'niftis', 'dicoms' or their tags may raise a ParseException if any files
+    in the folder do not match the datman naming convention.
+
     """
 
     def __init__(self, subject_id, config):
@@ -111,32 +118,65 @@ class Scan(DatmanNamed):
 
         DatmanNamed.__init__(self, ident)
 
-        self.nii_path = self.__get_path("nii", config)
-        self.dcm_path = self.__get_path("dcm", config)
-        self.nrrd_path = self.__get_path("nrrd", config)
-        self.mnc_path = self.__get_path("mnc", config)
-        self.qc_path = self.__get_path("qc", config)
-        self.resource_path = self.__get_path("resources", config, session=True)
+        # Paths are found now, while the config is set to this scan's study,
+        # so that later changes to the shared config can't affect them
+        self._paths = {
+            key: self.__make_path(config, key, session=key == "resources")
+            for key in ("nii", "dcm", "nrrd", "mnc", "qc", "resources")
+        }
+        self._series = {}
+        self._tag_dicts = {}
+
+    @property
+    def nii_path(self):
+        return self._paths["nii"]
+
+    @property
+    def dcm_path(self):
+        return self._paths["dcm"]
+
+    @property
+    def nrrd_path(self):
+        return self._paths["nrrd"]
+
+    @property
+    def mnc_path(self):
+        return self._paths["mnc"]
 
-        self.niftis = self.__get_series(self.nii_path, [".nii", ".nii.gz"])
-        self.dicoms = self.__get_series(self.dcm_path, [".dcm"])
+    @property
+    def qc_path(self):
+        return self._paths["qc"]
 
-        self.__nii_dict = self.__make_dict(self.niftis)
-        self.__dcm_dict = self.__make_dict(self.dicoms)
+    @property
+    def resource_path(self):
+        return self._paths["resources"]
 
-        self.nii_tags = list(self.__nii_dict.keys())
-        self.dcm_tags = list(self.__dcm_dict.keys())
+    @property
+    def niftis(self):
+        return self.__get_series("nii")
+
+    @property
+    def dicoms(self):
+        return self.__get_series("dcm")
+
+    @property
+    def nii_tags(self):
+        return list(self.__get_tag_dict("nii").keys())
+
+    @property
+    def dcm_tags(self):
+        return list(self.__get_tag_dict("dcm").keys())
 
     def get_tagged_nii(self, tag):
         try:
-            matched_niftis = self.__nii_dict[tag]
+            matched_niftis = self.__get_tag_dict("nii")[tag]
         except KeyError:
             matched_niftis = []
         return matched_niftis
 
     def get_tagged_dcm(self, tag):
         try:
-            matched_dicoms = self.__dcm_dict[tag]
+            matched_dicoms = self.__get_tag_dict("dcm")[tag]
         except KeyError:
             matched_dicoms = []
         return matched_dicoms
@@ -152,23 +192,26 @@ class Scan(DatmanNamed):
             id_str = id_str + "_01"
         return id_str
 
-    def __get_path(self, key, config, session=False):
+    def __make_path(self, config, key, session=False):
         folder_name = self.full_id
         if session:
             folder_name = self.id_plus_session
-        path = os.path.join(config.get_path(key), folder_name)
-        return path
+        return os.path.join(config.get_path(key), folder_name)
 
-    def __get_series(self, path, ext_list):
+    def __get_series(self, path_key):
         """
         This method will generate a ParseException if any files are not named
         according to the datman naming convention.
         """
-        glob_path = os.path.join(path, "*")
+        try:
+            return self._series[path_key]
+        except KeyError:
+            pass
+
         series_list = []
         badly_named = []
-        for item in glob.glob(glob_path):
-            if datman.utils.get_extension(item) in ext_list:
+        for item in list_dir(self._paths[path_key]):
+            if datman.utils.get_extension(item) in SERIES_EXTS[path_key]:
                 try:
                     series = Series(item)
                 except datman.scanid.ParseException:
@@ -178,8 +221,19 @@ class Scan(DatmanNamed):
         if badly_named:
             message = f"File(s) misnamed: {', '.join(badly_named)}"
             raise datman.scanid.ParseException(message)
+
+        self._series[path_key] = series_list
         return series_list
 
+    def __get_tag_dict(self, path_key):
+        try:
+            return self._tag_dicts[path_key]
+        except KeyError:
+            pass
+        tag_dict = self.__make_dict(self.__get_series(path_key))
+        self._tag_dicts[path_key] = tag_dict
+        return tag_dict
+
     def __make_dict(self, series_list):
         tag_dict = {}
         for series in series_list:
@@ -195,3 +249,18 @@ class Scan(DatmanNamed):
 
     def __repr__(self):
         return f"<datman.scan.Scan: {self.full_id}>"
+
+
+def list_dir(path):
+    """
+    Returns the full path of every (non-hidden) entry in a folder, or an
+    empty list if the folder can't be read.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return [
+                entry.path for entry in entries
+                if not entry.name.startswith(".")
+            ]
+    except OSError:
+        return []
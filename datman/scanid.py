@@ -9,14 +9,29 @@ Manages name conventions and functions to ensure that IDs conform to them.
     in its native convention can always be retrieved from 'orig_id'.
 
 """
+import functools
 import os.path
 import re
 from abc import ABC, abstractmethod
 
 from datman.exceptions import ParseException
 
+# The maximum number of parsed IDs and file names to remember
+PARSE_CACHE_SIZE = 16384
 
+
+@functools.total_ordering
 class Identifier(ABC):
+    """
+    Base class for parsed subject IDs.
+
+    Identifiers are immutable, so a parsed ID can be safely shared (e.g. by
+    the cache used by :py:func:`parse`). They are also hashable and sort by
+    their datman fields.
+    """
+
+    __slots__ = ("orig_id", "study", "site", "subject", "timepoint", "session")
+
     def match(self, identifier):
         if not isinstance(identifier, str):
             raise ParseException("Must be given a string to verify ID matches")
@@ -26,6 +41,10 @@ class Identifier(ABC):
             match = self.pha_pattern.match(identifier)
         return match
 
+    def _set(self, **fields):
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
     def get_full_subjectid(self):
         return "_".join([self.study, self.site, self.subject])
 
@@ -52,6 +71,46 @@ class Identifier(ABC):
     def get_xnat_experiment_id(self):
         pass
 
+    def _key(self):
+        return (
+            self.study,
+            self.site,
+            self.subject,
+            self.timepoint,
+            self.session,
+            self.orig_id,
+            type(self).__name__,
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        self._set(**state)
+
+    def __eq__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __lt__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self._key() < other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
     def __str__(self):
         if self.session:
             return self.get_full_subjectid_with_timepoint_session()
@@ -68,6 +127,8 @@ class DatmanIdentifier(Identifier):
 
     """
 
+    __slots__ = ()
+
     scan_re = (
         "(?P<id>(?P<study>[^_]+)_"
         "(?P<site>[^_]+)_"
@@ -96,25 +157,20 @@ class DatmanIdentifier(Identifier):
         if not match:
             raise ParseException(f"Invalid Datman ID {identifier}")
 
-        self._match_groups = match
-        self.orig_id = match.group("id")
-        self.study = match.group("study")
-        self.site = match.group("site")
-        self.subject = match.group("subject")
-        self.timepoint = match.group("timepoint")
         # Bug fix: spaces were being left after the session number leading to
         # broken file name
-        self._session = match.group("session").strip()
-
-    @property
-    def session(self):
-        if self._session == "XX":
-            return ""
-        return self._session
-
-    @session.setter
-    def session(self, value):
-        self._session = value
+        session = match.group("session").strip()
+        if session == "XX":
+            session = ""
+
+        self._set(
+            orig_id=match.group("id"),
+            study=match.group("study"),
+            site=match.group("site"),
+            subject=match.group("subject"),
+            timepoint=match.group("timepoint"),
+            session=session,
+        )
 
     def get_xnat_subject_id(self):
         return self.get_full_subjectid_with_timepoint_session()
@@ -137,6 +193,9 @@ class KCNIIdentifier(Identifier):
 
     """  # noqa: E501
 
+    # The kcni_* fields hold the original (unmapped) KCNI fields
+    __slots__ = ("pha_type", "kcni_study", "kcni_site", "kcni_subject")
+
     scan_re = (
         "(?P<id>(?P<study>[A-Z]{3}[0-9]{2})_"
         "(?P<site>[A-Z]{3})_"
@@ -161,32 +220,32 @@ class KCNIIdentifier(Identifier):
         if not match:
             raise ParseException(f"Invalid KCNI ID {identifier}")
 
-        self._match_groups = match
-        self.orig_id = match.group("id")
-        self.study = get_field(match, "study", settings=settings)
-        self.site = get_field(match, "site", settings=settings)
-
-        self.subject = match.group("subject")
+        subject = match.group("subject")
         try:
-            self.pha_type = match.group("pha_type")
+            pha_type = match.group("pha_type")
         except IndexError:
             # Not a phantom
-            self.pha_type = None
-        else:
-            self.subject = f"PHA_{self.pha_type}{self.subject}"
-
-        self.timepoint = match.group("timepoint")
-        self.session = match.group("session")
+            pha_type = None
+
+        self._set(
+            orig_id=match.group("id"),
+            study=get_field(match, "study", settings=settings),
+            site=get_field(match, "site", settings=settings),
+            subject=f"PHA_{pha_type}{subject}" if pha_type else subject,
+            timepoint=match.group("timepoint"),
+            session=match.group("session"),
+            pha_type=pha_type,
+            kcni_study=match.group("study"),
+            kcni_site=match.group("site"),
+            kcni_subject=subject,
+        )
 
     def get_xnat_subject_id(self):
-        study = self._match_groups.group("study")
-        site = self._match_groups.group("site")
-        subject = self._match_groups.group("subject")
         if self.pha_type:
             subject = self.pha_type + "PHA"
         else:
-            subject = self._match_groups.group("subject")
-        return "_".join([study, site, subject])
+            subject = self.kcni_subject
+        return "_".join([self.kcni_study, self.kcni_site, subject])
 
     def get_xnat_experiment_id(self):
         return self.orig_id
@@ -367,6 +426,61 @@ def parse(identifier, settings=None):
         # ID may need to be reparsed based on settings
         identifier = identifier.orig_id
 
+    if not isinstance(identifier, str):
+        raise ParseException(f"Invalid ID - {identifier}")
+
+    ident = _parse(identifier, _freeze(settings))
+    if ident is None:
+        raise ParseException(f"Invalid ID - {identifier}")
+    return ident
+
+
+def parse_many(identifiers, settings=None, ignore_invalid=False):
+    """
+    Parse many subject IDs at once.
+
+    Args:
+        identifiers (:obj:`list`): A list of strings (or Identifiers) to parse.
+        settings (:obj:`dict`, optional): A dictionary of settings to use when
+            parsing the IDs. See :py:func:`parse` for details. Defaults to
+            None.
+        ignore_invalid (bool, optional): Whether to return None for IDs that
+            dont match a supported convention, instead of raising an
+            exception. Defaults to False.
+
+    Raises:
+        ParseException: If any identifier is invalid and ignore_invalid is
+            not set.
+
+    Returns:
+        list: A list of :obj:`Identifier` instances (or None), in the same
+            order as the input.
+    """
+    frozen = _freeze(settings)
+    parsed = []
+    for identifier in identifiers:
+        if isinstance(identifier, Identifier):
+            if not settings:
+                parsed.append(identifier)
+                continue
+            identifier = identifier.orig_id
+        ident = None
+        if isinstance(identifier, str):
+            ident = _parse(identifier, frozen)
+        if ident is None and not ignore_invalid:
+            raise ParseException(f"Invalid ID - {identifier}")
+        parsed.append(ident)
+    return parsed
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(identifier, frozen_settings):
+    """
+    Does the work for parse(). Returns None instead of raising an exception
+    for invalid IDs, so that they get cached too.
+    """
+    settings = _thaw(frozen_settings)
+
     if settings and "ID_TYPE" in settings:
         id_type = settings["ID_TYPE"]
     else:
@@ -384,7 +498,36 @@ def parse(identifier, settings=None):
         except ParseException:
             pass
 
-    raise ParseException(f"Invalid ID - {identifier}")
+    return None
+
+
+def _freeze(settings):
+    """Convert an ID settings dictionary into a hashable cache key."""
+    if not settings:
+        return None
+    return tuple(
+        sorted(
+            (key, tuple(sorted(value.items())))
+            if isinstance(value, dict)
+            else (key, value)
+            for key, value in settings.items()
+        )
+    )
+
+
+def _thaw(frozen_settings):
+    if not frozen_settings:
+        return None
+    return {
+        key: dict(value) if isinstance(value, tuple) else value
+        for key, value in frozen_settings
+    }
+
+
+def clear_cache():
+    """Forget all previously parsed IDs and file names."""
+    _parse.cache_clear()
+    _parse_filename.cache_clear()
 
 
 def parse_filename(path):
@@ -409,14 +552,30 @@ def parse_filename(path):
                 (aside from some mangling to non-alphanumeric characters).
 
     """
-    fname = os.path.basename(path)
-    match = FILENAME_PHA_PATTERN.match(fname)  # check PHA first
+    if not isinstance(path, str):
+        raise ParseException()
+    parsed = _parse_filename(os.path.basename(path))
+    if parsed is None:
+        raise ParseException()
+    return parsed
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_filename(fname):
+    """
+    Does the work for parse_filename(). Returns None instead of raising an
+    exception for invalid names, so that they get cached too.
+    """
+    match = None
+    if "_PHA_" in fname:
+        # check PHA first
+        match = FILENAME_PHA_PATTERN.match(fname)
     if not match:
         match = FILENAME_PATTERN.match(fname)
     if not match:
-        raise ParseException()
+        return None
 
-    ident = DatmanIdentifier(match.group("id"))
+    ident = _parse(match.group("id"), None)
 
     tag = match.group("tag")
     series = match.group("series")
@@ -519,15 +678,20 @@ def get_field(match, field, settings=None):
 
     """
 
+    return _map_field(match.group(field), field, settings)
+
+
+def _map_field(value, field, settings=None):
+    """Apply any user specified changes (see get_field) to a field's value.
+    """
     if not settings or field.upper() not in settings:
-        return match.group(field)
+        return value
 
     mapping = settings[field.upper()]
-    current_field = match.group(field)
     try:
-        new_field = mapping[current_field]
+        new_field = mapping[value]
     except KeyError:
-        new_field = current_field
+        new_field = value
 
     return new_field
 
@@ -576,8 +740,8 @@ def get_kcni_identifier(identifier, settings=None):
     else:
         reverse = None
 
-    study = get_field(ident._match_groups, "study", reverse)
-    site = get_field(ident._match_groups, "site", reverse)
+    study = _map_field(ident.study, "study", reverse)
+    site = _map_field(ident.site, "site", reverse)
 
     if not is_phantom(ident):
         kcni = (
@@ -0,0 +1,246 @@
+"""
+Splits a study's XNAT experiments into shards that can be extracted in
+parallel, on separate machines.
+
+Every experiment is assigned to a shard by a stable hash of its subject ID
+and timepoint, so the assignment never changes between runs or machines and
+all sessions of a timepoint (which are exported to the same folders) always
+land in the same shard. Each shard can save a summary of what it did, and
+the summaries of all shards can be merged into a single report afterwards.
+
+.. code-block:: python
+
+    index, count = parse_shard('2/8')
+    mine = [ident for ident in experiments if in_shard(ident, index, count)]
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import platform
+import time
+
+import datman.scanid as scanid
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_VERSION = 1
+
+
+def parse_shard(spec):
+    """
+    Parse a shard specification.
+
+    Args:
+        spec (:obj:`str`): A string of the form 'i/N', where i is the shard
+            number, counted from 0, and N the total number of shards.
+
+    Returns:
+        tuple: The shard number and the number of shards.
+
+    Raises:
+        ValueError: If the specification is invalid.
+    """
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard '{spec}' is not of the form 'i/N'")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard number must be between 0 and {count - 1}, "
+                         f"not {index}")
+    return index, count
+
+
+def get_shard_key(ident):
+    """Returns the part of an experiment ID that decides its shard."""
+    if isinstance(ident, str):
+        try:
+            ident = scanid.parse(ident)
+        except scanid.ParseException:
+            return ident
+    return ident.get_full_subjectid_with_timepoint()
+
+
+def get_shard(ident, count):
+    """
+    Returns the shard an experiment belongs to.
+
+    Args:
+        ident (:obj:`datman.scanid.Identifier` or :obj:`str`): The
+            experiment's ID.
+        count (int): The number of shards.
+    """
+    digest = hashlib.sha1(get_shard_key(ident).encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) % count
+
+
+def in_shard(ident, index, count):
+    return get_shard(ident, count) == index
+
+
+def make_plan(idents, count):
+    """Returns a dictionary of shard numbers mapped to their experiment IDs.
+    """
+    plan = {index: [] for index in range(count)}
+    for ident in idents:
+        plan[get_shard(ident, count)].append(str(ident))
+    for names in plan.values():
+        names.sort()
+    return plan
+
+
+def format_plan(study, plan):
+    """Returns a partition plan from make_plan() as JSON."""
+    return json.dumps({
+        "study": study,
+        "shards": len(plan),
+        "experiments": {str(index): names for index, names in plan.items()}
+    }, indent=2)
+
+
+def get_log_name(study, index, count):
+    """Returns the base name for a shard's log and summary files."""
+    return f"{study}_shard{index}of{count}"
+
+
+class LogCounter(logging.Handler):
+    """Counts the warnings and errors logged through the loggers it's added
+    to."""
+
+    def __init__(self):
+        super(LogCounter, self).__init__(level=logging.WARNING)
+        self.counts = collections.Counter()
+
+    def emit(self, record):
+        self.counts[record.levelname] += 1
+
+    def reset(self):
+        counts = dict(self.counts)
+        self.counts.clear()
+        return counts
+
+
+class ShardSummary(object):
+    """
+    A record of the experiments one shard processed.
+
+    Args:
+        study (:obj:`str`): The study being extracted.
+        index (int): The shard number.
+        count (int): The number of shards.
+    """
+
+    def __init__(self, study, index=0, count=1):
+        self.study = study
+        self.index = index
+        self.count = count
+        self.started = time.time()
+        self.finished = None
+        self.experiments = []
+        self._current = None
+
+    def start(self, name):
+        self._current = (name, time.time())
+
+    def finish(self, counts=None):
+        if not self._current:
+            return
+        name, started = self._current
+        counts = counts or {}
+        self.experiments.append({
+            "name": name,
+            "seconds": round(time.time() - started, 2),
+            "errors": counts.get("ERROR", 0) + counts.get("CRITICAL", 0),
+            "warnings": counts.get("WARNING", 0),
+        })
+        self._current = None
+
+    def save(self, path, complete=True):
+        """
+        Write the summary to a JSON file.
+
+        Args:
+            path (:obj:`str`): The file to write.
+            complete (bool, optional): Whether the shard finished processing
+                all of its experiments. Defaults to True.
+        """
+        self.finished = time.time()
+        contents = {
+            "version": SUMMARY_VERSION,
+            "study": self.study,
+            "shard": self.index,
+            "shards": self.count,
+            "host": platform.node(),
+            "started": self.started,
+            "finished": self.finished,
+            "complete": complete,
+            "experiments": self.experiments,
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(contents, fh, indent=2)
+        os.replace(tmp_path, path)
+
+
+def read_summaries(log_dir, study=None):
+    """Returns all shard summaries in a folder, optionally for one study."""
+    summaries = []
+    for name in sorted(os.listdir(log_dir)):
+        if not name.endswith(".summary.json"):
+            continue
+        try:
+            with open(os.path.join(log_dir, name)) as fh:
+                summary = json.load(fh)
+        except (OSError, ValueError) as e:
+            logger.error(f"Can't read shard summary {name}. Reason - {e}")
+            continue
+        if summary.get("version") != SUMMARY_VERSION:
+            continue
+        if study and summary["study"] != study:
+            continue
+        summaries.append(summary)
+    return summaries
+
+
+def merge_summaries(summaries):
+    """
+    Combine shard summaries into one report per study.
+
+    Returns:
+        dict: Study names mapped to a dictionary with the number of shards
+        expected, the shard numbers that reported, the shard numbers that
+        are missing, the shard numbers that stopped before finishing, the
+        number of experiments processed, the total seconds spent and the
+        names of experiments that logged errors.
+    """
+    report = {}
+    for summary in summaries:
+        study = report.setdefault(summary["study"], {
+            "shards": summary["shards"],
+            "reported": set(),
+            "missing": [],
+            "incomplete": [],
+            "experiments": 0,
+            "seconds": 0,
+            "failed": [],
+        })
+        if summary["shards"] != study["shards"]:
+            logger.warning(f"Summaries for {summary['study']} disagree on "
+                           "the number of shards. Using the largest.")
+            study["shards"] = max(study["shards"], summary["shards"])
+        study["reported"].add(summary["shard"])
+        if not summary["complete"]:
+            study["incomplete"].append(summary["shard"])
+        study["experiments"] += len(summary["experiments"])
+        study["seconds"] += summary["finished"] - summary["started"]
+        study["failed"].extend(exp["name"] for exp in summary["experiments"]
+                               if exp["errors"])
+
+    for study in report.values():
+        study["missing"] = sorted(set(range(study["shards"])) -
+                                  study["reported"])
+        study["reported"] = sorted(study["reported"])
+        study["incomplete"].sort()
+        study["failed"].sort()
+    return report
@@ -0,0 +1,271 @@
+"""
+Keeps downloads and temporary extractions from filling the disks they use.
+
+Before a transfer starts, the space it's expected to need is reserved on the
+file system it writes to. If there isn't enough free space (after the
+reservations of other transfers in the same process and a configurable
+amount of headroom) the transfer waits until there is, rather than failing
+partway through and leaving partial data behind. Temporary folders can be
+spread across several temp roots, each one being made wherever the most
+space is available.
+
+.. code-block:: python
+
+    budget = StorageBudget.for_config(config)
+    with budget.temp_directory(archive_footprint(size)) as temp:
+        ...
+    with budget.reserve(zips_path, size):
+        ...
+
+Two settings control the budget made for a study:
+
+    - TEMP_ROOTS: A folder, or list of folders, temporary folders may be
+      made in. Defaults to the system's temp folder.
+    - DISK_HEADROOM_GB: The number of GB to always leave free on every file
+      system. Defaults to 1.
+
+Reservations are estimates and are held until the transfer finishes, so
+space already written counts against both the disk and the reservation
+until then. This errs on the side of caution.
+"""
+import collections
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from datman.exceptions import StorageException, UndefinedSetting
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+# Bytes reserved by every budget in this process, by file system (device)
+_reserved = collections.Counter()
+_space_freed = threading.Condition()
+
+
+class StorageBudget(object):
+    """
+    Reserves disk space for transfers before they start.
+
+    Args:
+        temp_roots (list, optional): Folders that temporary folders may be
+            made in. Defaults to the system's temp folder.
+        headroom (int, optional): The number of bytes to always leave free on
+            every file system. Defaults to 1 GB.
+        timeout (int, optional): The number of seconds to wait for space to
+            free up before giving up. None waits forever. Defaults to 3600.
+        poll (int, optional): The number of seconds between checks of the
+            free space while waiting. Defaults to 10.
+    """
+
+    def __init__(self, temp_roots=None, headroom=GB, timeout=3600, poll=10):
+        self.temp_roots = list(temp_roots or [tempfile.gettempdir()])
+        self.headroom = headroom
+        self.timeout = timeout
+        self.poll = poll
+
+    @classmethod
+    def for_config(cls, config, **kwargs):
+        """Make a budget from a study's TEMP_ROOTS and DISK_HEADROOM_GB
+        settings."""
+        if "temp_roots" not in kwargs:
+            try:
+                roots = config.get_key("TEMP_ROOTS")
+            except UndefinedSetting:
+                roots = None
+            if isinstance(roots, str):
+                roots = [roots]
+            kwargs["temp_roots"] = roots
+        if "headroom" not in kwargs:
+            try:
+                kwargs["headroom"] = int(
+                    float(config.get_key("DISK_HEADROOM_GB")) * GB)
+            except UndefinedSetting:
+                pass
+        return cls(**kwargs)
+
+    def available(self, path):
+        """Returns the number of bytes that can still be reserved on the file
+        system holding path."""
+        with _space_freed:
+            return self._available(path)
+
+    def _available(self, path):
+        return (get_free_space(path) - _reserved[_get_device(path)] -
+                self.headroom)
+
+    @contextlib.contextmanager
+    def reserve(self, path, size):
+        """
+        Hold space on a file system while a transfer writes to it.
+
+        Args:
+            path (:obj:`str`): A file or folder the transfer writes to. It
+                doesn't need to exist yet.
+            size (int): The number of bytes to reserve.
+
+        Raises:
+            StorageException: If the space doesn't become available before
+                the budget's timeout.
+        """
+        self._acquire([path], size)
+        try:
+            yield
+        finally:
+            self._release(path, size)
+
+    @contextlib.contextmanager
+    def temp_directory(self, size, prefix="tmp", suffix=""):
+        """
+        Make a temporary folder with space reserved for its contents.
+
+        The folder is made in whichever temp root has the most space
+        available, and it's deleted (and its reservation released) when the
+        with block exits, however it exits.
+
+        Args:
+            size (int): The number of bytes to reserve.
+            prefix (:obj:`str`, optional): The start of the folder's name.
+            suffix (:obj:`str`, optional): The end of the folder's name.
+
+        Raises:
+            StorageException: If none of the temp roots has enough space
+                before the budget's timeout.
+        """
+        root = self._acquire(self.temp_roots, size)
+        try:
+            temp_dir = tempfile.mkdtemp(suffix=suffix, prefix=prefix,
+                                        dir=root)
+            try:
+                yield temp_dir
+            finally:
+                remove_folder(temp_dir)
+        finally:
+            self._release(root, size)
+
+    def _acquire(self, paths, size):
+        """Reserve space on whichever of paths has the most available,
+        waiting if none have enough. Returns the path chosen."""
+        size = size or 0
+        deadline = None if self.timeout is None else \
+            time.time() + self.timeout
+        waiting = False
+        with _space_freed:
+            while True:
+                path, available = self._most_available(paths, size)
+                if available >= size:
+                    _reserved[_get_device(path)] += size
+                    if waiting:
+                        logger.info(f"Space became available in {path}")
+                    return path
+
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise StorageException(
+                        f"Not enough space for {format_size(size)} in "
+                        f"{', '.join(paths)} after waiting {self.timeout}s. "
+                        f"Only {format_size(max(available, 0))} available.")
+                if not waiting:
+                    logger.warning(
+                        f"Waiting for {format_size(size)} to be free in "
+                        f"{', '.join(paths)}. Only "
+                        f"{format_size(max(available, 0))} available.")
+                    waiting = True
+                _space_freed.wait(self.poll if remaining is None
+                                  else min(self.poll, remaining))
+
+    def _most_available(self, paths, size):
+        best = None
+        for path in paths:
+            try:
+                total = shutil.disk_usage(_get_existing(path)).total
+                available = self._available(path)
+            except OSError as e:
+                logger.error(f"Can't check free space in {path}. "
+                             f"Reason - {e}")
+                continue
+            if size > total - self.headroom:
+                # This one will never fit, no matter how long we wait
+                continue
+            if best is None or available > best[1]:
+                best = (path, available)
+        if best is None:
+            raise StorageException(
+                f"None of {', '.join(paths)} can hold {format_size(size)}")
+        return best
+
+    def _release(self, path, size):
+        size = size or 0
+        with _space_freed:
+            device = _get_device(path)
+            _reserved[device] -= size
+            if _reserved[device] <= 0:
+                del _reserved[device]
+            _space_freed.notify_all()
+
+    def __repr__(self):
+        return (f"<datman.storage.StorageBudget "
+                f"{', '.join(self.temp_roots)}>")
+
+
+def get_free_space(path):
+    """Returns the free bytes on the file system holding path."""
+    return shutil.disk_usage(_get_existing(path)).free
+
+
+def get_folder_size(path):
+    """Returns the total size of the files beneath a folder, in bytes."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def archive_footprint(size):
+    """Returns the space needed to download an archive of files totalling
+    size bytes and unpack it."""
+    return 2 * (size or 0)
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size}B"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+
+def remove_folder(path):
+    """Delete a folder and everything in it, logging (rather than raising)
+    any failures."""
+    def log_failure(function, failed_path, exc_info):
+        logger.error(f"Failed to remove {failed_path} while cleaning up "
+                     f"{path}. Reason - {exc_info[1]}")
+
+    if os.path.exists(path):
+        shutil.rmtree(path, onerror=log_failure)
+
+
+def _get_existing(path):
+    """Returns path, or its nearest parent that exists."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def _get_device(path):
+    return os.stat(_get_existing(path)).st_dev
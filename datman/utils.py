@@ -1,34 +1,60 @@
 """
 A collection of utilities for generally munging imaging data.
 """
+import collections
+import concurrent.futures
 import contextlib
+import fcntl
 import io
 import logging
 import os
 import random
 import re
 import shutil
+import sqlite3
+import struct
 import subprocess as proc
 import sys
 import tarfile
 import tempfile
 import time
 import zipfile
+import zlib
 
 import pydicom as dcm
 import pyxnat
 
 import datman.config
 import datman.dashboard as dashboard
+import datman.metadata
 import datman.scanid as scanid
 from datman.exceptions import (
     DashboardException,
     MetadataException,
     ParseException,
+    UndefinedSetting,
 )
 
 logger = logging.getLogger(__name__)
 
+# Files with these extensions gain nothing from being deflated again
+PRECOMPRESSED_EXTS = (".nii.gz", ".gz", ".zip", ".png", ".pdf")
+
+# How many seconds a metadata snapshot built from the dashboard is used for.
+# See _read_metadata_snapshot()
+DASHBOARD_SNAPSHOT_AGE = 60
+
+# When this process last updated the dashboard's QC checklist or blacklist.
+# Dashboard snapshots built before then are ignored.
+_last_dashboard_update = 0
+
+# Parsed blacklist files, keyed by path. See _get_blacklist_index()
+_BLACKLIST_CACHE = {}
+
+_BlacklistIndex = collections.namedtuple(
+    "_BlacklistIndex", ["stamp", "entries", "subjects"]
+)
+
 
 def locate_metadata(filename, study=None, subject=None, config=None, path=None):
     if not (path or study or config or subject):
@@ -50,6 +76,80 @@ def locate_metadata(filename, study=None, subject=None, config=None, path=None):
     return file_path
 
 
+@contextlib.contextmanager
+def open_metadata_db(config):
+    """
+    Yields a MetadataDB for the study if its 'METADATA_BACKEND' setting is
+    'sqlite', or None if the study uses the default csv files.
+
+    When the database is first created it's filled with the contents of any
+    existing checklist.csv and blacklist.csv files. The database only uses
+    SQLite's write-ahead log if the study's 'METADATA_WAL' setting is True.
+    """
+    if not config or _get_metadata_backend(config) != "sqlite":
+        yield None
+        return
+
+    meta_dir = config.get_path("meta")
+    db_path = os.path.join(meta_dir, datman.metadata.METADATA_DB)
+    try:
+        wal = bool(config.get_key("METADATA_WAL"))
+    except UndefinedSetting:
+        wal = False
+    try:
+        with datman.metadata.MetadataDB(db_path, wal=wal) as db:
+            if db.is_empty():
+                _import_csv_metadata(db, meta_dir)
+            yield db
+    except sqlite3.Error as e:
+        raise MetadataException(
+            f"Failed to use metadata database {db_path}. Reason - {str(e)}"
+        )
+
+
+def _get_metadata_config(config=None, study=None):
+    """
+    Support function for the read_* and update_* metadata functions. Returns
+    the config needed to check for a metadata database, building it only if
+    one wasn't given and there's a study (or subject ID) to build it for.
+    Otherwise returns None, and locate_metadata() reports what's missing.
+    """
+    if config or not study:
+        return config
+    return datman.config.config(study=study)
+
+
+def _get_metadata_backend(config):
+    """Returns the study's 'METADATA_BACKEND' setting ('csv' by default)."""
+    try:
+        backend = config.get_key("METADATA_BACKEND").lower()
+    except UndefinedSetting:
+        return "csv"
+
+    if backend not in ("csv", "sqlite"):
+        raise MetadataException(
+            f"Unrecognized METADATA_BACKEND {backend}. Must be one of 'csv' "
+            "or 'sqlite'."
+        )
+    return backend
+
+
+def _import_csv_metadata(db, meta_dir):
+    """
+    Support function for open_metadata_db(). Copies legacy csv entries into
+    the database without replacing anything another process has added.
+    """
+    checklist_path = os.path.join(meta_dir, "checklist.csv")
+    if os.path.exists(checklist_path):
+        with open(checklist_path, "r") as checklist:
+            db.update_checklist(_parse_checklist(checklist), overwrite=False)
+
+    blacklist_path = os.path.join(meta_dir, "blacklist.csv")
+    if os.path.exists(blacklist_path):
+        with open(blacklist_path, "r") as blacklist:
+            db.update_blacklist(_parse_blacklist(blacklist), overwrite=False)
+
+
 def read_checklist(
     study=None,
     subject=None,
@@ -129,13 +229,19 @@ def read_checklist(
             "BIDS IDs may only be used if querying the dashboard database."
         )
 
+    if subject:
+        subject = ident.get_full_subjectid_with_timepoint()
+
+    if not path:
+        config = _get_metadata_config(config, subject or study)
+        with open_metadata_db(config) as db:
+            if db:
+                return db.read_checklist(subject=subject)
+
     checklist_path = locate_metadata(
         "checklist.csv", path=path, subject=subject, study=study, config=config
     )
 
-    if subject:
-        subject = ident.get_full_subjectid_with_timepoint()
-
     try:
         with open(checklist_path, "r") as checklist:
             entries = _parse_checklist(checklist, subject=subject)
@@ -197,23 +303,22 @@ def _fetch_checklist(
     if config and not study:
         study = config.study_name
 
-    db_study = dashboard.get_project(study)
     entries = {}
-    for timepoint in db_study.timepoints:
-        if timepoint.is_phantom or not len(timepoint.sessions):
+    for subject in dashboard.get_study_records(study, scans=False):
+        if not subject.sessions:
             continue
-        session = list(timepoint.sessions.values())[0]
+        session = subject.sessions[0]
         if session.signed_off:
-            comment = str(session.reviewer)
+            comment = session.reviewer
         else:
             comment = ""
         if use_bids:
-            if not timepoint.bids_name:
+            if not subject.bids_name:
                 # If bids is requested ignore subjects without a bids name
                 continue
-            str_name = timepoint.bids_name
+            str_name = subject.bids_name
         else:
-            str_name = timepoint.name
+            str_name = subject.name
         entries[str_name] = comment
 
     return entries
@@ -294,29 +399,47 @@ def update_checklist(entries, study=None, config=None, path=None):
 
     if dashboard.dash_found and not path:
         _update_qc_reviewers(entries)
+        _discard_dashboard_snapshots()
         return
 
+    if not path:
+        config = _get_metadata_config(config, study)
+        with open_metadata_db(config) as db:
+            if db:
+                db.update_checklist(entries)
+                return
+
     # No dashboard, or path was given, so update file system.
     checklist_path = locate_metadata(
         "checklist.csv", study=study, config=config, path=path
     )
-    old_entries = read_checklist(path=checklist_path)
+    with _lock_metadata(checklist_path):
+        old_entries = read_checklist(path=checklist_path)
 
-    # Merge with existing list
-    for subject in entries:
-        try:
-            ident = scanid.parse(subject)
-        except scanid.ParseException:
-            raise MetadataException(
-                f"Attempt to add invalid subject ID {subject} to QC checklist"
-            )
-        subject = ident.get_full_subjectid_with_timepoint()
-        old_entries[subject] = entries[subject]
+        # Merge with existing list
+        for subject in entries:
+            try:
+                ident = scanid.parse(subject)
+            except scanid.ParseException:
+                raise MetadataException(
+                    f"Attempt to add invalid subject ID {subject} to QC "
+                    "checklist"
+                )
+            old_entries[ident.get_full_subjectid_with_timepoint()] = \
+                entries[subject]
+
+        lines = datman.metadata.format_checklist(old_entries)
+        write_metadata(lines, checklist_path)
 
-    # Reformat to expected checklist line format
-    lines = [f"qc_{sub}.html {old_entries[sub]}\n" for sub in old_entries]
 
-    write_metadata(sorted(lines), checklist_path)
+def _discard_dashboard_snapshots():
+    """
+    Support function for update_checklist() and update_blacklist(). Stops
+    this process from using any dashboard metadata snapshot that was built
+    before its latest update.
+    """
+    global _last_dashboard_update
+    _last_dashboard_update = time.time()
 
 
 def _update_qc_reviewers(entries):
@@ -414,18 +537,66 @@ def read_blacklist(
     else:
         tmp_sub = subject
 
+    if not path:
+        config = _get_metadata_config(config, tmp_sub or study)
+        with open_metadata_db(config) as db:
+            if db:
+                return db.read_blacklist(scan=scan, subject=subject)
+
     blacklist_path = locate_metadata(
         "blacklist.csv", study=study, subject=tmp_sub, config=config, path=path
     )
     try:
-        with open(blacklist_path, "r") as blacklist:
-            entries = _parse_blacklist(blacklist, scan=scan, subject=subject)
+        index = _get_blacklist_index(blacklist_path)
     except Exception as e:
         raise MetadataException(
             f"Failed to read checklist file {blacklist_path}. Reason - {str(e)}"
         )
 
-    return entries
+    if scan:
+        return index.entries.get(scan)
+
+    if not subject:
+        return dict(index.entries)
+
+    if subject in index.subjects:
+        scans = index.subjects[subject]
+    else:
+        scans = [name for name in index.entries if name.startswith(subject)]
+    return {name: index.entries[name] for name in scans}
+
+
+def _get_blacklist_index(blacklist_path):
+    """
+    Helper function for 'read_blacklist()'. Returns the parsed contents of a
+    blacklist file, with the scan names grouped by subject ID (with and
+    without session) for fast look ups.
+
+    The result is kept in memory until the file's modification time or size
+    changes, so repeated look ups only need to stat the file.
+    """
+    stat = os.stat(blacklist_path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    index = _BLACKLIST_CACHE.get(blacklist_path)
+    if index and index.stamp == stamp:
+        return index
+
+    with open(blacklist_path, "r") as blacklist:
+        entries = _parse_blacklist(blacklist)
+
+    subjects = {}
+    for scan_name in entries:
+        ident, _, _, _ = scanid.parse_filename(scan_name)
+        for subid in {
+            ident.get_full_subjectid_with_timepoint(),
+            ident.get_full_subjectid_with_timepoint_session(),
+        }:
+            subjects.setdefault(subid, []).append(scan_name)
+
+    index = _BlacklistIndex(stamp, entries, subjects)
+    _BLACKLIST_CACHE[blacklist_path] = index
+    return index
 
 
 def _fetch_blacklist(
@@ -546,32 +717,40 @@ def update_blacklist(entries, study=None, config=None, path=None):
 
     if dashboard.dash_found and not path:
         _update_scan_checklist(entries)
+        _discard_dashboard_snapshots()
         return
 
+    if not path:
+        config = _get_metadata_config(config, study)
+        with open_metadata_db(config) as db:
+            if db:
+                db.update_blacklist(entries)
+                return
+
     blacklist_path = locate_metadata(
         "blacklist.csv", study=study, config=config, path=path
     )
-    old_entries = read_blacklist(path=blacklist_path)
+    with _lock_metadata(blacklist_path):
+        old_entries = read_blacklist(path=blacklist_path)
 
-    for scan_name in entries:
-        try:
-            scanid.parse_filename(scan_name)
-        except scanid.ParseException:
-            raise MetadataException(
-                f"Attempt to add invalid scan name {scan_name} to blacklist"
-            )
-        if not entries[scan_name]:
-            logger.error(
-                "Can't add blacklist entry with empty comment. "
-                f"Skipping {scan_name}"
-            )
-            continue
-        old_entries[scan_name] = entries[scan_name]
+        for scan_name in entries:
+            try:
+                scanid.parse_filename(scan_name)
+            except scanid.ParseException:
+                raise MetadataException(
+                    f"Attempt to add invalid scan name {scan_name} to "
+                    "blacklist"
+                )
+            if not entries[scan_name]:
+                logger.error(
+                    "Can't add blacklist entry with empty comment. "
+                    f"Skipping {scan_name}"
+                )
+                continue
+            old_entries[scan_name] = entries[scan_name]
 
-    lines = [f"{sub} {old_entries[sub]}\n" for sub in old_entries]
-    new_list = ["series\treason\n"]
-    new_list.extend(sorted(lines))
-    write_metadata(new_list, blacklist_path)
+        write_metadata(datman.metadata.format_blacklist(old_entries),
+                       blacklist_path)
 
 
 def _update_scan_checklist(entries):
@@ -599,6 +778,23 @@ def _update_scan_checklist(entries):
         )
 
 
+@contextlib.contextmanager
+def _lock_metadata(path):
+    """
+    Hold an exclusive lock on a metadata file while it's read and rewritten,
+    so that concurrent updates dont overwrite each other's entries.
+    """
+    lock_path = os.path.join(
+        os.path.dirname(path), "." + os.path.basename(path) + ".lock"
+    )
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 def write_metadata(lines, path, retry=3):
     """
     Repeatedly attempts to write lines to <path>. The destination file
@@ -620,7 +816,8 @@ def write_metadata(lines, path, retry=3):
         write_metadata(lines, path, retry=retry - 1)
 
 
-def get_subject_metadata(config=None, study=None, allow_partial=False):
+def get_subject_metadata(config=None, study=None, allow_partial=False,
+                         use_snapshot=True):
     """Returns all QC'd session IDs mapped to any blacklisted scans they have
 
     This will collect and organize all checklist and blacklist data for a
@@ -639,6 +836,12 @@ def get_subject_metadata(config=None, study=None, allow_partial=False):
         allow_partial (bool, optional): Whether to include blacklist entries
             if the subject has not been fully QC'd (i.e. if they dont have
             a completed checklist entry yet). Defaults to False.
+        use_snapshot (bool, optional): Whether to read the checklist and
+            blacklist from the study's metadata snapshot, rebuilding it if
+            they've changed (See datman.metadata). A snapshot of dashboard
+            metadata can't detect changes made by other processes, so it may
+            be up to DASHBOARD_SNAPSHOT_AGE seconds out of date. Use False
+            when the latest entries are needed. Defaults to True.
 
     Returns:
         dict: A dictionary with any QC'd subject ID mapped to a list of
@@ -653,8 +856,11 @@ def get_subject_metadata(config=None, study=None, allow_partial=False):
             )
         config = datman.config.config(study=study)
 
-    checklist = read_checklist(config=config)
-    blacklist = read_blacklist(config=config)
+    if use_snapshot:
+        checklist, blacklist = _read_metadata_snapshot(config)
+    else:
+        checklist = read_checklist(config=config)
+        blacklist = read_blacklist(config=config)
 
     all_qc = {subid: [] for subid in checklist if checklist[subid]}
     for bl_entry in blacklist:
@@ -682,6 +888,50 @@ def get_subject_metadata(config=None, study=None, allow_partial=False):
     return all_qc
 
 
+def _read_metadata_snapshot(config):
+    """
+    Support function for get_subject_metadata(). Returns a study's complete
+    checklist and blacklist from its snapshot, rebuilding it first if it's
+    out of date.
+
+    Metadata from the dashboard has no files to check for changes, so its
+    snapshot is instead rebuilt once it's DASHBOARD_SNAPSHOT_AGE seconds old,
+    or if this process has updated the dashboard since it was built.
+    """
+    meta_dir = config.get_path("meta")
+    snapshot_path = os.path.join(meta_dir, datman.metadata.SNAPSHOT_FILE)
+
+    max_age = None
+    if dashboard.dash_found:
+        sources = []
+        max_age = min(DASHBOARD_SNAPSHOT_AGE,
+                      time.time() - _last_dashboard_update)
+    elif _get_metadata_backend(config) == "sqlite":
+        db_path = os.path.join(meta_dir, datman.metadata.METADATA_DB)
+        sources = [db_path, db_path + "-wal"]
+    else:
+        sources = [
+            os.path.join(meta_dir, "checklist.csv"),
+            os.path.join(meta_dir, "blacklist.csv"),
+        ]
+
+    snapshot = datman.metadata.read_snapshot(snapshot_path, sources, max_age)
+    if snapshot:
+        return snapshot
+
+    stamps = datman.metadata.get_stamps(sources)
+    checklist = read_checklist(config=config)
+    blacklist = read_blacklist(config=config)
+    try:
+        datman.metadata.write_snapshot(
+            snapshot_path, stamps, checklist, blacklist
+        )
+    except OSError as e:
+        logger.debug(f"Can't save metadata snapshot {snapshot_path}. "
+                     f"Reason - {e}")
+    return checklist, blacklist
+
+
 def get_extension(path):
     """
     Get the filename extension on this path.
@@ -1306,18 +1556,257 @@ def is_dicom(fileobj):
         return False
 
 
-def make_zip(source_dir, dest_zip):
-    # Can't use shutil.make_archive here because for python 2.7 it fails on
-    # large zip files (seemingly > 2GB) and zips with more than about 65000
-    # files. Soooo, doing it the hard way. Can change this if we ever move to
-    # py3
-    with zipfile.ZipFile(
-        dest_zip, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True
-    ) as zip_handle:
-        # We want this to use 'w' flag, since it should overwrite any existing
-        # zip of the same name
-        for current_dir, folders, files in os.walk(source_dir):
-            for item in files:
-                item_path = os.path.join(current_dir, item)
-                archive_path = item_path.replace(source_dir + "/", "")
-                zip_handle.write(item_path, archive_path)
+def make_zip(source_dir, dest_zip, compress_level=6, workers=None,
+             use_processes=False, max_buffer=256 * 1024 ** 2):
+    """Zip the contents of a folder, compressing members in parallel.
+
+    Files are compressed by a pool of workers and written to the archive
+    in a fixed (sorted) order so the output is deterministic. Files that are
+    already compressed (see PRECOMPRESSED_EXTS) are stored as-is instead of
+    being deflated a second time. Any existing file at dest_zip will be
+    overwritten.
+
+    Args:
+        source_dir (:obj:`str`): The folder to archive.
+        dest_zip (:obj:`str`): The full path of the zip file to create.
+        compress_level (int, optional): The zlib compression level (0-9)
+            to deflate members with. Defaults to 6.
+        workers (int, optional): The number of compression workers to use.
+            Defaults to the number of CPUs available.
+        use_processes (bool, optional): Whether to compress in a process pool
+            instead of a thread pool. zlib releases the GIL while compressing
+            so threads are usually enough. Defaults to False.
+        max_buffer (int, optional): The most bytes of file contents to have
+            workers compress ahead of the writer. Files larger than this are
+            compressed by the writer as they're streamed into the archive.
+            Defaults to 256MB.
+    """
+    members = []
+    for current_dir, folders, files in os.walk(source_dir):
+        folders.sort()
+        for item in sorted(files):
+            item_path = os.path.join(current_dir, item)
+            members.append((item_path, os.path.relpath(item_path, source_dir)))
+
+    if not workers:
+        workers = os.cpu_count() or 1
+
+    if use_processes:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    # We want this to use 'w' flag, since it should overwrite any existing
+    # zip of the same name
+    with pool, open(dest_zip, "wb") as output:
+        zip_writer = _ZipWriter(output)
+        pending = collections.deque()
+        buffered = 0
+        for item_path, archive_path in members:
+            size = os.path.getsize(item_path)
+            if size > max_buffer:
+                size = 0
+                future = None
+            else:
+                # Write out earlier members until there's room for this one
+                while pending and buffered + size > max_buffer:
+                    buffered -= _write_member(zip_writer, compress_level,
+                                              *pending.popleft())
+                future = pool.submit(_compress_member, item_path,
+                                     compress_level)
+            pending.append((item_path, archive_path, size, future))
+            buffered += size
+        while pending:
+            _write_member(zip_writer, compress_level, *pending.popleft())
+        zip_writer.close()
+
+
+def _get_compress_type(path):
+    if path.lower().endswith(PRECOMPRESSED_EXTS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _compress_member(path, compress_level):
+    """Read a file and deflate it, unless it's already compressed.
+
+    Returns the (possibly compressed) contents, the CRC of the original
+    contents, the original size and the zip compression type used.
+    """
+    with open(path, "rb") as fh:
+        data = fh.read()
+    crc = zlib.crc32(data)
+    size = len(data)
+    compress_type = _get_compress_type(path)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return data, crc, size, compress_type
+
+
+def _write_member(zip_writer, compress_level, item_path, archive_path, size,
+                  future):
+    """Add a single member to the archive.
+
+    Members that weren't compressed by a worker are compressed while they're
+    streamed in.
+
+    Returns:
+        int: The number of buffered bytes freed.
+    """
+    zinfo = zipfile.ZipInfo.from_file(item_path, archive_path)
+    if future is None:
+        with open(item_path, "rb") as source:
+            zip_writer.write_stream(zinfo, source,
+                                    _get_compress_type(item_path),
+                                    compress_level)
+        return size
+    zip_writer.write(zinfo, *future.result())
+    return size
+
+
+# Sizes, offsets and member counts from these values up need the ZIP64
+# extensions. The fields they don't fit in are set to a marker instead.
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+_ZIP64_MARKER = 0xFFFFFFFF
+_ZIP64_COUNT_MARKER = 0xFFFF
+
+
+class _ZipWriter(object):
+    """
+    Writes a zip archive from members that have already been compressed.
+
+    zipfile can only add members by compressing them itself, so the records
+    of the archive (as described in PKWARE's APPNOTE.TXT) are written here.
+    Only what make_zip() needs is supported: stored and deflated members,
+    with the ZIP64 extensions for large members and archives.
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self._entries = []
+
+    def write(self, zinfo, data, crc, file_size, compress_type):
+        """Add a member whose data has already been compressed."""
+        offset = self.fh.tell()
+        self.fh.write(self._local_header(zinfo, compress_type, crc,
+                                         len(data), file_size))
+        self.fh.write(data)
+        self._entries.append((zinfo, compress_type, crc, len(data),
+                              file_size, offset))
+
+    def write_stream(self, zinfo, source, compress_type, compress_level,
+                     chunk_size=1024 ** 2):
+        """Compress and add a member read from an open file."""
+        offset = self.fh.tell()
+        # The sizes aren't known yet, so the header is written again after
+        # the data. It always has room for ZIP64 sizes so it won't change
+        # length.
+        self.fh.write(self._local_header(zinfo, compress_type, 0, 0, 0,
+                                         zip64=True))
+        compressor = None
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+        crc = file_size = compress_size = 0
+        for chunk in iter(lambda: source.read(chunk_size), b""):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            compress_size += len(chunk)
+            self.fh.write(chunk)
+        if compressor:
+            chunk = compressor.flush()
+            compress_size += len(chunk)
+            self.fh.write(chunk)
+        end = self.fh.tell()
+        self.fh.seek(offset)
+        self.fh.write(self._local_header(zinfo, compress_type, crc,
+                                         compress_size, file_size,
+                                         zip64=True))
+        self.fh.seek(end)
+        self._entries.append((zinfo, compress_type, crc, compress_size,
+                              file_size, offset))
+
+    def close(self):
+        """Write the central directory. No members can be added after."""
+        cd_offset = self.fh.tell()
+        for entry in self._entries:
+            self.fh.write(self._central_header(*entry))
+        cd_size = self.fh.tell() - cd_offset
+        count = len(self._entries)
+
+        if (count >= ZIP64_COUNT_LIMIT or cd_size >= ZIP64_LIMIT or
+                cd_offset >= ZIP64_LIMIT):
+            zip64_offset = self.fh.tell()
+            self.fh.write(struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45,
+                                      0, 0, count, count, cd_size,
+                                      cd_offset))
+            self.fh.write(struct.pack("<IIQI", 0x07064B50, 0, zip64_offset,
+                                      1))
+            count = _ZIP64_COUNT_MARKER
+            cd_size = cd_offset = _ZIP64_MARKER
+        self.fh.write(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, count, count,
+                                  cd_size, cd_offset, 0))
+
+    def _local_header(self, zinfo, compress_type, crc, compress_size,
+                      file_size, zip64=None):
+        if zip64 is None:
+            zip64 = max(file_size, compress_size) >= ZIP64_LIMIT
+        extra = b""
+        version = 20
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, file_size, compress_size)
+            file_size = compress_size = _ZIP64_MARKER
+            version = 45
+        name, flags = _encode_zip_name(zinfo.filename)
+        dos_date, dos_time = _get_dos_date_time(zinfo.date_time)
+        return struct.pack(
+            "<IHHHHHIIIHH", 0x04034B50, version, flags, compress_type,
+            dos_time, dos_date, crc, compress_size, file_size, len(name),
+            len(extra)
+        ) + name + extra
+
+    def _central_header(self, zinfo, compress_type, crc, compress_size,
+                        file_size, offset):
+        zip64_fields = []
+        if file_size >= ZIP64_LIMIT:
+            zip64_fields.append(file_size)
+            file_size = _ZIP64_MARKER
+        if compress_size >= ZIP64_LIMIT:
+            zip64_fields.append(compress_size)
+            compress_size = _ZIP64_MARKER
+        if offset >= ZIP64_LIMIT:
+            zip64_fields.append(offset)
+            offset = _ZIP64_MARKER
+        extra = b""
+        version = 20
+        if zip64_fields:
+            extra = struct.pack(f"<HH{len(zip64_fields)}Q", 1,
+                                8 * len(zip64_fields), *zip64_fields)
+            version = 45
+        name, flags = _encode_zip_name(zinfo.filename)
+        dos_date, dos_time = _get_dos_date_time(zinfo.date_time)
+        return struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | version, version,
+            flags, compress_type, dos_time, dos_date, crc, compress_size,
+            file_size, len(name), len(extra), 0, 0, 0, zinfo.external_attr,
+            offset
+        ) + name + extra
+
+
+def _encode_zip_name(name):
+    """Returns a member name's bytes and the flags needed for them."""
+    try:
+        return name.encode("ascii"), 0
+    except UnicodeEncodeError:
+        # Bit 11 marks names encoded with UTF-8
+        return name.encode("utf-8"), 0x800
+
+
+def _get_dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    dos_date = (year - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+    return dos_date, dos_time
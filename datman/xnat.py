@@ -13,6 +13,7 @@ from xml.etree import ElementTree
 
 import requests
 
+import datman.config
 from datman.exceptions import ExportException, UndefinedSetting, XnatException
 
 logger = logging.getLogger(__name__)
@@ -423,6 +424,26 @@ class xnat(object):
         Returns:
             list: A list of string experiment IDs belonging to 'subject'.
         """
+        return [
+            item.get("label")
+            for item in self.get_experiment_listing(project, subject)
+        ]
+
+    def get_experiment_listing(self, project, subject=""):
+        """Retrieve XNAT's listing of the experiments in a project.
+
+        Args:
+            project (:obj:`str`): An XNAT project ID.
+            subject (:obj:`str`, optional): An existing XNAT subject within
+                'project' to restrict the search to. Defaults to ''.
+
+        Raises:
+            XnatException: If server/API access fails.
+
+        Returns:
+            list: A dictionary for each experiment, holding its 'label',
+            'insert_date' (when it was uploaded) and other details.
+        """
         logger.debug(
             f"Querying XNAT server {self.server} for experiment IDs for "
             f"subject {subject} in project {project}"
@@ -447,7 +468,7 @@ class xnat(object):
         if not result:
             return []
 
-        return [item.get("label") for item in result["ResultSet"]["Result"]]
+        return result["ResultSet"]["Result"]
 
     def get_experiment(self, project, subject_id, exper_id, create=False):
         """Get an experiment from the XNAT server.
@@ -742,6 +763,100 @@ class xnat(object):
             err.session = experiment
             raise err
 
+    def put_dicoms_async(
+        self, project, subject, experiment, filename, retries=3
+    ):
+        """Upload an archive of dicoms to XNAT's prearchive.
+
+        Unlike put_dicoms, this returns as soon as XNAT has received the
+        archive instead of waiting for the session to be built and archived.
+        The session's progress can be followed with get_prearchive_status
+        and it can be archived with archive_prearchive_session once it's
+        ready.
+
+        Returns:
+            str: The path of the session in the prearchive (e.g.
+            '/data/prearchive/projects/<project>/<timestamp>/<session>').
+        """
+        headers = {"Content-Type": "application/zip"}
+
+        upload_url = (
+            f"{self.server}/data/services/import?project={project}"
+            f"&subject={subject}&session={experiment}&overwrite=delete"
+            f"&dest=/prearchive/projects/{project}&inbody=true"
+        )
+
+        try:
+            with open(filename, "rb") as data:
+                result = self._make_xnat_post(upload_url, data, retries,
+                                              headers)
+        except XnatException as e:
+            e.study = project
+            e.session = experiment
+            raise e
+        except IOError as e:
+            logger.error(
+                f"Failed to open file: {filename} with excuse: {e.strerror}"
+            )
+            err = XnatException(f"Error in file: {filename}")
+            err.study = project
+            err.session = experiment
+            raise err
+        except requests.exceptions.RequestException:
+            err = XnatException(f"Error uploading data with url: {upload_url}")
+            err.study = project
+            err.session = experiment
+            raise err
+
+        if isinstance(result, bytes):
+            result = result.decode("utf-8", errors="replace")
+        prearchive_path = (result or "").strip()
+        if not prearchive_path.startswith("/"):
+            err = XnatException(
+                f"XNAT did not return a prearchive path for {filename}. "
+                f"Received: {prearchive_path}"
+            )
+            err.study = project
+            err.session = experiment
+            raise err
+        return urllib.parse.urlparse(prearchive_path).path
+
+    def get_prearchive_status(self, project, prearchive_path):
+        """Get the status of a session in a project's prearchive.
+
+        Args:
+            project (:obj:`str`): The XNAT project the session was uploaded
+                to.
+            prearchive_path (:obj:`str`): The session's path, as returned by
+                put_dicoms_async.
+
+        Returns:
+            str: XNAT's status for the session (e.g. 'RECEIVING', 'BUILDING',
+            'READY', 'ERROR' or 'CONFLICT'), or None if it's no longer in the
+            prearchive.
+        """
+        url = f"{self.server}/data/prearchive/projects/{project}?format=json"
+        try:
+            result = self._make_xnat_query(url)
+        except Exception as e:
+            raise XnatException(
+                f"Failed to query prearchive of {project}. Reason - {e}"
+            )
+        if not result:
+            return None
+        for entry in result["ResultSet"]["Result"]:
+            if entry.get("url", "").rstrip("/") == prearchive_path.rstrip("/"):
+                return entry.get("status")
+        return None
+
+    def archive_prearchive_session(self, prearchive_path, retries=3):
+        """Move a session from the prearchive into the archive."""
+        url = (
+            f"{self.server}/data/services/archive?src={prearchive_path}"
+            "&overwrite=delete"
+        )
+        self._make_xnat_post(url, None, retries)
+
     def get_dicom(
         self, project, session, experiment, scan, filename=None, retries=3
     ):
@@ -777,6 +892,43 @@ class xnat(object):
             err.session = session
             raise err
 
+    def get_dicoms(
+        self, project, session, experiment, scans, filename=None, retries=3
+    ):
+        """Downloads the dicoms for several scans in a single zip file.
+
+        This saves XNAT from building a separate archive for every scan. Each
+        scan's files are stored under a 'scans/<scan ID>-<scan type>' folder
+        in the zip file (see datman.extract.split_dicom_archive).
+
+        If filename is not specified creates a temporary file and returns the
+        path to that, user needs to be responsible for cleaning up any
+        created tempfiles"""
+        url = (
+            f"{self.server}/data/archive/projects/{project}/"
+            f"subjects/{session}/experiments/{experiment}/"
+            f"scans/{','.join(scans)}/resources/DICOM/files?format=zip"
+        )
+
+        if not filename:
+            handle, filename = tempfile.mkstemp(prefix="dm2_xnat_extract_")
+            os.close(handle)
+        try:
+            self._get_xnat_stream(url, filename, retries)
+            return filename
+        except Exception:
+            try:
+                os.remove(filename)
+            except OSError as e:
+                logger.warning(
+                    f"Failed to delete tempfile: {filename} with "
+                    f"excuse: {str(e)}"
+                )
+            err = XnatException(f"Failed getting dicoms with url: {url}")
+            err.study = project
+            err.session = session
+            raise err
+
     def put_resource(
         self, project, subject, experiment, filename, data, folder, retries=3
     ):
@@ -1309,6 +1461,8 @@ class XNATExperiment(XNATObject):
         # Misc - basically just OPT CU1 needs this
         self.misc_resource_IDs = self._get_other_resource_IDs()
 
+        self.size = self._get_size()
+
     def _get_contents(self, data_type):
         children = self.raw_json.get("children", [])
 
@@ -1329,6 +1483,23 @@ class XNATExperiment(XNATObject):
             )
         return xnat_scans
 
+    def _get_size(self):
+        """Returns the total size of the experiment's scan and resource
+        files in XNAT's catalogs, in bytes (or 0 if it's unknown)."""
+        items = [item for scan in self.scans
+                 for child in scan.raw_json.get("children", [])
+                 if child.get("field") == "file"
+                 for item in child.get("items", [])]
+        for resources in self.resource_files:
+            items.extend(resources)
+        size = 0
+        for item in items:
+            try:
+                size += int(item.get("data_fields", {}).get("file_size") or 0)
+            except (TypeError, ValueError):
+                pass
+        return size
+
     def _get_scan_UIDs(self):
         return [scan.uid for scan in self.scans]
 
@@ -1568,6 +1739,7 @@ class XNATScan(XNATObject):
         self.image_type = self._get_field("parameters/imageType")
         self.multiecho = self.is_multiecho()
         self.description = self._set_description()
+        self.size = self._get_dicom_size()
 
     def _set_description(self):
         series_descr = self._get_field("series_description")
@@ -1575,6 +1747,21 @@ class XNATScan(XNATObject):
             return series_descr
         return self._get_field("type")
 
+    def _get_dicom_size(self):
+        """Returns the size of the scan's DICOM files in XNAT's catalog, in
+        bytes (or 0 if it's unknown)."""
+        size = 0
+        for child in self.raw_json.get("children", []):
+            for item in child.get("items", []):
+                fields = item.get("data_fields", {})
+                if fields.get("label") != "DICOM":
+                    continue
+                try:
+                    size += int(fields.get("file_size") or 0)
+                except (TypeError, ValueError):
+                    pass
+        return size
+
     def is_multiecho(self):
         try:
             child = self.raw_json["children"][0]["items"][0]
@@ -1605,13 +1792,22 @@ class XNATScan(XNATObject):
         return False
 
     def set_tag(self, tag_map):
-        matches = {}
-        for tag, pattern in tag_map.items():
-            regex = pattern["SeriesDescription"]
-            if isinstance(regex, list):
-                regex = "|".join(regex)
-            if re.search(regex, self.description, re.IGNORECASE):
-                matches[tag] = pattern
+        """
+        Find the tags that match this scan.
+
+        Args:
+            tag_map (:obj:`datman.config.TagMatcher` or dict): A matcher for
+                the study's tags (from TagInfo.matcher) or a dictionary of
+                tags mapped to their 'Pattern' settings. A matcher should be
+                used when many scans are tagged, so the patterns are only
+                compiled once.
+
+        Returns:
+            dict: The matching tags mapped to their 'Pattern' settings.
+        """
+        if not isinstance(tag_map, datman.config.TagMatcher):
+            tag_map = datman.config.TagMatcher(tag_map)
+        matches = tag_map.match(self.description)
 
         if len(matches) == 1 or (len(matches) == 2 and self.multiecho):
             self.tags = list(matches.keys())
@@ -1620,10 +1816,7 @@ class XNATScan(XNATObject):
 
     def _set_fmap_tag(self, tag_map, matches):
         try:
-            for tag, pattern in tag_map.items():
-                if tag in matches:
-                    if not re.search(pattern["ImageType"], self.image_type):
-                        del matches[tag]
+            matches = tag_map.filter_image_type(matches, self.image_type)
         except Exception:
             matches = {}
 
@@ -0,0 +1,188 @@
+import fcntl
+import json
+import os
+
+import pytest
+from mock import patch
+
+import datman.extract.checkpoint as checkpoint
+
+
+@pytest.fixture
+def folders(tmp_path):
+    meta = tmp_path / "meta"
+    target = tmp_path / "nii"
+    meta.mkdir()
+    target.mkdir()
+    return str(meta), str(target)
+
+
+def _write_journal(meta, entries):
+    path = os.path.join(meta, checkpoint.JOURNAL_PREFIX + "host_1.jsonl")
+    with open(path, "w") as fh:
+        for staging, state in entries:
+            fh.write(json.dumps({"staging": staging, "state": state}) + "\n")
+        # A line cut off when the run was killed
+        fh.write('{"staging": ')
+    return path
+
+
+def _make_staging(target, name, files):
+    staging = os.path.join(target, checkpoint.STAGING_PREFIX + name)
+    os.makedirs(staging)
+    for fname in files:
+        with open(os.path.join(staging, fname), "w") as fh:
+            fh.write(fname)
+    return staging
+
+
+def test_promote_moves_outputs_and_removes_journal(folders):
+    meta, target = folders
+
+    with checkpoint.CheckpointJournal(meta) as journal:
+        staging = journal.stage(target, "SERIES.nii")
+        assert os.path.basename(staging).startswith(checkpoint.STAGING_PREFIX)
+        with open(os.path.join(staging, "SERIES.nii.gz"), "w") as fh:
+            fh.write("data")
+
+        moved = journal.promote(staging, target)
+
+    assert moved == [os.path.join(target, "SERIES.nii.gz")]
+    assert os.listdir(target) == ["SERIES.nii.gz"]
+    assert os.listdir(meta) == []
+
+
+def test_promote_doesnt_overwrite_existing_outputs(folders):
+    meta, target = folders
+    existing = os.path.join(target, "SERIES.nii.gz")
+    with open(existing, "w") as fh:
+        fh.write("original")
+
+    with checkpoint.CheckpointJournal(meta) as journal:
+        staging = journal.stage(target, "SERIES.nii")
+        with open(os.path.join(staging, "SERIES.nii.gz"), "w") as fh:
+            fh.write("new")
+        assert journal.promote(staging, target) == []
+
+    with open(existing) as fh:
+        assert fh.read() == "original"
+    assert os.listdir(target) == ["SERIES.nii.gz"]
+
+
+def test_recover_removes_unfinished_exports(folders):
+    meta, target = folders
+    staging = _make_staging(target, "SERIES.nii_1", ["SERIES.nii.gz"])
+    _write_journal(meta, [(staging, checkpoint.STARTED)])
+
+    assert checkpoint.recover(meta) == 1
+
+    assert os.listdir(target) == []
+    assert os.listdir(meta) == []
+
+
+def test_recover_completes_interrupted_promotion(folders):
+    meta, target = folders
+    staging = _make_staging(target, "SERIES.nii_1", ["SERIES.json"])
+    with open(os.path.join(target, "SERIES.nii.gz"), "w") as fh:
+        fh.write("already moved")
+    _write_journal(meta, [(staging, checkpoint.STARTED),
+                          (staging, checkpoint.PROMOTING)])
+
+    assert checkpoint.recover(meta) == 1
+
+    assert sorted(os.listdir(target)) == ["SERIES.json", "SERIES.nii.gz"]
+
+
+def test_recover_ignores_finished_exports(folders):
+    meta, target = folders
+    staging = os.path.join(target, checkpoint.STAGING_PREFIX + "SERIES")
+    _write_journal(meta, [(staging, checkpoint.STARTED),
+                          (staging, checkpoint.FINISHED)])
+
+    assert checkpoint.recover(meta) == 0
+    assert os.listdir(meta) == []
+
+
+def test_recover_skips_journals_of_running_extractions(folders):
+    meta, target = folders
+
+    with checkpoint.CheckpointJournal(meta) as journal:
+        staging = journal.stage(target, "SERIES.nii")
+
+        assert checkpoint.recover(meta) == 0
+        assert os.path.isdir(staging)
+        assert os.path.exists(journal.path)
+
+        journal.discard(staging)
+
+
+def test_new_journal_never_taken_for_an_abandoned_one(folders):
+    meta, target = folders
+    flock = fcntl.flock
+    recovered = []
+
+    def lock_after_other_run_recovers(fh, operation):
+        if not recovered:
+            # Another run starts between this one making and locking its
+            # journal
+            recovered.append(None)
+            recovered[0] = checkpoint.recover(meta)
+        return flock(fh, operation)
+
+    with patch('datman.extract.checkpoint.fcntl.flock',
+               side_effect=lock_after_other_run_recovers):
+        journal = checkpoint.CheckpointJournal(meta)
+
+    with journal:
+        assert os.path.exists(journal.path)
+        assert checkpoint.recover(meta) == 0
+        staging = journal.stage(target, "SERIES.nii")
+        assert checkpoint.recover(meta) == 0
+        assert os.path.isdir(staging)
+        journal.discard(staging)
+
+    assert recovered == [0]
+    assert os.listdir(meta) == []
+
+
+def test_recover_skips_journals_finished_before_locking(folders):
+    meta, target = folders
+    staging = _make_staging(target, "SERIES.nii_1", ["SERIES.nii.gz"])
+    abandoned = _write_journal(meta, [(staging, checkpoint.STARTED)])
+    # Make sure the abandoned journal is found after the running one
+    os.rename(abandoned, os.path.join(meta, checkpoint.JOURNAL_PREFIX +
+                                      "~host_1.jsonl"))
+    journal = checkpoint.CheckpointJournal(meta)
+    flock = fcntl.flock
+
+    def finish_before_locking(fh, operation):
+        if fh.name == journal.path:
+            # The run finishes after recover() opens its journal
+            journal.close()
+        return flock(fh, operation)
+
+    with patch('datman.extract.checkpoint.fcntl.flock',
+               side_effect=finish_before_locking):
+        assert checkpoint.recover(meta) == 1
+
+    assert os.listdir(target) == []
+    assert os.listdir(meta) == []
+
+
+def test_recover_removes_stale_temporary_journals(folders):
+    meta, target = folders
+    base = os.path.join(meta, checkpoint.JOURNAL_PREFIX)
+    stale, new, locked = [base + name + ".jsonl" + checkpoint.TEMP_SUFFIX
+                          for name in ("stale", "new", "locked")]
+    for path in (stale, new, locked):
+        open(path, "w").close()
+    old = os.stat(stale).st_mtime - checkpoint.STALE_TEMP_AGE - 1
+    os.utime(stale, (old, old))
+    os.utime(locked, (old, old))
+
+    with open(locked) as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        assert checkpoint.recover(meta) == 0
+
+    assert sorted(os.listdir(meta)) == sorted(
+        os.path.basename(path) for path in (new, locked))
@@ -4,6 +4,10 @@ Tests for datman/config.py
 """
 
 import os
+import shutil
+
+import pytest
+from mock import patch
 
 import datman.config as config
 
@@ -14,3 +18,224 @@ def test_initialise_from_environ():
     os.environ['DM_CONFIG'] = os.path.join(FIXTURE_DIR, 'site_config.yml')
     os.environ['DM_SYSTEM'] = 'test'
     config.config()
+
+
+def _copy_fixture(tmp_path):
+    """Copy the project settings fixture somewhere safe to modify."""
+    fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "fixture_project_settings")
+    dest = tmp_path / "config"
+    shutil.copytree(fixture, str(dest))
+    site_config = dest / "site_config.yaml"
+    contents = site_config.read_text().replace(
+        "'tests/fixture_project_settings/'", "'{}/'".format(dest))
+    site_config.write_text(contents)
+    return str(site_config)
+
+
+def test_study_set_from_positional_argument(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    cfg = config.config(filename=site_config, system='local')
+
+    path = cfg.get_path('nii', 'STUDY')
+
+    assert cfg.study_name == 'STUDY'
+    assert path == 'tests/STUDY/data/nii/'
+
+
+def test_repeated_lookups_use_cache(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    cfg = config.config(filename=site_config, system='local', study='STUDY')
+
+    with patch.object(cfg, '_resolve_key',
+                      wraps=cfg._resolve_key) as mock_resolve:
+        for _ in range(3):
+            cfg.get_key('XNAT_Archive', site='CMH')
+            with pytest.raises(config.UndefinedSetting):
+                cfg.get_key('NOT_A_SETTING')
+
+    assert mock_resolve.call_count == 2
+    first, second = cfg.get_tags(site='CMH'), cfg.get_tags(site='CMH')
+    assert first is not second
+    assert first._original is second._original is not None
+
+
+def test_changing_returned_settings_doesnt_change_cache(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    cfg = config.config(filename=site_config, system='local', study='STUDY')
+
+    export_info = cfg.get_key('ExportInfo', site='CMH')
+    export_info['T1']['Count'] = 99
+    del export_info['RST']
+    tags = cfg.get_tags(site='CMH')
+    tags.get('T1')['Pattern'] = 'changed'
+    tags.tags['NEW'] = {'Pattern': 'new'}
+
+    assert cfg.get_key('ExportInfo', site='CMH')['T1']['Count'] == 1
+    assert 'RST' in cfg.get_key('ExportInfo', site='CMH')
+    new_tags = cfg.get_tags(site='CMH')
+    assert new_tags.get('T1', 'Pattern') == ['T1', 'BRAVO']
+    assert 'NEW' not in new_tags.keys()
+
+
+def test_cache_discarded_when_config_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'CACHE_CHECK_INTERVAL', 0)
+    site_config = _copy_fixture(tmp_path)
+    cfg = config.config(filename=site_config, system='local', study='STUDY')
+    assert cfg.get_key('XNATPORT') == '999'
+
+    with open(site_config) as fh:
+        contents = fh.read().replace("XNATPORT: '999'", "XNATPORT: '888'")
+    with open(site_config, 'w') as fh:
+        fh.write(contents)
+    mtime = os.path.getmtime(site_config) + 10
+    os.utime(site_config, (mtime, mtime))
+
+    assert cfg.get_key('XNATPORT') == '888'
+
+
+def _add_study(site_config, name, study_tag, site_tags):
+    """Add another study to a copied config fixture."""
+    config_dir = os.path.dirname(site_config)
+    study_file = "{}_settings.yaml".format(name.lower())
+    with open(os.path.join(config_dir, study_file), 'w') as fh:
+        fh.write("PROJECTDIR: {}\n".format(name))
+        fh.write("STUDY_TAG: {}\n".format(study_tag))
+        fh.write("Sites:\n")
+        for site, tags in site_tags.items():
+            fh.write("  {}:\n".format(site))
+            fh.write("    SITE_TAGS: {}\n".format(tags))
+    with open(site_config) as fh:
+        contents = fh.read().replace(
+            "  STUDY: study_settings.yaml",
+            "  STUDY: study_settings.yaml\n  {}: {}".format(name, study_file))
+    with open(site_config, 'w') as fh:
+        fh.write(contents)
+
+
+def test_project_found_from_study_and_site_tags(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    _add_study(site_config, 'OTHER', 'OTH01', {'CMH': 'OTHCMH',
+                                               'UTO': ['OTHUTO']})
+    cfg = config.config(filename=site_config, system='local')
+
+    assert cfg.map_xnat_archive_to_project('OTH01_CMH_0001_01_01') == 'OTHER'
+    assert cfg.map_xnat_archive_to_project('OTHUTO_UTO_0001_01_01') == 'OTHER'
+    assert cfg.study_name == 'OTHER'
+
+    with pytest.raises(ValueError):
+        cfg.map_xnat_archive_to_project('NOPE_CMH_0001_01_01')
+
+
+def test_project_index_reused_when_configs_unchanged(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    _add_study(site_config, 'OTHER', 'OTH01', {'CMH': ['OTHCMH']})
+    cfg = config.config(filename=site_config, system='local')
+    cfg.map_xnat_archive_to_project('OTH01_CMH_0001_01_01')
+
+    new_cfg = config.config(filename=site_config, system='local')
+    with patch.object(new_cfg, '_build_project_index') as mock_build:
+        project = new_cfg.map_xnat_archive_to_project('OTHCMH_CMH_0001_01_01')
+
+    assert project == 'OTHER'
+    assert not mock_build.called
+
+
+def test_project_index_replaced_in_one_step(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    _add_study(site_config, 'OTHER', 'OTH01', {'CMH': ['OTHCMH']})
+    config_dir = os.path.dirname(site_config)
+    index_file = os.path.join(config_dir, config.PROJECT_INDEX_FILE)
+    with open(index_file, 'w') as fh:
+        fh.write('{"projects": []}')
+
+    def fail_midway(contents, fh):
+        fh.write('{"projects": ')
+        raise OSError('Disk full')
+
+    cfg = config.config(filename=site_config, system='local')
+    with patch('datman.config.json.dump', side_effect=fail_midway):
+        project = cfg.map_xnat_archive_to_project('OTH01_CMH_0001_01_01')
+
+    assert project == 'OTHER'
+
+    with open(index_file) as fh:
+        assert fh.read() == '{"projects": []}'
+    assert not [name for name in os.listdir(config_dir)
+                if name.endswith('.tmp')]
+
+
+def test_snapshot_used_instead_of_parsing_yaml(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    snapshot, errors = config.compile_snapshot(filename=site_config,
+                                               system='local')
+
+    assert not errors
+    assert os.path.exists(snapshot)
+
+    with patch('datman.config.parse_yaml') as mock_parse:
+        cfg = config.config(filename=site_config, system='local',
+                            study='STUDY')
+        assert cfg.get_key('XNAT_Archive', site='CMH') == 'ARC01'
+    assert not mock_parse.called
+
+
+def test_changed_files_parsed_instead_of_using_snapshot(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    config.compile_snapshot(filename=site_config, system='local')
+
+    study_config = os.path.join(os.path.dirname(site_config),
+                                'study_settings.yaml')
+    with open(study_config) as fh:
+        contents = fh.read().replace("'ARC01'", "'NEW01'")
+    with open(study_config, 'w') as fh:
+        fh.write(contents)
+    mtime = os.path.getmtime(study_config) + 10
+    os.utime(study_config, (mtime, mtime))
+
+    cfg = config.config(filename=site_config, system='local', study='STUDY')
+    assert cfg.get_key('XNAT_Archive', site='CMH') == 'NEW01'
+
+
+def test_snapshot_leaves_out_invalid_studies(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    _add_study(site_config, 'BROKEN', 'BRK01', {'CMH': ['BRK']})
+    broken = os.path.join(os.path.dirname(site_config),
+                          'broken_settings.yaml')
+    with open(broken, 'a') as fh:
+        fh.write("    ExportInfo:\n      T1: {Pattern: '(T1'}\n")
+
+    _, errors = config.compile_snapshot(filename=site_config, system='local')
+
+    assert list(errors) == ['BROKEN']
+
+
+def test_snapshot_accepts_series_description_and_image_type(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    _add_study(site_config, 'OTHER', 'OTH01', {'CMH': ['OTH']})
+    other = os.path.join(os.path.dirname(site_config), 'other_settings.yaml')
+    with open(other, 'a') as fh:
+        fh.write("    ExportInfo:\n"
+                 "      T1: {Pattern: {SeriesDescription: ['T1', 'BRAVO'],\n"
+                 "                     ImageType: 'ORIGINAL'}}\n"
+                 "      RST: {Pattern: {SeriesDescription: 'Rest'}}\n")
+
+    _, errors = config.compile_snapshot(filename=site_config, system='local')
+
+    assert not errors
+
+
+def test_snapshot_leaves_out_invalid_image_type_patterns(tmp_path):
+    site_config = _copy_fixture(tmp_path)
+    _add_study(site_config, 'BROKEN', 'BRK01', {'CMH': ['BRK']})
+    broken = os.path.join(os.path.dirname(site_config),
+                          'broken_settings.yaml')
+    with open(broken, 'a') as fh:
+        fh.write("    ExportInfo:\n"
+                 "      T1: {Pattern: {SeriesDescription: 'T1',\n"
+                 "                     ImageType: '(ORIGINAL'}}\n")
+
+    _, errors = config.compile_snapshot(filename=site_config, system='local')
+
+    assert list(errors) == ['BROKEN']
+    assert errors['BROKEN'].startswith('ConfigException')
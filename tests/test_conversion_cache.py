@@ -0,0 +1,89 @@
+import os
+
+import pytest
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.uid import ExplicitVRLittleEndian
+
+import datman.conversion_cache
+
+COMMAND = 'dcm2niix -z y -b y -o {out} {src}'
+
+
+def _write_dicom(folder, name, series_uid, instance_uid):
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = instance_uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    path = os.path.join(folder, name)
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.SOPInstanceUID = instance_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.save_as(path)
+
+
+@pytest.fixture
+def series_dir(tmp_path):
+    path = tmp_path / 'files'
+    path.mkdir()
+    for num in range(3):
+        _write_dicom(str(path), f'{num}.dcm', '1.2.3', f'1.2.3.{num}')
+    (path / 'notes.txt').write_text('not a dicom')
+    return str(path)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return datman.conversion_cache.ConversionCache(str(tmp_path / 'cache'))
+
+
+def _make_output(tmp_path, name):
+    out = tmp_path / name
+    out.mkdir()
+    (out / 'files_T1.nii.gz').write_text('image')
+    (out / 'files_T1.json').write_text('{}')
+    return str(out)
+
+
+def test_read_uids_skips_non_dicoms(series_dir):
+    assert datman.conversion_cache.read_uids(series_dir) == (
+        '1.2.3', ['1.2.3.0', '1.2.3.1', '1.2.3.2'])
+
+
+def test_key_depends_on_instances_and_command(cache, series_dir):
+    key = cache.make_key(series_dir, COMMAND)
+
+    assert key == cache.make_key(series_dir, COMMAND)
+    assert key != cache.make_key(series_dir, COMMAND.replace('-z y', '-z n'))
+    _write_dicom(series_dir, '3.dcm', '1.2.3', '1.2.3.3')
+    assert key != cache.make_key(series_dir, COMMAND)
+
+
+def test_cached_outputs_reused(cache, series_dir, tmp_path):
+    key = cache.make_key(series_dir, COMMAND)
+    assert cache.materialise(key, str(tmp_path)) is None
+
+    cache.put(key, _make_output(tmp_path, 'first'), messages=b'warning')
+    dest = tmp_path / 'second'
+    dest.mkdir()
+    messages, created = cache.materialise(key, str(dest))
+
+    assert messages == b'warning'
+    assert sorted(os.path.basename(path) for path in created) == [
+        'files_T1.json', 'files_T1.nii.gz']
+    assert (dest / 'files_T1.nii.gz').read_text() == 'image'
+
+
+def test_put_keeps_existing_entry(cache, series_dir, tmp_path):
+    key = cache.make_key(series_dir, COMMAND)
+    cache.put(key, _make_output(tmp_path, 'first'))
+    other = _make_output(tmp_path, 'second')
+    with open(os.path.join(other, 'files_T1.json'), 'w') as fh:
+        fh.write('changed')
+
+    cache.put(key, other)
+
+    with open(os.path.join(cache.get(key), 'files_T1.json')) as fh:
+        assert fh.read() == '{}'
+    assert os.listdir(os.path.dirname(cache.get(key))) == [key]
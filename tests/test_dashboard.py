@@ -0,0 +1,324 @@
+import sys
+import types
+
+import pytest
+from mock import patch, MagicMock
+
+import datman.dashboard as dashboard
+from datman.exceptions import DashboardException
+
+
+def _make_session(*scan_names):
+    session = MagicMock()
+    session.scans = []
+    for name in scan_names:
+        scan = MagicMock()
+        scan.name = name
+        session.scans.append(scan)
+    return session
+
+
+@pytest.fixture
+def queries():
+    with patch('datman.dashboard.dash_found', True), \
+            patch('datman.dashboard._connected', True), \
+            patch('datman.dashboard.queries') as mock_queries:
+        study = MagicMock()
+        study.study.scantypes = [MagicMock(tag='T1'), MagicMock(tag='RST')]
+        mock_queries.get_study.return_value = [study]
+        yield mock_queries
+
+
+def test_add_scans_looks_up_each_session_once(queries):
+    session = _make_session('STUDY_CMH_0001_01_01_T1_02')
+    queries.get_session.return_value = session
+
+    records = dashboard.add_scans([
+        'STUDY_CMH_0001_01_01_T1_02_SagT1',
+        'STUDY_CMH_0001_01_01_RST_03_Resting',
+        '/some/path/STUDY_CMH_0001_01_01_RST_04_Resting.nii.gz',
+        'STUDY_CMH_0001_01_01_DTI_05_DTI',
+    ])
+
+    assert queries.get_session.call_count == 1
+    assert queries.get_study.call_count == 1
+    assert len(records) == 3
+    assert records['STUDY_CMH_0001_01_01_T1_02_SagT1'] is session.scans[0]
+    assert session.add_scan.call_count == 2
+    session.add_scan.assert_any_call('STUDY_CMH_0001_01_01_RST_03', '03',
+                                     'RST', 'Resting')
+
+
+def test_find_scans_groups_by_session(queries):
+    sessions = {
+        1: _make_session('STUDY_CMH_0001_01_01_T1_02'),
+        2: _make_session('STUDY_CMH_0001_01_02_T1_02'),
+    }
+    queries.get_session.side_effect = lambda subid, num: sessions[num]
+
+    records = dashboard.find_scans([
+        'STUDY_CMH_0001_01_01_T1_02_SagT1.json',
+        'STUDY_CMH_0001_01_02_T1_02_SagT1.json',
+        'STUDY_CMH_0001_01_02_T1_03_SagT1.json',
+        'NOT_A_VALID_NAME',
+    ])
+
+    assert queries.get_session.call_count == 2
+    assert records == {
+        'STUDY_CMH_0001_01_01_T1_02_SagT1.json': sessions[1].scans[0],
+        'STUDY_CMH_0001_01_02_T1_02_SagT1.json': sessions[2].scans[0],
+    }
+
+
+def test_update_sidecars_bulk_reports_failures(queries):
+    session = _make_session('STUDY_CMH_0001_01_01_T1_02')
+    queries.get_session.return_value = session
+    found = '/nii/STUDY_CMH_0001_01_01_T1_02_SagT1.json'
+    missing = '/nii/STUDY_CMH_0001_01_01_T1_03_SagT1.json'
+
+    failed = dashboard.update_sidecars_bulk([found, missing])
+
+    assert failed == [missing]
+    session.scans[0].add_json.assert_called_once_with(found)
+
+
+def test_add_scan_errors_reports_failures(queries):
+    session = _make_session('STUDY_CMH_0001_01_01_T1_02')
+    queries.get_session.return_value = session
+
+    failed = dashboard.add_scan_errors([
+        ['STUDY_CMH_0001_01_01_T1_02_SagT1', 'missing images'],
+        ['STUDY_CMH_0001_01_01_T1_03_SagT1', 'missing images'],
+    ])
+
+    assert failed == ['STUDY_CMH_0001_01_01_T1_03_SagT1']
+    session.scans[0].add_error.assert_called_once_with('missing images')
+
+
+def test_spool_kept_in_study_metadata_folder():
+    config = MagicMock()
+    config.get_path.side_effect = lambda path: '/STUDY/' + path
+
+    assert dashboard.get_spool_path(config) == \
+        '/STUDY/meta/' + dashboard.SPOOL_FILE
+
+
+@pytest.fixture
+def fake_dashboard():
+    """A stand in for the dashboard package, which isnt installed here."""
+    module = types.ModuleType('dashboard')
+    module.queries = MagicMock()
+    module.monitors = MagicMock()
+    module.db = MagicMock()
+    module.calls = []
+
+    def connect_db(**options):
+        module.calls.append(options)
+
+    module.connect_db = connect_db
+    with patch.dict(sys.modules, {'dashboard': module}), \
+            patch('datman.dashboard.dash_found', True), \
+            patch('datman.dashboard._connected', False), \
+            patch('datman.dashboard.queries', None), \
+            patch('datman.dashboard.monitors', None), \
+            patch('datman.dashboard._db', None):
+        yield module
+
+
+def test_connects_on_first_use_only(fake_dashboard):
+    assert fake_dashboard.calls == []
+
+    dashboard.get_study_subjects('STUDY')
+    dashboard.get_study_subjects('STUDY')
+
+    assert fake_dashboard.calls == [{}]
+    assert fake_dashboard.queries.get_study_timepoints.call_count == 2
+
+
+def test_pool_settings_read_from_environment(fake_dashboard, monkeypatch):
+    monkeypatch.setenv('DM_DASH_POOL_SIZE', '2')
+    monkeypatch.setenv('DM_DASH_MAX_OVERFLOW', '0')
+
+    dashboard.connect(pool_timeout=5)
+
+    assert fake_dashboard.calls == [
+        {'pool_size': 2, 'max_overflow': 0, 'pool_timeout': 5}]
+
+
+def test_invalid_pool_setting_raises_exception(fake_dashboard, monkeypatch):
+    monkeypatch.setenv('DM_DASH_POOL_SIZE', 'lots')
+
+    with pytest.raises(DashboardException):
+        dashboard.connect()
+
+
+def test_nested_sessions_commit_once(fake_dashboard):
+    with dashboard.session():
+        with dashboard.session():
+            pass
+        assert fake_dashboard.db.session.commit.call_count == 0
+
+    assert fake_dashboard.db.session.commit.call_count == 1
+    assert fake_dashboard.db.session.remove.call_count == 1
+
+
+def test_session_rolls_back_on_error(fake_dashboard):
+    with pytest.raises(ValueError):
+        with dashboard.session():
+            raise ValueError
+
+    assert fake_dashboard.db.session.commit.call_count == 0
+    assert fake_dashboard.db.session.rollback.call_count == 1
+    assert fake_dashboard.db.session.remove.call_count == 1
+
+
+class TestWriteQueue:
+
+    @pytest.fixture
+    def operations(self):
+        ops = {'add_scans': MagicMock(), 'update_sidecars': MagicMock()}
+        with patch.dict(dashboard.WRITE_OPERATIONS, ops):
+            yield ops
+
+    @pytest.fixture
+    def spool(self, tmp_path):
+        return str(tmp_path / 'spool' / 'dashboard_spool.jsonl')
+
+    def test_consecutive_items_written_in_one_call(self, operations, spool):
+        queue = dashboard.WriteQueue(spool=spool, max_delay=60)
+        queue.put('add_scans', ['A_1'])
+        queue.put('add_scans', ['A_2', 'A_3'])
+        queue.put('update_sidecars', ['A_1.json'])
+        queue.put('add_scans', ['A_4'])
+
+        queue.close()
+
+        assert operations['add_scans'].call_args_list == [
+            ((['A_1', 'A_2', 'A_3'],),), ((['A_4'],),)]
+        operations['update_sidecars'].assert_called_once_with(['A_1.json'])
+
+    def test_writes_when_max_items_reached(self, operations, spool):
+        queue = dashboard.WriteQueue(spool=spool, max_items=2, max_delay=60)
+        queue.put('add_scans', ['A_1', 'A_2'])
+        queue._thread.join(timeout=0.5)
+
+        operations['add_scans'].assert_called_once_with(['A_1', 'A_2'])
+        queue.close()
+
+    def test_failed_updates_are_spooled_and_replayed(self, operations,
+                                                     spool):
+        operations['add_scans'].side_effect = DashboardException
+        queue = dashboard.WriteQueue(spool=spool)
+        queue.put('add_scans', ['A_1'])
+        queue.put('update_sidecars', ['A_1.json'])
+        queue.close()
+
+        # Later updates are saved too, so they're never applied out of order
+        operations['update_sidecars'].assert_not_called()
+
+        operations['add_scans'].side_effect = None
+        operations['add_scans'].reset_mock()
+        queue = dashboard.WriteQueue(spool=spool)
+        queue.close()
+
+        operations['add_scans'].assert_called_once_with(['A_1'])
+        operations['update_sidecars'].assert_called_once_with(['A_1.json'])
+        with open(spool) as fh:
+            assert fh.read() == ''
+
+    def test_spool_kept_until_replayed_updates_written(self, operations,
+                                                       spool):
+        operations['add_scans'].side_effect = DashboardException
+        queue = dashboard.WriteQueue(spool=spool)
+        queue.put('update_sidecars', ['A_1.json'])
+        queue.put('add_scans', ['A_1'])
+        queue.put('update_sidecars', ['A_2.json'])
+        queue.close()
+        with open(spool) as fh:
+            saved = fh.read()
+
+        def check_spool(items):
+            with open(spool) as fh:
+                assert fh.read() == saved
+            raise DashboardException
+
+        operations['add_scans'].side_effect = check_spool
+        operations['update_sidecars'].reset_mock()
+        queue = dashboard.WriteQueue(spool=spool)
+        queue.close()
+
+        operations['update_sidecars'].assert_not_called()
+        with open(spool) as fh:
+            assert fh.read() == saved
+
+    def test_unknown_operation_rejected(self, operations, spool):
+        queue = dashboard.WriteQueue(spool=spool)
+        with pytest.raises(DashboardException):
+            queue.put('drop_tables', [])
+        queue.close()
+
+
+def _make_timepoint(name, sessions, is_phantom=False):
+    timepoint = MagicMock(is_phantom=is_phantom, bids_name=None)
+    timepoint.name = name
+    timepoint.sessions = {}
+    for num, signed_off, scans in sessions:
+        session = MagicMock(signed_off=signed_off, reviewer='DH')
+        session.scans = []
+        for scan_name, comment in scans:
+            scan = MagicMock(description='desc', bids_name=None)
+            scan.name = scan_name
+            scan.blacklisted.return_value = comment is not None
+            scan.get_comment.return_value = comment
+            session.scans.append(scan)
+        timepoint.sessions[num] = session
+    return timepoint
+
+
+def test_get_study_records(queries):
+    study = MagicMock()
+    study.timepoints = [
+        _make_timepoint('STUDY_CMH_0002_01', [
+            (2, False, []),
+            (1, True, [('STUDY_CMH_0002_01_01_T1_03', 'Motion'),
+                       ('STUDY_CMH_0002_01_01_RST_04', None)]),
+        ]),
+        _make_timepoint('STUDY_CMH_0001_01', []),
+        _make_timepoint('STUDY_TGH_0003_01', []),
+        _make_timepoint('STUDY_CMH_PHA_FBN0001', [], is_phantom=True),
+    ]
+    queries.get_study.return_value = [study]
+
+    records = dashboard.get_study_records('STUDY', site='CMH')
+
+    assert [subject.name for subject in records] == [
+        'STUDY_CMH_0001_01', 'STUDY_CMH_0002_01']
+    sessions = records[1].sessions
+    assert [session.name for session in sessions] == [
+        'STUDY_CMH_0002_01_01', 'STUDY_CMH_0002_01_02']
+    assert sessions[0].reviewer == 'DH'
+    assert sessions[1].reviewer is None
+    assert sessions[0].scans == (
+        dashboard.ScanRecord('STUDY_CMH_0002_01_01_RST_04', 'RST', '04',
+                             'desc', None, False, None),
+        dashboard.ScanRecord('STUDY_CMH_0002_01_01_T1_03', 'T1', '03',
+                             'desc', None, True, 'Motion'))
+
+
+def test_get_study_records_without_scans(queries):
+    study = MagicMock()
+    study.timepoints = [
+        _make_timepoint('STUDY_CMH_0001_01', [
+            (1, True, [('STUDY_CMH_0001_01_01_T1_03', 'Motion')]),
+        ]),
+    ]
+    queries.get_study.return_value = [study]
+
+    records = dashboard.get_study_records('STUDY', scans=False)
+
+    session, = records[0].sessions
+    assert session.reviewer == 'DH'
+    assert session.scans == ()
+    scan = study.timepoints[0].sessions[1].scans[0]
+    assert not scan.blacklisted.called
+    assert not scan.get_comment.called
@@ -1,3 +1,5 @@
+import pickle
+
 import datman.scanid as scanid
 import pytest
 
@@ -532,6 +534,61 @@ def test_bids_file_equals_itself_with_path_and_ext():
     assert ident == bids_full_path
 
 
+def test_repeated_parse_returns_cached_identifier():
+    assert scanid.parse("DTI_CMH_H001_01_02") is \
+        scanid.parse("DTI_CMH_H001_01_02")
+
+
+def test_parse_cache_respects_settings():
+    settings = {'STUDY': {'DTI01': 'DTI'}}
+    plain = scanid.parse("DTI01_CMH_H001_01_SE02_MR")
+    mapped = scanid.parse("DTI01_CMH_H001_01_SE02_MR", settings)
+
+    assert plain.study == 'DTI01'
+    assert mapped.study == 'DTI'
+
+
+def test_identifier_is_immutable():
+    ident = scanid.parse("DTI_CMH_H001_01_02")
+    with pytest.raises(AttributeError):
+        ident.session = '03'
+
+
+def test_identifiers_are_hashable_and_comparable():
+    first = scanid.parse("DTI_CMH_H001_01_02")
+    second = scanid.parse("DTI_CMH_H002_01_01")
+    same = scanid.DatmanIdentifier("DTI_CMH_H001_01_02")
+
+    assert first == same
+    assert len({first, second, same}) == 2
+    assert sorted([second, first]) == [first, second]
+
+
+def test_identifier_survives_pickling():
+    ident = scanid.parse("ABC01_CMH_LEGPHA_0001_MR")
+    copy = pickle.loads(pickle.dumps(ident))
+
+    assert copy == ident
+    assert copy.get_xnat_subject_id() == ident.get_xnat_subject_id()
+
+
+def test_parse_many_keeps_input_order():
+    ids = ["DTI_CMH_H001_01_02", "garbage", "ABC01_CMH_12345678_01_SE02_MR"]
+
+    with pytest.raises(scanid.ParseException):
+        scanid.parse_many(ids)
+
+    parsed = scanid.parse_many(ids, ignore_invalid=True)
+    assert [str(ident) if ident else None for ident in parsed] == [
+        "DTI_CMH_H001_01_02", None, "ABC01_CMH_12345678_01_02"]
+
+
+def test_parse_filename_raises_for_repeated_bad_names():
+    for _ in range(2):
+        with pytest.raises(scanid.ParseException):
+            scanid.parse_filename("DTI_CMH_T1_03_description.nii.gz")
+
+
 def test_bids_file_correctly_parses_when_all_anat_entities_given():
     anat_bids = "sub-CMH0001_ses-01_acq-abcd_ce-efgh_rec-ijkl_" + \
                 "run-1_mod-mnop_somesuffix"
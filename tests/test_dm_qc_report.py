@@ -79,6 +79,21 @@ class PrepareScan(unittest.TestCase):
         assert mock_create.call_count == 1
 
 
+class NewSubject(unittest.TestCase):
+    @patch('datman.scan.list_dir')
+    def test_rejects_subject_with_misnamed_files(self, mock_list_dir):
+        mock_list_dir.return_value = ['STUDY_SITE_ID_01_01_T1.nii.gz']
+
+        assert not qc.new_subject("STUDY_SITE_ID_01", config)
+
+    @patch('datman.scan.list_dir')
+    def test_accepts_subject_without_qc_folder(self, mock_list_dir):
+        mock_list_dir.return_value = [
+            'STUDY_SITE_ID_01_01_T1_02_SagT1-BRAVO.nii.gz']
+
+        assert qc.new_subject("STUDY_SITE_ID_01", config)
+
+
 class GetStandards(unittest.TestCase):
     site = "CMH"
     path = "/some/path"
@@ -0,0 +1,396 @@
+import os
+import threading
+import zipfile
+
+import pytest
+from mock import MagicMock, patch
+
+import datman.config
+import datman.extract
+import datman.manifest
+import datman.storage
+import datman.xnat
+from datman.exceptions import StorageException, UndefinedSetting
+
+EXPERIMENT = 'STUDY_CMH_0001_01_01'
+
+
+@pytest.fixture
+def config(tmp_path):
+    paths = {}
+    for folder in ['fake', 'missing', 'meta']:
+        paths[folder] = str(tmp_path / folder)
+        os.makedirs(paths[folder])
+
+    def get_key(key, site=None):
+        raise UndefinedSetting(key)
+
+    config = MagicMock()
+    config.study_name = 'STUDY'
+    config.get_path.side_effect = lambda path_type: paths[path_type]
+    config.get_key.side_effect = get_key
+    config.get_tags.return_value = datman.config.TagInfo({
+        'T1': {'formats': ['fake'], 'Pattern': {'SeriesDescription': 'T1'}},
+        'RST': {'formats': ['fake', 'missing'],
+                'Pattern': {'SeriesDescription': 'Rest'}},
+    })
+    return config
+
+
+def _make_experiment():
+    scans = []
+    for series, descr in [('2', 'Sag_T1'), ('3', 'Resting')]:
+        scan_json = {
+            'data_fields': {'ID': series, 'series_description': descr,
+                            'parameters/imageType': 'ORIGINAL'},
+            'children': [{'items': [{'data_fields': {'content': 'RAW'}}]}],
+        }
+        scans.append(datman.xnat.XNATScan('STUDY', 'STUDY_CMH_0001_01',
+                                          EXPERIMENT, scan_json))
+    experiment = MagicMock(resource_files=[], scans=scans)
+    experiment.name = EXPERIMENT
+    return experiment
+
+
+def fake_exporter(extractor, seriesdir, outputdir, stem, scan=None):
+    path = os.path.join(outputdir, stem + '.txt')
+    with open(path, 'w') as fh:
+        fh.write(seriesdir)
+    return [path]
+
+
+@pytest.fixture
+def extractor(config, tmp_path):
+    xnat = MagicMock()
+    xnat.get_experiment.return_value = _make_experiment()
+    extractor = datman.extract.Extractor(
+        config, update_dashboard=False,
+        exporters={'fake': MagicMock(wraps=fake_exporter)})
+    events = []
+    extractor.add_listener(lambda event, **details: events.append(
+        (event, details)))
+    with patch('datman.utils.read_blacklist', return_value=None), \
+            patch('datman.extract.extractor.get_dicom_archive_from_xnat',
+                  return_value=str(tmp_path)):
+        yield extractor, xnat, events
+    extractor.close()
+
+
+def test_process_experiment_exports_and_reports_events(extractor, config):
+    extractor, xnat, events = extractor
+    ident = datman.scanid.parse(EXPERIMENT)
+
+    assert extractor.process_experiment(xnat, 'STUDY', ident)
+
+    outputs = sorted(os.listdir(os.path.join(config.get_path('fake'),
+                                             'STUDY_CMH_0001_01')))
+    assert outputs == ['STUDY_CMH_0001_01_01_RST_03_Resting.txt',
+                       'STUDY_CMH_0001_01_01_T1_02_Sag-T1.txt']
+    names = [event for event, _ in events]
+    assert names[0] == 'experiment_started'
+    assert names[-1] == 'experiment_finished'
+    assert names.count('series_exported') == 2
+    failed, = [details for event, details in events
+               if event == 'export_failed']
+    assert failed['format'] == 'missing'
+    assert failed['series'] == 'STUDY_CMH_0001_01_01_RST_03_Resting'
+
+
+def test_exported_series_skipped_next_time(extractor):
+    extractor, xnat, events = extractor
+    ident = datman.scanid.parse(EXPERIMENT)
+    extractor.process_experiment(xnat, 'STUDY', ident)
+    exporter = extractor.exporters['fake']
+    assert exporter.call_count == 2
+
+    extractor.process_experiment(xnat, 'STUDY', ident)
+
+    assert exporter.call_count == 2
+    assert extractor.manifest.remaining(
+        'STUDY_CMH_0001_01_01_T1_02_Sag-T1', ['fake']) == []
+
+
+def test_failed_export_leaves_no_partial_outputs(extractor, config):
+    extractor, xnat, events = extractor
+    ident = datman.scanid.parse(EXPERIMENT)
+
+    def fail_midway(extractor, seriesdir, outputdir, stem, scan=None):
+        with open(os.path.join(outputdir, stem + '.txt'), 'w') as fh:
+            fh.write('partial')
+        raise RuntimeError('Killed')
+
+    extractor.exporters['fake'].side_effect = fail_midway
+    extractor.process_experiment(xnat, 'STUDY', ident)
+
+    output_dir = os.path.join(config.get_path('fake'), 'STUDY_CMH_0001_01')
+    assert os.listdir(output_dir) == []
+    assert extractor.manifest.remaining(
+        'STUDY_CMH_0001_01_01_T1_02_Sag-T1', ['fake']) == ['fake']
+
+    extractor.close()
+    assert os.listdir(config.get_path('meta')) == [
+        datman.manifest.MANIFEST_FILE]
+
+
+def test_series_without_disk_space_reported_as_failed(extractor):
+    extractor, xnat, events = extractor
+    make_temp = extractor.storage.temp_directory
+    sizes = []
+
+    def temp_directory(size, **kwargs):
+        sizes.append(size)
+        if len(sizes) == 2:
+            raise StorageException("Not enough space")
+        return make_temp(size, **kwargs)
+
+    with patch.object(extractor.storage, 'temp_directory',
+                      side_effect=temp_directory):
+        extractor.process_experiment(xnat, 'STUDY',
+                                     datman.scanid.parse(EXPERIMENT))
+
+    failed = [details['series'] for event, details in events
+              if event == 'export_failed']
+    assert 'STUDY_CMH_0001_01_01_T1_02_Sag-T1' in failed
+    exported = [details['series'] for event, details in events
+                if event == 'series_exported']
+    assert exported == ['STUDY_CMH_0001_01_01_RST_03_Resting']
+
+
+def test_experiment_without_disk_space_reported_as_failed(extractor):
+    extractor, xnat, events = extractor
+    extractor.bulk_download = True
+
+    with patch.object(extractor.storage, 'temp_directory',
+                      side_effect=StorageException("Not enough space")):
+        extractor.process_experiment(xnat, 'STUDY',
+                                     datman.scanid.parse(EXPERIMENT))
+
+    assert sorted((details['series'], details['format'])
+                  for event, details in events
+                  if event == 'export_failed') == [
+        ('STUDY_CMH_0001_01_01_RST_03_Resting', 'fake'),
+        ('STUDY_CMH_0001_01_01_RST_03_Resting', 'missing'),
+        ('STUDY_CMH_0001_01_01_T1_02_Sag-T1', 'fake')]
+    assert xnat.get_dicoms.call_count == 0
+
+
+def test_exports_use_space_reserved_with_download(config, tmp_path):
+    xnat = MagicMock()
+    xnat.get_experiment.return_value = _make_experiment()
+    temp_dirs = []
+
+    def needs_temp(extractor, seriesdir, outputdir, stem, scan=None):
+        # More than any disk can hold, if it were reserved again
+        with extractor.make_temp_directory(2 ** 70) as temp:
+            temp_dirs.append(temp)
+            return fake_exporter(extractor, seriesdir, outputdir, stem)
+
+    budget = datman.storage.StorageBudget(temp_roots=[str(tmp_path)],
+                                          headroom=0)
+    extractor = datman.extract.Extractor(
+        config, update_dashboard=False, storage=budget,
+        exporters={'fake': datman.extract.ExportFormat('fake', needs_temp,
+                                                       workers=2)})
+    exported = []
+    extractor.add_listener(lambda event, **details: exported.append(
+        details['series']) if event == 'series_exported' else None)
+
+    with extractor, \
+            patch('datman.utils.read_blacklist', return_value=None), \
+            patch('datman.extract.extractor.get_dicom_archive_from_xnat',
+                  return_value=str(tmp_path)):
+        extractor.process_experiment(xnat, 'STUDY',
+                                     datman.scanid.parse(EXPERIMENT))
+
+    assert len(exported) == 2
+    assert len(temp_dirs) == 2
+    assert not any(os.path.exists(temp) for temp in temp_dirs)
+    with pytest.raises(StorageException):
+        with extractor.make_temp_directory(2 ** 70):
+            pass
+
+
+def test_formats_with_workers_export_in_background(config, tmp_path):
+    xnat = MagicMock()
+    xnat.get_experiment.return_value = _make_experiment()
+    exporter = MagicMock(wraps=fake_exporter)
+    extractor = datman.extract.Extractor(
+        config, update_dashboard=False,
+        exporters={'fake': datman.extract.ExportFormat('fake', exporter,
+                                                       workers=2)})
+    exported = []
+    extractor.add_listener(lambda event, **details: exported.append(
+        details['series']) if event == 'series_exported' else None)
+
+    with extractor, \
+            patch('datman.utils.read_blacklist', return_value=None), \
+            patch('datman.extract.extractor.get_dicom_archive_from_xnat',
+                  return_value=str(tmp_path)):
+        extractor.process_experiment(xnat, 'STUDY',
+                                     datman.scanid.parse(EXPERIMENT))
+
+    assert exporter.call_count == 2
+    assert sorted(exported) == ['STUDY_CMH_0001_01_01_RST_03_Resting',
+                                'STUDY_CMH_0001_01_01_T1_02_Sag-T1']
+    assert len(os.listdir(os.path.join(config.get_path('fake'),
+                                       'STUDY_CMH_0001_01'))) == 2
+
+
+def test_conversion_errors_queued_after_scans(extractor, tmp_path):
+    extractor, _, _ = extractor
+    extractor.update_dashboard = True
+    dest = str(tmp_path / 'STUDY_CMH_0001_01_01_T1_02_SagT1.err')
+
+    with patch('datman.dashboard.dash_found', True), \
+            patch('datman.dashboard.queue_write') as mock_queue:
+        extractor._add_to_dashboard(['STUDY_CMH_0001_01_01_T1_02_SagT1'])
+        extractor.report_issues(dest, 'Error: missing images')
+
+    assert [call[0][0] for call in mock_queue.call_args_list] == [
+        'add_scans', 'add_scan_errors']
+    mock_queue.assert_called_with(
+        'add_scan_errors',
+        [['STUDY_CMH_0001_01_01_T1_02_SagT1', 'Error: missing images']])
+
+
+def test_wanted_tags(extractor):
+    extractor, xnat, events = extractor
+    extractor.tags = ['T1']
+
+    extractor.process_experiment(xnat, 'STUDY',
+                                 datman.scanid.parse(EXPERIMENT))
+
+    exporter = extractor.exporters['fake']
+    assert exporter.call_count == 1
+    assert exporter.call_args[0][3] == 'STUDY_CMH_0001_01_01_T1_02_Sag-T1'
+
+
+def test_experiment_not_found(extractor):
+    extractor, xnat, events = extractor
+    xnat.get_experiment.side_effect = datman.exceptions.XnatException
+
+    assert not extractor.process_experiment(
+        xnat, 'STUDY', datman.scanid.parse(EXPERIMENT))
+    assert events[-1][1]['error']
+
+
+def _make_archive(path, members):
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name in members:
+            archive.writestr(name, 'dicom')
+    return path
+
+
+def test_split_dicom_archive(tmp_path):
+    prefix = EXPERIMENT + '/scans/'
+    archive = _make_archive(str(tmp_path / 'scans.zip'), [
+        prefix + '1-Localizer/resources/DICOM/files/a.dcm',
+        prefix + '1-2-Derived/resources/DICOM/files/b.dcm',
+        prefix + '3-T1/resources/DICOM/files/c.dcm',
+        prefix + '4-Other/resources/DICOM/files/d.dcm',
+        'README.txt',
+    ])
+
+    unpacked = datman.extract.split_dicom_archive(
+        archive, str(tmp_path / 'out'), ['1', '1-2', '3'])
+
+    assert sorted(unpacked) == ['1', '1-2', '3']
+    for scan_id, name in [('1', 'a.dcm'), ('1-2', 'b.dcm'), ('3', 'c.dcm')]:
+        files = [f for _, _, files in os.walk(unpacked[scan_id])
+                 for f in files]
+        assert files == [name]
+
+
+def test_bulk_download_uses_one_request(extractor, tmp_path):
+    extractor, xnat, events = extractor
+    extractor.bulk_download = True
+    prefix = EXPERIMENT + '/scans/'
+    xnat.get_dicoms.side_effect = lambda *args: _make_archive(
+        str(tmp_path / 'scans.zip'), [
+            prefix + '2-T1/resources/DICOM/files/a.dcm',
+            prefix + '3-RST/resources/DICOM/files/b.dcm'])
+
+    with patch('datman.extract.extractor.find_dicom_dir',
+               side_effect=lambda folder: folder):
+        extractor.process_experiment(xnat, 'STUDY',
+                                     datman.scanid.parse(EXPERIMENT))
+
+    assert xnat.get_dicoms.call_count == 1
+    assert xnat.get_dicoms.call_args[0][3] == ['2', '3']
+    exporter = extractor.exporters['fake']
+    assert sorted(os.path.basename(call[0][1])
+                  for call in exporter.call_args_list) == [
+        'series_2', 'series_3']
+
+
+@pytest.fixture
+def valid_ids():
+    with patch('datman.utils.validate_subject_id',
+               side_effect=lambda exp_id, config: datman.scanid.parse(exp_id)):
+        yield
+
+
+def _listing(*experiments):
+    return [{'label': label, 'insert_date': date}
+            for label, date in experiments]
+
+
+def test_experiments_ordered_by_priority(extractor, valid_ids, tmp_path):
+    extractor, xnat, _ = extractor
+    exported = tmp_path / 'exported.txt'
+    exported.write_text('data')
+    xnat.server = 'https://xnat'
+    xnat.get_experiment_listing.return_value = _listing(
+        ('STUDY_CMH_0001_01_01', '2020-01-01 10:00:00.0'),
+        ('STUDY_CMH_0002_01_01', '2021-06-01 10:00:00.0'),
+        ('STUDY_CMH_0003_01_01', '2019-01-01 10:00:00.0'),
+        ('STUDY_CMH_0004_01_01', None),
+        ('BADID', '2022-01-01 10:00:00.0'))
+    extractor.manifest.add('STUDY_CMH_0002_01_01_T1_02_Sag-T1', 'fake',
+                           [str(exported)])
+
+    with patch.object(extractor, 'get_projects',
+                      return_value={'STUDY': ['CMH', 'CMH2']}), \
+            patch.object(extractor, 'get_connection', return_value=xnat):
+        found = extractor.collect_all_experiments(
+            requested=['STUDY_CMH_0003_01_01'])
+
+    assert [str(ident) for _, _, ident in found] == [
+        'STUDY_CMH_0003_01_01', 'STUDY_CMH_0001_01_01',
+        'STUDY_CMH_0004_01_01', 'STUDY_CMH_0002_01_01']
+    # Sites sharing a project and server share a listing
+    assert xnat.get_experiment_listing.call_count == 1
+
+
+def test_experiments_yielded_before_all_listings_arrive(extractor,
+                                                        valid_ids):
+    extractor, _, _ = extractor
+    fast, slow = MagicMock(server='fast'), MagicMock(server='slow')
+    fast.get_experiment_listing.return_value = _listing(
+        ('STUDY_CMH_0001_01_01', '2020-01-01 10:00:00'))
+    release = threading.Event()
+
+    def wait_for_release(project):
+        release.wait(5)
+        return _listing(('STUDY_CMH_0002_01_01', '2020-01-01 10:00:00'))
+
+    slow.get_experiment_listing.side_effect = wait_for_release
+    sites = {'CMH': fast, 'TOR': slow}
+
+    with patch.object(extractor, 'get_projects',
+                      return_value={'STUDY': ['CMH', 'TOR']}), \
+            patch.object(extractor, 'get_connection',
+                         side_effect=sites.get):
+        experiments = extractor.iter_experiments()
+        first = next(experiments)
+        release.set()
+        rest = list(experiments)
+
+    assert first[0] is fast
+    assert [str(exp[2]) for exp in rest] == ['STUDY_CMH_0002_01_01']
+
+
+def test_unknown_priority_rejected(config):
+    with pytest.raises(ValueError):
+        datman.extract.Extractor(config, update_dashboard=False,
+                                 priority=['requested', 'oldest'])
@@ -0,0 +1,135 @@
+import time
+
+import pytest
+from mock import MagicMock
+
+import datman.import_ledger as ledger_module
+from datman.exceptions import XnatException
+
+ARCHIVE = "/dicom/STUDY_CMH_0001_01_01.zip"
+PREARCHIVE = "/data/prearchive/projects/STUDY/20200101_120000/SESSION"
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    path = str(tmp_path / ledger_module.IMPORT_LEDGER)
+    with ledger_module.ImportLedger(path, base_delay=10,
+                                    max_delay=60) as ledger:
+        yield ledger
+
+
+@pytest.fixture
+def queued(ledger):
+    ledger.start(ARCHIVE, "STUDY", "STUDY_CMH_0001", "STUDY_CMH_0001_01_01")
+    ledger.queued(ARCHIVE, PREARCHIVE)
+    return ledger.get(ARCHIVE)
+
+
+def test_start_records_upload_in_progress(ledger):
+    ledger.start(ARCHIVE, "STUDY", "STUDY_CMH_0001", "STUDY_CMH_0001_01_01")
+
+    record = ledger.get(ARCHIVE)
+    assert record.state == ledger_module.UPLOADING
+    assert record.prearchive is None
+    assert ledger.pending() == [record]
+
+
+def test_queued_uploads_are_not_due_until_base_delay_passes(ledger, queued):
+    assert queued.state == ledger_module.QUEUED
+    assert queued.prearchive == PREARCHIVE
+    assert queued.next_check > time.time()
+    assert ledger.find(states=[ledger_module.QUEUED], due=True) == []
+
+
+def test_retry_later_backs_off_up_to_max_delay(ledger, queued):
+    delays = []
+    for _ in range(5):
+        before = time.time()
+        ledger.retry_later(ARCHIVE)
+        delays.append(round(ledger.get(ARCHIVE).next_check - before))
+
+    assert delays == [20, 40, 60, 60, 60]
+    assert ledger.get(ARCHIVE).attempts == 5
+
+
+def test_restarting_an_upload_resets_its_entry(ledger, queued):
+    ledger.failed(ARCHIVE, "Prearchive status is ERROR")
+    ledger.start(ARCHIVE, "STUDY", "STUDY_CMH_0001", "STUDY_CMH_0001_01_01")
+
+    record = ledger.get(ARCHIVE)
+    assert record.state == ledger_module.UPLOADING
+    assert record.message is None
+    assert len(ledger.find()) == 1
+
+
+def test_ledger_persists_between_connections(tmp_path):
+    path = str(tmp_path / ledger_module.IMPORT_LEDGER)
+    with ledger_module.ImportLedger(path) as ledger:
+        ledger.start(ARCHIVE, "STUDY", "STUDY_CMH_0001",
+                     "STUDY_CMH_0001_01_01")
+        ledger.queued(ARCHIVE, PREARCHIVE)
+
+    with ledger_module.ImportLedger(path) as ledger:
+        assert ledger.get(ARCHIVE).prearchive == PREARCHIVE
+
+
+class TestCheckImport:
+
+    def test_ready_session_is_archived(self, ledger, queued):
+        xnat = MagicMock()
+        xnat.get_prearchive_status.return_value = "READY"
+
+        state = ledger_module.check_import(ledger, queued, xnat)
+
+        assert state == ledger_module.DONE
+        xnat.archive_prearchive_session.assert_called_once_with(PREARCHIVE)
+        assert ledger.get(ARCHIVE).state == ledger_module.DONE
+
+    def test_building_session_is_checked_again_later(self, ledger, queued):
+        xnat = MagicMock()
+        xnat.get_prearchive_status.return_value = "BUILDING"
+
+        state = ledger_module.check_import(ledger, queued, xnat)
+
+        assert state == ledger_module.QUEUED
+        assert not xnat.archive_prearchive_session.called
+        record = ledger.get(ARCHIVE)
+        assert record.attempts == 1
+        assert record.next_check > queued.next_check
+
+    def test_conflicting_session_fails(self, ledger, queued):
+        xnat = MagicMock()
+        xnat.get_prearchive_status.return_value = "CONFLICT"
+
+        state = ledger_module.check_import(ledger, queued, xnat)
+
+        assert state == ledger_module.FAILED
+        assert "CONFLICT" in ledger.get(ARCHIVE).message
+
+    def test_session_archived_by_xnat_is_done(self, ledger, queued):
+        xnat = MagicMock()
+        xnat.get_prearchive_status.return_value = None
+
+        state = ledger_module.check_import(ledger, queued, xnat)
+
+        assert state == ledger_module.DONE
+        xnat.get_experiment.assert_called_once_with(
+            "STUDY", "STUDY_CMH_0001", "STUDY_CMH_0001_01_01")
+
+    def test_session_missing_everywhere_fails(self, ledger, queued):
+        xnat = MagicMock()
+        xnat.get_prearchive_status.return_value = None
+        xnat.get_experiment.side_effect = XnatException("Not found")
+
+        state = ledger_module.check_import(ledger, queued, xnat)
+
+        assert state == ledger_module.FAILED
+
+    def test_server_errors_are_retried(self, ledger, queued):
+        xnat = MagicMock()
+        xnat.get_prearchive_status.side_effect = XnatException("Timed out")
+
+        state = ledger_module.check_import(ledger, queued, xnat)
+
+        assert state == ledger_module.QUEUED
+        assert ledger.get(ARCHIVE).message == "Timed out"
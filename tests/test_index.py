@@ -0,0 +1,113 @@
+import os
+
+import pytest
+from mock import MagicMock
+
+import datman.index
+from datman.exceptions import UndefinedSetting
+
+
+@pytest.fixture
+def study_dir(tmp_path):
+    paths = {}
+    for folder in ["nii", "resources", "meta"]:
+        paths[folder] = str(tmp_path / folder)
+        os.makedirs(paths[folder])
+
+    _touch(paths["nii"], "STUDY_CMH_0001_01",
+           "STUDY_CMH_0001_01_01_T1_03_SagT1.nii.gz",
+           "STUDY_CMH_0001_01_01_T1_03_SagT1.json",
+           "STUDY_CMH_0001_01_01_RST_04_Resting.nii.gz")
+    _touch(paths["nii"], "STUDY_CMH_0002_01",
+           "STUDY_CMH_0002_01_01_T1_02_SagT1.nii.gz")
+    _touch(paths["resources"], "STUDY_CMH_0001_01_01/behav",
+           "task_log.txt")
+    return paths
+
+
+@pytest.fixture
+def config(study_dir):
+    def get_path(path_type):
+        try:
+            return study_dir[path_type]
+        except KeyError:
+            raise UndefinedSetting(path_type)
+
+    config = MagicMock()
+    config.study_name = "STUDY"
+    config.get_path.side_effect = get_path
+    return config
+
+
+def _touch(root, session, *names):
+    folder = os.path.join(root, session)
+    os.makedirs(folder, exist_ok=True)
+    for name in names:
+        with open(os.path.join(folder, name), "w") as fh:
+            fh.write(name)
+
+
+def _names(records):
+    return [os.path.basename(record.path) for record in records]
+
+
+def test_skips_undefined_paths(config):
+    with datman.index.StudyIndex(config) as index:
+        assert sorted(index.roots) == ["nii", "resources"]
+
+
+def test_find_by_fields(config):
+    with datman.index.StudyIndex(config) as index:
+        index.refresh()
+
+        assert _names(index.find(subject="STUDY_CMH_0001_01_01", tag="T1")) \
+            == ["STUDY_CMH_0001_01_01_T1_03_SagT1.json",
+                "STUDY_CMH_0001_01_01_T1_03_SagT1.nii.gz"]
+        assert _names(index.find(series=2)) == \
+            ["STUDY_CMH_0002_01_01_T1_02_SagT1.nii.gz"]
+        assert len(index.find(ext="nii.gz")) == 3
+
+        record = index.find(folder="resources")[0]
+        assert record.subject == "STUDY_CMH_0001_01"
+        assert record.session == "STUDY_CMH_0001_01_01"
+        assert record.tag is None
+        assert record.size == len("task_log.txt")
+
+        assert index.sessions("nii") == ["STUDY_CMH_0001_01",
+                                         "STUDY_CMH_0002_01"]
+
+
+def test_refresh_only_lists_changed_folders(config, study_dir):
+    with datman.index.StudyIndex(config) as index:
+        assert index.refresh() == 6
+        assert index.refresh() == 0
+
+        new_file = os.path.join(study_dir["nii"], "STUDY_CMH_0002_01",
+                                "STUDY_CMH_0002_01_01_DTI_05_DTI.nii.gz")
+        open(new_file, "w").close()
+        os.utime(os.path.dirname(new_file), (1, 1))
+
+        assert index.refresh() == 1
+        assert _names(index.find(tag="DTI")) == [os.path.basename(new_file)]
+
+
+def test_removed_folders_are_forgotten(config, study_dir):
+    with datman.index.StudyIndex(config) as index:
+        index.refresh()
+        behav = os.path.join(study_dir["resources"], "STUDY_CMH_0001_01_01",
+                             "behav")
+        os.remove(os.path.join(behav, "task_log.txt"))
+        os.rmdir(behav)
+
+        index.refresh()
+
+        assert index.find(folder="resources") == []
+
+
+def test_index_is_persistent(config):
+    with datman.index.StudyIndex(config) as index:
+        index.refresh()
+
+    with datman.index.StudyIndex(config) as index:
+        assert len(index.find()) == 5
+        assert index.refresh() == 0
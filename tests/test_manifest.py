@@ -0,0 +1,107 @@
+import os
+
+import pytest
+from mock import MagicMock
+
+import datman.manifest
+from datman.exceptions import UndefinedSetting
+
+SERIES = "STUDY_CMH_0001_01_01_T1_03_SagT1"
+
+
+@pytest.fixture
+def study_dir(tmp_path):
+    paths = {}
+    for folder in ["nii", "dcm", "meta"]:
+        paths[folder] = str(tmp_path / folder)
+        os.makedirs(os.path.join(paths[folder], "STUDY_CMH_0001_01"))
+    return paths
+
+
+@pytest.fixture
+def config(study_dir):
+    def get_path(path_type):
+        try:
+            return study_dir[path_type]
+        except KeyError:
+            raise UndefinedSetting(path_type)
+
+    config = MagicMock()
+    config.study_name = "STUDY"
+    config.get_path.side_effect = get_path
+    return config
+
+
+@pytest.fixture
+def manifest(config):
+    with datman.manifest.ProcessedManifest.for_study(config) as manifest:
+        yield manifest
+
+
+def _write(folder, name, contents="data"):
+    path = os.path.join(folder, "STUDY_CMH_0001_01", name)
+    with open(path, "w") as fh:
+        fh.write(contents)
+    return path
+
+
+def test_remaining_formats(manifest, study_dir):
+    nii = _write(study_dir["nii"], SERIES + ".nii.gz")
+    missing = os.path.join(study_dir["nii"], "not_there.json")
+
+    assert manifest.add(SERIES, "nii", [nii, missing], uid="1.2.3") == 1
+
+    assert manifest.remaining(SERIES, ["nii", "dcm"]) == ["dcm"]
+    record, = manifest.find(uid="1.2.3")
+    assert record.size == 4
+    assert record.checksum is None
+
+
+def test_verify_finds_missing_and_changed_files(manifest, study_dir):
+    nii = _write(study_dir["nii"], SERIES + ".nii.gz")
+    json_file = _write(study_dir["nii"], SERIES + ".json")
+    dcm = _write(study_dir["dcm"], SERIES + ".dcm")
+    manifest.add(SERIES, "nii", [nii, json_file], checksum=True)
+    manifest.add(SERIES, "dcm", [dcm], checksum=True)
+
+    os.remove(json_file)
+    _write(study_dir["dcm"], SERIES + ".dcm", "more data")
+
+    bad = manifest.verify()
+    assert sorted(rec.path for rec in bad) == sorted([json_file, dcm])
+
+    _write(study_dir["nii"], SERIES + ".nii.gz", "DATA")
+    assert manifest.verify() == bad
+    assert len(manifest.verify(checksum=True)) == 3
+
+
+def test_rebuild_adds_untracked_and_removes_stale(manifest, config,
+                                                  study_dir):
+    nii = _write(study_dir["nii"], SERIES + ".nii.gz")
+    _write(study_dir["nii"], "notes.txt")
+    gone = os.path.join(study_dir["dcm"], "STUDY_CMH_0001_01", SERIES + ".dcm")
+    manifest._conn.execute(
+        "INSERT INTO outputs VALUES (?, ?, NULL, 'dcm', 4, NULL, NULL, 0)",
+        (gone, SERIES))
+
+    removed, added = datman.manifest.rebuild(manifest, config,
+                                             export_formats=("nii", "dcm"))
+
+    assert (removed, added) == (1, 1)
+    assert [rec.path for rec in manifest.find()] == [nii]
+    assert manifest.remaining(SERIES, ["nii", "dcm"]) == ["dcm"]
+
+
+def test_rebuild_records_missing_checksums(manifest, config, study_dir):
+    nii = _write(study_dir["nii"], SERIES + ".nii.gz")
+    manifest.add(SERIES, "nii", [nii], uid="1.2.3")
+
+    datman.manifest.rebuild(manifest, config, export_formats=("nii",))
+    record, = manifest.find()
+    assert record.checksum is None
+
+    datman.manifest.rebuild(manifest, config, export_formats=("nii",),
+                            checksum=True)
+    record, = manifest.find()
+    assert record.checksum == datman.manifest.get_checksum(nii)
+    assert record.uid == "1.2.3"
@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+import datman.metadata
+from datman.exceptions import MetadataException
+
+
+@pytest.fixture
+def db(tmp_path):
+    with datman.metadata.MetadataDB(str(tmp_path / "metadata.sqlite")) as db:
+        yield db
+
+
+def test_new_database_is_empty(db):
+    assert db.is_empty()
+    assert db.read_checklist() == {}
+    assert db.read_blacklist() == {}
+
+
+def test_checklist_entries_stored_without_session(db):
+    db.update_checklist({"STUDY_CMH_0001_01_01": "", "STUDY_CMH_0002_01": "DH"})
+
+    assert db.read_checklist() == {"STUDY_CMH_0001_01": "",
+                                   "STUDY_CMH_0002_01": "DH"}
+    assert db.read_checklist(subject="STUDY_CMH_0002_01_01") == "DH"
+    assert db.read_checklist(subject="STUDY_CMH_0003_01") is None
+
+
+def test_overwrite_false_keeps_existing_entries(db):
+    db.update_checklist({"STUDY_CMH_0001_01": "DH"})
+    db.update_checklist({"STUDY_CMH_0001_01": "",
+                         "STUDY_CMH_0002_01": ""}, overwrite=False)
+
+    assert db.read_checklist() == {"STUDY_CMH_0001_01": "DH",
+                                   "STUDY_CMH_0002_01": ""}
+
+
+def test_invalid_entry_adds_nothing(db):
+    with pytest.raises(MetadataException):
+        db.update_checklist({"STUDY_CMH_0001_01": "DH", "BAD_ID": ""})
+    assert db.is_empty()
+
+    with pytest.raises(MetadataException):
+        db.update_blacklist({"STUDY_CMH_0001_01_01_T1_02_T1": "Motion",
+                             "BAD_ID": "Motion"})
+    assert db.is_empty()
+
+
+def test_blacklist_lookups(db):
+    db.update_blacklist({
+        "STUDY_CMH_0001_01_01_T1_02_T1": "Motion",
+        "STUDY_CMH_0001_01_02_RST_03_Rest": "Aborted",
+        "STUDY_CMH_0002_01_01_T1_02_T1": "Artifact",
+        "STUDY_CMH_0003_01_01_T1_02_T1": "",
+    })
+
+    assert len(db.read_blacklist()) == 3
+    assert db.read_blacklist(scan="STUDY_CMH_0002_01_01_T1_02_T1") \
+        == "Artifact"
+    assert db.read_blacklist(scan="STUDY_CMH_0003_01_01_T1_02_T1") is None
+    assert sorted(db.read_blacklist(subject="STUDY_CMH_0001_01")) == [
+        "STUDY_CMH_0001_01_01_T1_02_T1", "STUDY_CMH_0001_01_02_RST_03_Rest"
+    ]
+    assert list(db.read_blacklist(subject="STUDY_CMH_0001_01_02")) == [
+        "STUDY_CMH_0001_01_02_RST_03_Rest"
+    ]
+
+
+def test_export_csv_uses_legacy_format(db, tmp_path):
+    db.update_checklist({"STUDY_CMH_0002_01": "DH", "STUDY_CMH_0001_01": ""})
+    db.update_blacklist({"STUDY_CMH_0001_01_01_T1_02_T1": "Motion"})
+    checklist = str(tmp_path / "checklist.csv")
+    blacklist = str(tmp_path / "blacklist.csv")
+
+    db.export_csv(checklist_path=checklist, blacklist_path=blacklist)
+
+    with open(checklist) as fh:
+        assert fh.readlines() == ["qc_STUDY_CMH_0001_01.html \n",
+                                  "qc_STUDY_CMH_0002_01.html DH\n"]
+    with open(blacklist) as fh:
+        assert fh.readlines() == ["series\treason\n",
+                                  "STUDY_CMH_0001_01_01_T1_02_T1 Motion\n"]
+    assert not [f for f in os.listdir(str(tmp_path)) if f.startswith(".tmp")]
+
+
+def test_rollback_journal_used_unless_wal_requested(tmp_path):
+    path = str(tmp_path / "metadata.sqlite")
+    with datman.metadata.MetadataDB(path) as db:
+        mode, = db._conn.execute("PRAGMA journal_mode").fetchone()
+    assert mode == "delete"
+
+    with datman.metadata.MetadataDB(path, wal=True) as db:
+        mode, = db._conn.execute("PRAGMA journal_mode").fetchone()
+    assert mode == "wal"
+
+
+@pytest.mark.parametrize("version", [(3, 7, 17), (3, 45, 0)])
+def test_upsert_works_with_old_sqlite_versions(version, tmp_path,
+                                               monkeypatch):
+    monkeypatch.setattr(datman.metadata.sqlite3, "sqlite_version_info",
+                        version)
+    path = str(tmp_path / "metadata.sqlite")
+
+    with datman.metadata.MetadataDB(path) as db:
+        db.update_checklist({"STUDY_CMH_0001_01": "",
+                             "STUDY_CMH_0002_01": "DH"})
+        db.update_checklist({"STUDY_CMH_0001_01": "KS",
+                             "STUDY_CMH_0003_01": ""})
+        db.update_checklist({"STUDY_CMH_0002_01": "",
+                             "STUDY_CMH_0004_01": ""}, overwrite=False)
+        db.update_blacklist({"STUDY_CMH_0001_01_01_T1_02_T1": "Motion"})
+        db.update_blacklist({"STUDY_CMH_0001_01_01_T1_02_T1": "Artifact"})
+
+        assert db.read_checklist() == {"STUDY_CMH_0001_01": "KS",
+                                       "STUDY_CMH_0002_01": "DH",
+                                       "STUDY_CMH_0003_01": "",
+                                       "STUDY_CMH_0004_01": ""}
+        assert db.read_blacklist() == {
+            "STUDY_CMH_0001_01_01_T1_02_T1": "Artifact"}
@@ -0,0 +1,120 @@
+import threading
+import time
+
+from mock import MagicMock, patch
+
+import datman.extract.registry as registry
+from datman.exceptions import UndefinedSetting
+
+
+def exporter(extractor, seriesdir, outputdir, stem, scan=None):
+    return []
+
+
+def _make_config(settings):
+    def get_key(key, site=None):
+        try:
+            return settings[key]
+        except KeyError:
+            raise UndefinedSetting(key)
+
+    config = MagicMock()
+    config.get_key.side_effect = get_key
+    return config
+
+
+def test_given_exporters_replace_defaults_and_run_inline():
+    formats = registry.get_formats({'fake': exporter})
+
+    assert list(formats) == ['fake']
+    assert formats['fake'].exporter is exporter
+    assert formats['fake'].workers == 0
+
+
+def test_export_workers_setting_overrides_defaults():
+    config = _make_config({'EXPORT_WORKERS': {'nii': 6, 'unknown': 2}})
+
+    with patch.object(registry, '_get_entry_points', return_value=[]):
+        formats = registry.get_formats(config=config)
+
+    assert formats['nii'].workers == 6
+    assert formats['mnc'].workers == registry.DEFAULT_FORMATS['mnc'].workers
+    assert registry.DEFAULT_FORMATS['nii'].workers != 6
+
+
+def test_plugins_are_loaded_from_entry_points():
+    sidecar = MagicMock()
+    sidecar.name = 'sidecar'
+    sidecar.load.return_value = registry.ExportFormat('json', exporter,
+                                                      workers=3)
+    broken = MagicMock()
+    broken.name = 'broken'
+    broken.load.side_effect = ImportError('No module named mypackage')
+
+    with patch.object(registry, '_get_entry_points',
+                      return_value=[sidecar, broken]):
+        formats = registry.get_formats()
+
+    assert formats['sidecar'].name == 'sidecar'
+    assert formats['sidecar'].workers == 3
+    assert 'broken' not in formats
+    assert 'nii' in formats
+
+
+class TestExportPool:
+
+    def _track(self, running, peak, lock):
+        def run():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return threading.current_thread().name
+        return run
+
+    def test_inline_formats_run_in_calling_thread(self):
+        pool = registry.ExportPool({'dcm': registry.ExportFormat('dcm',
+                                                                 exporter)})
+
+        job = pool.submit('dcm', threading.current_thread)
+
+        assert job.done()
+        assert job.result() is threading.current_thread()
+
+    def test_workers_limit_concurrent_exports(self):
+        running, peak, lock = [0], [0], threading.Lock()
+        pool = registry.ExportPool(
+            {'nii': registry.ExportFormat('nii', exporter, workers=2)},
+            cpus=8)
+
+        jobs = [pool.submit('nii', self._track(running, peak, lock))
+                for _ in range(6)]
+        names = {job.result() for job in jobs}
+        pool.shutdown()
+
+        assert peak[0] == 2
+        assert all(name.startswith('export_nii') for name in names)
+
+    def test_formats_share_cpus(self):
+        running, peak, lock = [0], [0], threading.Lock()
+        pool = registry.ExportPool({
+            'nii': registry.ExportFormat('nii', exporter, workers=2, cpus=1),
+            'mnc': registry.ExportFormat('mnc', exporter, workers=2, cpus=1),
+        }, cpus=1)
+
+        jobs = [pool.submit(name, self._track(running, peak, lock))
+                for name in ['nii', 'mnc', 'nii', 'mnc']]
+        for job in jobs:
+            job.result()
+        pool.shutdown()
+
+        assert peak[0] == 1
+
+    def test_errors_are_returned_by_the_future(self):
+        pool = registry.ExportPool({})
+
+        job = pool.submit('unknown', lambda: 1 / 0)
+
+        assert isinstance(job.exception(), ZeroDivisionError)
@@ -85,21 +85,32 @@ class TestScan(unittest.TestCase):
         assert subject.dcm_path == expected_dcm
         assert subject.qc_path == expected_qc
 
+    def test_paths_unaffected_by_later_study_changes(self):
+        config = cfg.config(filename=site_config, system=system, study=study)
+        subject = datman.scan.Scan(self.good_name, config)
+        expected_nii = config.get_path('nii') + self.good_name
+
+        with patch.object(config, 'get_path',
+                          return_value='/other/study/') as mock_get_path:
+            assert subject.nii_path == expected_nii
+        assert not mock_get_path.called
+        assert config.study_name == study
+
     def test_niftis_and_dicoms_set_to_empty_list_when_broken_path(self):
         subject = datman.scan.Scan(self.good_name, self.config)
 
         assert subject.niftis == []
         assert subject.dicoms == []
 
-    @patch('glob.glob')
-    def test_niftis_with_either_extension_type_found(self, mock_glob):
+    @patch('datman.scan.list_dir')
+    def test_niftis_with_either_extension_type_found(self, mock_list_dir):
         simple_ext = "{}_01_T1_02_SagT1-BRAVO.nii".format(self.good_name)
         complex_ext = "{}_01_DTI60-1000_05_Ax-DTI-60.nii.gz".format(
             self.good_name)
         wrong_ext = "{}_01_DTI60-1000_05_Ax-DTI-60.bvec".format(self.good_name)
 
         nii_list = [simple_ext, complex_ext, wrong_ext]
-        mock_glob.return_value = nii_list
+        mock_list_dir.return_value = nii_list
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
@@ -108,30 +119,31 @@ class TestScan(unittest.TestCase):
 
         assert sorted(found_niftis) == sorted(expected)
 
-    @patch('glob.glob')
+    @patch('datman.scan.list_dir')
     def test_subject_series_with_nondatman_name_causes_parse_exception(
             self,
-            mock_glob):
+            mock_list_dir):
         well_named = "{}_01_T1_02_SagT1-BRAVO.nii".format(self.good_name)
         badly_named1 = "{}_01_DTI60-1000_05_Ax-DTI-60.nii".format(
             self.bad_name)
         badly_named2 = "{}_01_T2_07.nii".format(self.good_name)
 
         nii_list = [well_named, badly_named1, badly_named2]
-        mock_glob.return_value = nii_list
+        mock_list_dir.return_value = nii_list
 
+        subject = datman.scan.Scan(self.good_name, self.config)
         with pytest.raises(datman.scanid.ParseException):
-            datman.scan.Scan(self.good_name, self.config)
+            subject.niftis
 
-    @patch('glob.glob')
-    def test_dicoms_lists_only_dicom_files(self, mock_glob):
+    @patch('datman.scan.list_dir')
+    def test_dicoms_lists_only_dicom_files(self, mock_list_dir):
         dicom1 = "{}_01_T1_02_SagT1-BRAVO.dcm".format(self.good_name)
         dicom2 = "{}_01_DTI60-1000_05_Ax-DTI-60.dcm".format(self.good_name)
         nifti = "{}_01_T1_02_SagT1-BRAVO.nii".format(self.good_name)
         wrong_ext = "{}_01_DTI60-1000_05_Ax-DTI-60.bvec".format(self.good_name)
 
         dcm_list = [dicom1, nifti, dicom2, wrong_ext]
-        mock_glob.return_value = dcm_list
+        mock_list_dir.return_value = dcm_list
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
@@ -140,37 +152,37 @@ class TestScan(unittest.TestCase):
 
         assert sorted(found_dicoms) == sorted(expected)
 
-    @patch('glob.glob')
-    def test_nii_tags_lists_all_tags(self, mock_glob):
+    @patch('datman.scan.list_dir')
+    def test_nii_tags_lists_all_tags(self, mock_list_dir):
         T1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.nii"
         DTI = "STUDY_CAMH_9999_01_01_DTI60-1000_05_Ax-DTI-60.nii"
 
-        mock_glob.return_value = [T1, DTI]
+        mock_list_dir.return_value = [T1, DTI]
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
         assert sorted(subject.nii_tags) == sorted(['T1', 'DTI60-1000'])
         assert subject.dcm_tags == []
 
-    @patch('glob.glob')
-    def test_dcm_tags_lists_all_tags(self, mock_glob):
+    @patch('datman.scan.list_dir')
+    def test_dcm_tags_lists_all_tags(self, mock_list_dir):
         T1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.dcm"
         DTI = "STUDY_CAMH_9999_01_01_DTI60-1000_05_Ax-DTI-60.dcm"
 
-        mock_glob.return_value = [T1, DTI]
+        mock_list_dir.return_value = [T1, DTI]
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
         assert sorted(subject.dcm_tags) == sorted(['T1', 'DTI60-1000'])
         assert subject.nii_tags == []
 
-    @patch('glob.glob')
-    def test_get_tagged_nii_finds_all_matching_series(self, mock_glob):
+    @patch('datman.scan.list_dir')
+    def test_get_tagged_nii_finds_all_matching_series(self, mock_list_dir):
         T1_1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.nii"
         T1_2 = "STUDY_CAMH_9999_01_01_T1_03_SagT1-BRAVO.nii.gz"
         DTI = "STUDY_CAMH_9999_01_01_DTI_05_Ax-DTI-60.nii"
 
-        mock_glob.return_value = [T1_1, DTI, T1_2]
+        mock_list_dir.return_value = [T1_1, DTI, T1_2]
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
@@ -182,13 +194,13 @@ class TestScan(unittest.TestCase):
         expected = [DTI]
         assert actual_DTIs == expected
 
-    @patch('glob.glob')
-    def test_get_tagged_dcm_finds_all_matching_series(self, mock_glob):
+    @patch('datman.scan.list_dir')
+    def test_get_tagged_dcm_finds_all_matching_series(self, mock_list_dir):
         T1_1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.dcm"
         T1_2 = "STUDY_CAMH_9999_01_01_T1_03_SagT1-BRAVO.dcm"
         DTI = "STUDY_CAMH_9999_01_01_DTI_05_Ax-DTI-60.dcm"
 
-        mock_glob.return_value = [T1_1, DTI, T1_2]
+        mock_list_dir.return_value = [T1_1, DTI, T1_2]
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
@@ -200,15 +212,39 @@ class TestScan(unittest.TestCase):
         expected = [DTI]
         assert actual_DTIs == expected
 
-    @patch('glob.glob')
+    @patch('datman.scan.list_dir')
     def test_get_tagged_X_returns_empty_list_when_no_tag_files(self,
-                                                               mock_glob):
+                                                               mock_list_dir):
         nifti = "STUDY_CAMH_9999_01_01_T1_03_SagT1-BRAVO.nii.gz"
         dicom = "STUDY_CAMH_9999_01_01_DTI_05_Ax-DTI-60.dcm"
 
-        mock_glob.return_value = [nifti, dicom]
+        mock_list_dir.return_value = [nifti, dicom]
 
         subject = datman.scan.Scan(self.good_name, self.config)
 
         assert subject.get_tagged_nii('DTI') == []
         assert subject.get_tagged_dcm('T1') == []
+
+    @patch('datman.scan.list_dir')
+    def test_folders_only_read_when_series_first_needed(self, mock_list_dir):
+        mock_list_dir.return_value = [
+            "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.nii"]
+
+        subject = datman.scan.Scan(self.good_name, self.config)
+        assert subject.full_id == self.good_name
+        assert not mock_list_dir.called
+
+        subject.niftis
+        subject.nii_tags
+        subject.get_tagged_nii('T1')
+        assert mock_list_dir.call_count == 1
+
+
+def test_list_dir_returns_full_paths_and_skips_hidden_files(tmp_path):
+    (tmp_path / "STUDY_CMH_9999_01_01_T1_02_SagT1.nii").write_text("")
+    (tmp_path / ".hidden").write_text("")
+
+    found = datman.scan.list_dir(str(tmp_path))
+
+    assert found == [str(tmp_path / "STUDY_CMH_9999_01_01_T1_02_SagT1.nii")]
+    assert datman.scan.list_dir(str(tmp_path / "missing")) == []
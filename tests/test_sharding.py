@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+
+import datman.scanid
+import datman.sharding
+
+
+@pytest.mark.parametrize('spec', ['3', '1/0', '2/2', '-1/4', 'a/b'])
+def test_invalid_shards_rejected(spec):
+    with pytest.raises(ValueError):
+        datman.sharding.parse_shard(spec)
+
+
+def test_sessions_of_a_timepoint_share_a_shard():
+    names = ['STUDY_CMH_{:04d}_01_{:02d}'.format(sub, sess)
+             for sub in range(50) for sess in (1, 2)]
+    idents = [datman.scanid.parse(name) for name in names]
+
+    plan = datman.sharding.make_plan(idents, 4)
+
+    assert sorted(name for shard in plan.values() for name in shard) == \
+        sorted(names)
+    assert all(plan.values())
+    for ident in idents:
+        shard = datman.sharding.get_shard(ident, 4)
+        assert shard == datman.sharding.get_shard(str(ident), 4)
+        assert datman.sharding.in_shard(
+            ident.get_full_subjectid_with_timepoint() + '_02', shard, 4)
+
+
+def _save(log_dir, study, index, count, experiments, complete=True):
+    summary = datman.sharding.ShardSummary(study, index, count)
+    for name, errors in experiments:
+        summary.start(name)
+        summary.finish({'ERROR': errors})
+    name = datman.sharding.get_log_name(study, index, count)
+    summary.save(os.path.join(log_dir, name + '.summary.json'), complete)
+
+
+def test_merge_summaries(tmp_path):
+    log_dir = str(tmp_path)
+    _save(log_dir, 'STUDY', 0, 3, [('STUDY_CMH_0001_01_01', 0),
+                                   ('STUDY_CMH_0002_01_01', 2)])
+    _save(log_dir, 'STUDY', 2, 3, [('STUDY_CMH_0003_01_01', 0)],
+          complete=False)
+    _save(log_dir, 'OTHER', 0, 1, [('OTHER_CMH_0001_01_01', 0)])
+    with open(os.path.join(log_dir, 'junk.summary.json'), 'w') as fh:
+        fh.write('not json')
+
+    summaries = datman.sharding.read_summaries(log_dir, study='STUDY')
+    report = datman.sharding.merge_summaries(summaries)
+
+    assert list(report) == ['STUDY']
+    result = report['STUDY']
+    assert result['experiments'] == 3
+    assert result['reported'] == [0, 2]
+    assert result['missing'] == [1]
+    assert result['incomplete'] == [2]
+    assert result['failed'] == ['STUDY_CMH_0002_01_01']
+    json.dumps(report)
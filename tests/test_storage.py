@@ -0,0 +1,130 @@
+import collections
+import os
+import threading
+
+import pytest
+from mock import MagicMock, patch
+
+import datman.storage
+from datman.exceptions import StorageException, UndefinedSetting
+
+GB = datman.storage.GB
+
+Usage = collections.namedtuple("Usage", ["total", "used", "free"])
+
+
+@pytest.fixture
+def roots(tmp_path):
+    paths = []
+    for name in ["small", "big"]:
+        path = tmp_path / name
+        path.mkdir()
+        paths.append(str(path))
+    return paths
+
+
+@pytest.fixture
+def disk(roots):
+    """Pretend the 'big' root has 10GB free and everything else 2GB."""
+    def disk_usage(path):
+        free = 10 * GB if path.endswith("big") else 2 * GB
+        return Usage(20 * GB, 20 * GB - free, free)
+
+    with patch("datman.storage.shutil.disk_usage", side_effect=disk_usage):
+        yield
+
+
+def test_reservations_reduce_available_space_until_released(roots, disk):
+    budget = datman.storage.StorageBudget(headroom=0)
+
+    with budget.reserve(os.path.join(roots[0], "new_file.zip"), GB):
+        assert budget.available(roots[0]) == GB
+    assert budget.available(roots[0]) == 2 * GB
+
+
+def test_temp_directory_made_in_root_with_most_space(roots, disk):
+    budget = datman.storage.StorageBudget(roots, headroom=0)
+
+    with budget.temp_directory(GB, prefix="test_") as temp:
+        assert os.path.dirname(temp) == roots[1]
+        assert os.path.basename(temp).startswith("test_")
+        with open(os.path.join(temp, "data"), "w") as fh:
+            fh.write("data")
+
+    assert not os.path.exists(temp)
+    assert budget.available(roots[1]) == 10 * GB
+
+
+def test_temp_directory_cleaned_up_after_errors(roots, disk):
+    budget = datman.storage.StorageBudget(roots, headroom=0)
+
+    with pytest.raises(RuntimeError):
+        with budget.temp_directory(GB) as temp:
+            raise RuntimeError("Conversion failed")
+
+    assert not os.path.exists(temp)
+    assert budget.available(roots[1]) == 10 * GB
+
+
+def test_headroom_is_left_free(roots, disk):
+    budget = datman.storage.StorageBudget([roots[0]], headroom=GB, timeout=0)
+
+    with pytest.raises(StorageException):
+        with budget.temp_directory(int(1.5 * GB)):
+            pass
+
+
+def test_transfer_larger_than_disk_fails_without_waiting(roots, disk):
+    budget = datman.storage.StorageBudget(roots, timeout=None)
+
+    with pytest.raises(StorageException):
+        with budget.temp_directory(30 * GB):
+            pass
+
+
+def test_waits_for_space_to_be_released(roots, disk):
+    budget = datman.storage.StorageBudget([roots[0]], headroom=0, timeout=10,
+                                          poll=0.05)
+    started = threading.Event()
+    release = threading.Event()
+
+    def hold_space():
+        with budget.reserve(roots[0], int(1.5 * GB)):
+            started.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_space)
+    holder.start()
+    started.wait(5)
+
+    timer = threading.Timer(0.2, release.set)
+    timer.start()
+    with budget.temp_directory(GB):
+        assert release.is_set()
+    holder.join()
+
+
+def test_for_config_uses_study_settings(roots):
+    settings = {"TEMP_ROOTS": roots[1], "DISK_HEADROOM_GB": "0.5"}
+
+    def get_key(key, site=None):
+        try:
+            return settings[key]
+        except KeyError:
+            raise UndefinedSetting(key)
+
+    config = MagicMock()
+    config.get_key.side_effect = get_key
+
+    budget = datman.storage.StorageBudget.for_config(config)
+
+    assert budget.temp_roots == [roots[1]]
+    assert budget.headroom == GB // 2
+
+
+def test_get_folder_size(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a").write_bytes(b"x" * 10)
+    (tmp_path / "sub" / "b").write_bytes(b"x" * 5)
+
+    assert datman.storage.get_folder_size(str(tmp_path)) == 15
@@ -2,13 +2,16 @@
 
 import unittest
 import logging
+import threading
+import zipfile
 
 import pytest
 from mock import patch, MagicMock
 
 import datman.utils as utils
 import datman.config
-from datman.exceptions import ParseException
+from datman.exceptions import (MetadataException, ParseException,
+                               UndefinedSetting)
 
 logging.disable(logging.CRITICAL)
 
@@ -119,3 +122,313 @@ class TestValidateSubjectID:
         with pytest.raises(ParseException):
             bad_site = "AND01_UFO_0408_01_SE01_MR"
             utils.validate_subject_id(bad_site, dm_config)
+
+
+class TestMakeZip:
+
+    @pytest.fixture
+    def source_dir(self, tmp_path):
+        series = tmp_path / "source" / "series1"
+        series.mkdir(parents=True)
+        (series / "0001.dcm").write_bytes(b"dicom" * 1000)
+        (series / "0002.dcm").write_bytes(b"more dicom" * 1000)
+        (tmp_path / "source" / "T1.nii.gz").write_bytes(b"already zipped")
+        (tmp_path / "source" / "big.txt").write_bytes(b"x" * 5000)
+        return str(tmp_path / "source")
+
+    def test_contents_match_source_files(self, source_dir, tmp_path):
+        dest = str(tmp_path / "out.zip")
+        utils.make_zip(source_dir, dest)
+
+        with zipfile.ZipFile(dest) as zf:
+            assert zf.testzip() is None
+            assert zf.read("series1/0001.dcm") == b"dicom" * 1000
+            assert zf.read("T1.nii.gz") == b"already zipped"
+
+    def test_members_written_in_sorted_order(self, source_dir, tmp_path):
+        dest = str(tmp_path / "out.zip")
+        utils.make_zip(source_dir, dest, workers=4)
+
+        with zipfile.ZipFile(dest) as zf:
+            assert zf.namelist() == [
+                "T1.nii.gz", "big.txt", "series1/0001.dcm",
+                "series1/0002.dcm"
+            ]
+
+    def test_precompressed_files_are_stored(self, source_dir, tmp_path):
+        dest = str(tmp_path / "out.zip")
+        utils.make_zip(source_dir, dest)
+
+        with zipfile.ZipFile(dest) as zf:
+            stored = zf.getinfo("T1.nii.gz")
+            deflated = zf.getinfo("series1/0001.dcm")
+        assert stored.compress_type == zipfile.ZIP_STORED
+        assert deflated.compress_type == zipfile.ZIP_DEFLATED
+
+    def test_large_files_streamed_by_zipfile(self, source_dir, tmp_path):
+        dest = str(tmp_path / "out.zip")
+        utils.make_zip(source_dir, dest, max_buffer=4096)
+
+        with zipfile.ZipFile(dest) as zf:
+            assert zf.testzip() is None
+            assert zf.read("big.txt") == b"x" * 5000
+
+    def test_bytes_compressed_ahead_are_capped(self, source_dir, tmp_path):
+        dest = str(tmp_path / "out.zip")
+        held = [0, 0]
+        lock = threading.Lock()
+        compress_member = utils._compress_member
+        write_member = utils._write_member
+
+        def compress(path, level):
+            result = compress_member(path, level)
+            with lock:
+                held[0] += result[2]
+                held[1] = max(held)
+            return result
+
+        def write(*args):
+            freed = write_member(*args)
+            with lock:
+                held[0] -= freed
+            return freed
+
+        with patch.object(utils, "_compress_member", side_effect=compress), \
+                patch.object(utils, "_write_member", side_effect=write):
+            utils.make_zip(source_dir, dest, workers=4, max_buffer=12000)
+
+        assert 0 < held[1] <= 12000
+        with zipfile.ZipFile(dest) as zf:
+            assert zf.testzip() is None
+            assert zf.read("series1/0002.dcm") == b"more dicom" * 1000
+
+    def test_members_compressed_concurrently(self, source_dir, tmp_path):
+        dest = str(tmp_path / "out.zip")
+        # Fails with BrokenBarrierError unless two members are being
+        # compressed at the same time
+        barrier = threading.Barrier(2, timeout=5)
+        compress_member = utils._compress_member
+
+        def compress(path, level):
+            if path.endswith(".dcm"):
+                barrier.wait()
+            return compress_member(path, level)
+
+        with patch.object(utils, "_compress_member", side_effect=compress):
+            utils.make_zip(source_dir, dest, workers=2)
+
+        with zipfile.ZipFile(dest) as zf:
+            assert zf.testzip() is None
+            assert zf.read("series1/0001.dcm") == b"dicom" * 1000
+
+    def test_zip64_records_readable(self, source_dir, tmp_path):
+        dest = str(tmp_path / "out.zip")
+
+        with patch.object(utils, "ZIP64_LIMIT", 100), \
+                patch.object(utils, "ZIP64_COUNT_LIMIT", 2):
+            utils.make_zip(source_dir, dest, max_buffer=4096)
+
+        with zipfile.ZipFile(dest) as zf:
+            assert zf.testzip() is None
+            assert len(zf.namelist()) == 4
+            assert zf.read("big.txt") == b"x" * 5000
+            assert zf.read("series1/0002.dcm") == b"more dicom" * 1000
+
+    def test_process_pool_makes_same_archive(self, source_dir, tmp_path):
+        threads = str(tmp_path / "threads.zip")
+        processes = str(tmp_path / "processes.zip")
+
+        utils.make_zip(source_dir, threads, workers=2)
+        utils.make_zip(source_dir, processes, workers=2, use_processes=True)
+
+        with open(threads, "rb") as fh1, open(processes, "rb") as fh2:
+            assert fh1.read() == fh2.read()
+
+
+class TestMetadataBackend:
+
+    @pytest.fixture
+    def config(self, tmp_path):
+        config = MagicMock(spec=datman.config.config)
+        config.study_name = 'STUDY'
+        settings = {'METADATA_BACKEND': 'sqlite'}
+
+        def get_key(key):
+            try:
+                return settings[key]
+            except KeyError:
+                raise UndefinedSetting(key)
+
+        config.get_key.side_effect = get_key
+        config.get_path.return_value = str(tmp_path)
+        return config
+
+    def test_csv_files_used_when_backend_not_set(self, config, tmp_path):
+        config.get_key.side_effect = UndefinedSetting
+        with open(str(tmp_path / 'checklist.csv'), 'w') as fh:
+            fh.write("qc_STUDY_CMH_0001_01.html DH\n")
+
+        utils.update_checklist({'STUDY_CMH_0002_01': ''}, config=config)
+
+        assert utils.read_checklist(config=config) == {
+            'STUDY_CMH_0001_01': 'DH', 'STUDY_CMH_0002_01': ''}
+        assert not (tmp_path / 'metadata.sqlite').exists()
+
+    def test_database_imports_existing_csv_files(self, config, tmp_path):
+        with open(str(tmp_path / 'checklist.csv'), 'w') as fh:
+            fh.write("qc_STUDY_CMH_0001_01.html DH\n")
+        with open(str(tmp_path / 'blacklist.csv'), 'w') as fh:
+            fh.write("series\treason\n"
+                     "STUDY_CMH_0001_01_01_T1_02_T1 Motion\n")
+
+        utils.update_checklist({'STUDY_CMH_0002_01': ''}, config=config)
+        utils.update_blacklist({'STUDY_CMH_0002_01_01_T1_02_T1': 'Artifact'},
+                               config=config)
+
+        assert utils.read_checklist(config=config) == {
+            'STUDY_CMH_0001_01': 'DH', 'STUDY_CMH_0002_01': ''}
+        assert utils.read_checklist(subject='STUDY_CMH_0001_01_01',
+                                    config=config) == 'DH'
+        assert utils.read_blacklist(
+            scan='/some/path/STUDY_CMH_0002_01_01_T1_02_T1.nii.gz',
+            config=config) == 'Artifact'
+        assert list(utils.read_blacklist(subject='STUDY_CMH_0001_01',
+                                         config=config)) == [
+            'STUDY_CMH_0001_01_01_T1_02_T1']
+        # The csv files are left alone
+        with open(str(tmp_path / 'checklist.csv')) as fh:
+            assert fh.readlines() == ["qc_STUDY_CMH_0001_01.html DH\n"]
+
+    @patch('datman.config.config')
+    def test_config_only_built_when_study_given(self, mock_config):
+        with pytest.raises(MetadataException):
+            utils.update_checklist({'STUDY_CMH_0001_01': ''})
+        with pytest.raises(MetadataException):
+            utils.update_blacklist({'STUDY_CMH_0001_01_01_T1_02_T1': 'Bad'})
+        assert not mock_config.called
+
+    def test_unknown_backend_raises_exception(self, config):
+        config.get_key.side_effect = lambda key: 'redis'
+
+        with pytest.raises(MetadataException):
+            utils.read_checklist(config=config)
+
+
+class TestReadBlacklist:
+
+    entries = ("series\treason\n"
+               "STUDY_CMH_0001_01_01_T1_02_T1 Motion\n"
+               "STUDY_CMH_0001_01_02_RST_03_Rest Aborted, restarted\n"
+               "STUDY_CMH_0002_01_01_T1_02_T1 Artifact\n"
+               "STUDY_CMH_0002_01_01_T1_02_T1 Duplicate\n")
+
+    @pytest.fixture
+    def blacklist(self, tmp_path):
+        path = str(tmp_path / 'blacklist.csv')
+        with open(path, 'w') as fh:
+            fh.write(self.entries)
+        return path
+
+    def test_lookups(self, blacklist):
+        assert utils.read_blacklist(path=blacklist) == {
+            'STUDY_CMH_0001_01_01_T1_02_T1': 'Motion',
+            'STUDY_CMH_0001_01_02_RST_03_Rest': 'Aborted  restarted',
+            'STUDY_CMH_0002_01_01_T1_02_T1': 'Artifact'}
+        assert utils.read_blacklist(
+            scan='STUDY_CMH_0002_01_01_T1_02_T1.nii.gz',
+            path=blacklist) == 'Artifact'
+        assert utils.read_blacklist(
+            scan='STUDY_CMH_0003_01_01_T1_02_T1', path=blacklist) is None
+        assert list(utils.read_blacklist(subject='STUDY_CMH_0001_01',
+                                         path=blacklist)) == [
+            'STUDY_CMH_0001_01_01_T1_02_T1',
+            'STUDY_CMH_0001_01_02_RST_03_Rest']
+        assert list(utils.read_blacklist(subject='STUDY_CMH_0001_01_02',
+                                         path=blacklist)) == [
+            'STUDY_CMH_0001_01_02_RST_03_Rest']
+        assert len(utils.read_blacklist(subject='STUDY_CMH_000',
+                                        path=blacklist)) == 3
+
+    def test_file_parsed_once_until_modified(self, blacklist):
+        with patch('datman.utils._parse_blacklist',
+                   wraps=utils._parse_blacklist) as mock_parse:
+            for _ in range(3):
+                utils.read_blacklist(scan='STUDY_CMH_0001_01_01_T1_02_T1',
+                                     path=blacklist)
+            assert mock_parse.call_count == 1
+
+            utils.update_blacklist({'STUDY_CMH_0003_01_01_T1_02_T1': 'Bad'},
+                                   path=blacklist)
+
+            assert utils.read_blacklist(scan='STUDY_CMH_0003_01_01_T1_02_T1',
+                                        path=blacklist) == 'Bad'
+
+    def test_returned_entries_are_copies(self, blacklist):
+        entries = utils.read_blacklist(path=blacklist)
+        entries.clear()
+
+        assert len(utils.read_blacklist(path=blacklist)) == 3
+
+
+class TestGetSubjectMetadata:
+
+    @pytest.fixture
+    def config(self, tmp_path):
+        with open(str(tmp_path / 'checklist.csv'), 'w') as fh:
+            fh.write("qc_STUDY_CMH_0001_01.html DH\n"
+                     "qc_STUDY_CMH_0002_01.html\n")
+        with open(str(tmp_path / 'blacklist.csv'), 'w') as fh:
+            fh.write("series\treason\n"
+                     "STUDY_CMH_0001_01_01_T1_02_T1 Motion\n"
+                     "STUDY_CMH_0002_01_01_T1_02_T1 Motion\n")
+        config = MagicMock(spec=datman.config.config)
+        config.study_name = 'STUDY'
+        config.get_key.side_effect = UndefinedSetting
+        config.get_path.return_value = str(tmp_path)
+        return config
+
+    def test_metadata_read_from_snapshot(self, config, tmp_path):
+        expected = {'STUDY_CMH_0001_01': ['STUDY_CMH_0001_01_01_T1_02_T1']}
+        assert utils.get_subject_metadata(config) == expected
+        assert (tmp_path / '.subject_metadata.snapshot').exists()
+
+        with patch('datman.utils.read_checklist') as mock_read:
+            assert utils.get_subject_metadata(config) == expected
+            assert utils.get_subject_metadata(
+                config, allow_partial=True) == {
+                    'STUDY_CMH_0001_01': ['STUDY_CMH_0001_01_01_T1_02_T1'],
+                    'STUDY_CMH_0002_01': ['STUDY_CMH_0002_01_01_T1_02_T1']}
+            mock_read.assert_not_called()
+
+    def test_snapshot_rebuilt_when_sources_change(self, config):
+        utils.get_subject_metadata(config)
+
+        utils.update_checklist({'STUDY_CMH_0002_01': 'DH'}, config=config)
+
+        assert utils.get_subject_metadata(config) == {
+            'STUDY_CMH_0001_01': ['STUDY_CMH_0001_01_01_T1_02_T1'],
+            'STUDY_CMH_0002_01': ['STUDY_CMH_0002_01_01_T1_02_T1']}
+
+    @patch('datman.utils._update_qc_reviewers')
+    @patch('datman.utils.read_blacklist', return_value={})
+    @patch('datman.utils.read_checklist')
+    def test_dashboard_snapshot_rebuilt_after_own_updates(
+            self, mock_checklist, mock_blacklist, mock_update, config,
+            monkeypatch):
+        monkeypatch.setattr(utils.dashboard, 'dash_found', True)
+        monkeypatch.setattr(utils, '_last_dashboard_update', 0)
+        mock_checklist.return_value = {'STUDY_CMH_0001_01': ''}
+        utils.get_subject_metadata(config)
+        assert utils.get_subject_metadata(config) == {}
+        assert mock_checklist.call_count == 1
+
+        utils.update_checklist({'STUDY_CMH_0001_01': 'DH'})
+        mock_checklist.return_value = {'STUDY_CMH_0001_01': 'DH'}
+
+        assert utils.get_subject_metadata(config) == {'STUDY_CMH_0001_01': []}
+        assert mock_checklist.call_count == 2
+
+    def test_snapshot_can_be_skipped(self, config, tmp_path):
+        utils.get_subject_metadata(config, use_snapshot=False)
+
+        assert not (tmp_path / '.subject_metadata.snapshot').exists()
@@ -5,6 +5,7 @@ import logging
 from mock import Mock, patch
 import pytest
 
+import datman.config
 import datman.xnat
 # Used only to act as a spec for Mock
 from datman.config import config as Config
@@ -182,3 +183,62 @@ class TestGetAuth(unittest.TestCase):
         with pytest.raises(KeyError):
             with patch.dict('os.environ', env, clear=True):
                 datman.xnat.get_auth()
+
+
+class TestSetTag:
+    tag_map = {
+        'T1': {'SeriesDescription': 'T1', 'ImageType': 'ORIGINAL'},
+        'FMAP-AP': {'SeriesDescription': ['FMAP', 'FieldMap'],
+                    'ImageType': r'\\M$'},
+        'FMAP-PH': {'SeriesDescription': ['FMAP', 'FieldMap'],
+                    'ImageType': r'\\P$'},
+    }
+
+    def _make_scan(self, description, image_type='ORIGINAL\\PRIMARY\\M'):
+        scan_json = {'data_fields': {'ID': '2',
+                                     'series_description': description,
+                                     'parameters/imageType': image_type},
+                     'children': []}
+        return datman.xnat.XNATScan('STUDY', 'STUDY_CMH_0001_01',
+                                    'STUDY_CMH_0001_01_01', scan_json)
+
+    def test_matcher_and_dict_give_same_tags(self):
+        matcher = datman.config.TagMatcher(self.tag_map)
+        for descr in ['Sag_t1_mprage', 'FieldMap_AP', 'Resting']:
+            assert self._make_scan(descr).set_tag(matcher) == \
+                self._make_scan(descr).set_tag(self.tag_map)
+
+    def test_image_type_used_to_split_fmaps(self):
+        matcher = datman.config.TagMatcher(self.tag_map)
+        scan = self._make_scan('fmap', image_type='ORIGINAL\\PRIMARY\\P')
+
+        scan.set_tag(matcher)
+
+        assert scan.tags == ['FMAP-PH']
+
+    def test_descriptions_only_searched_once(self):
+        matcher = datman.config.TagMatcher(self.tag_map)
+        matcher.match('T1')
+        matcher._patterns = []
+
+        assert list(matcher.match('T1')) == ['T1']
+        assert matcher.match('T1') is not matcher.match('T1')
+
+    def test_invalid_pattern_raises_exception(self):
+        with pytest.raises(datman.config.ConfigException):
+            datman.config.TagMatcher({'T1': {'SeriesDescription': '(T1'}})
+
+
+def test_scan_size_counts_only_dicom_catalog():
+    scan_json = {
+        'data_fields': {'ID': '2', 'series_description': 'T1'},
+        'children': [{'field': 'file', 'items': [
+            {'data_fields': {'label': 'DICOM', 'content': 'RAW',
+                             'file_size': 1000}},
+            {'data_fields': {'label': 'SNAPSHOTS', 'file_size': 50}},
+        ]}],
+    }
+    scan = datman.xnat.XNATScan('STUDY', 'STUDY_CMH_0001_01',
+                                'STUDY_CMH_0001_01_01', scan_json)
+
+    assert scan.size == 1000